@@ -0,0 +1,215 @@
+"""
+Reachability samples of the boxes.
+
+The supervision appends its ping results to the `ping_history` array of the
+boxes. They are regularly moved (drained) to the `box_pings` time-series
+collection, which expires them after PING_RETENTION, so that box documents
+keep a constant size. Box reads exclude the history with WITHOUT_PING_HISTORY
+(see back.mongodb.db; the field is kept, empty, so that boxes still validate).
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import CollectionInvalid
+
+from back.mongodb.hermes_com_models import PingStats
+
+logger = logging.getLogger(__name__)
+
+PING_RETENTION = timedelta(days=90)
+DRAIN_INTERVAL = 300  # seconds
+DRAIN_BATCH_SIZE = 500  # boxes per bulk write
+RECENT_PINGS = 50  # samples shown by the admin dashboard
+
+
+async def ensure_box_pings_collection(db: AsyncIOMotorDatabase) -> None:
+    try:
+        await db.create_collection(
+            "box_pings",
+            timeseries={
+                "timeField": "timestamp",
+                "metaField": "mac",
+                "granularity": "minutes",
+            },
+            expireAfterSeconds=int(PING_RETENTION.total_seconds()),
+        )
+    except CollectionInvalid:
+        pass  # already exists
+    await db.box_pings.create_index([("mac", ASCENDING), ("timestamp", ASCENDING)])
+
+
+def _sample_key(mac: str, timestamp: datetime) -> tuple[str, datetime]:
+    # Dates are stored in UTC with a millisecond precision, and read back naive
+    return mac, timestamp.replace(
+        tzinfo=None, microsecond=timestamp.microsecond // 1000 * 1000
+    )
+
+
+async def drain_ping_history(db: AsyncIOMotorDatabase) -> int:
+    """Move the samples found in the boxes to the time-series collection.
+    Returns the number of samples moved.
+
+    The samples are copied, then pulled from the boxes. If the drain stops in
+    between, the samples already copied (same box and timestamp) are not
+    copied again by the next one."""
+    moved = 0
+    samples: list[dict] = []
+    pulls: list[UpdateOne] = []
+
+    async def flush() -> None:
+        nonlocal moved
+        if samples:
+            periods: dict[str, tuple[datetime, datetime]] = {}
+            for sample in samples:
+                first, last = periods.get(sample["mac"], (sample["timestamp"],) * 2)
+                periods[sample["mac"]] = (
+                    min(first, sample["timestamp"]),
+                    max(last, sample["timestamp"]),
+                )
+            copied = {
+                _sample_key(ping["mac"], ping["timestamp"])
+                async for ping in db.box_pings.find(
+                    {
+                        "$or": [
+                            {"mac": mac, "timestamp": {"$gte": first, "$lte": last}}
+                            for mac, (first, last) in periods.items()
+                        ]
+                    },
+                    {"_id": 0, "mac": 1, "timestamp": 1},
+                )
+            }
+            new_samples = [
+                sample
+                for sample in samples
+                if _sample_key(sample["mac"], sample["timestamp"]) not in copied
+            ]
+            if new_samples:
+                await db.box_pings.insert_many(new_samples, ordered=False)
+            moved += len(new_samples)
+        if pulls:
+            await db.boxes.bulk_write(pulls, ordered=False)
+        samples.clear()
+        pulls.clear()
+
+    async for box in db.boxes.find(
+        {"ping_history.0": {"$exists": True}}, {"mac": 1, "ping_history": 1}
+    ):
+        history = box["ping_history"]
+        samples += [
+            {
+                "mac": box["mac"],
+                "timestamp": datetime.fromtimestamp(ping["timestamp"], timezone.utc),
+                "success": ping["success"],
+            }
+            for ping in history
+        ]
+        # Only remove the samples that were copied, new ones may have been added
+        pulls.append(
+            UpdateOne(
+                {"_id": box["_id"]},
+                {
+                    "$pull": {
+                        "ping_history": {
+                            "timestamp": {
+                                "$lte": max(ping["timestamp"] for ping in history)
+                            }
+                        }
+                    }
+                },
+            )
+        )
+        if len(pulls) >= DRAIN_BATCH_SIZE:
+            await flush()
+
+    await flush()
+    return moved
+
+
+async def ping_drain_loop(db: AsyncIOMotorDatabase) -> None:
+    logger.info("box_pings drain loop started (every %d s)", DRAIN_INTERVAL)
+    while True:
+        try:
+            moved = await drain_ping_history(db)
+            if moved:
+                logger.info("box_pings: %d samples moved", moved)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("box_pings drain loop: unexpected error: %s", e)
+        await asyncio.sleep(DRAIN_INTERVAL)
+
+
+def _as_ping(ping: dict) -> dict:
+    return {
+        "timestamp": ping["timestamp"].replace(tzinfo=timezone.utc).timestamp(),
+        "success": ping["success"],
+    }
+
+
+async def get_recent_pings(
+    db: AsyncIOMotorDatabase,
+    mac: str,
+    pending: list[dict],
+    limit: int = RECENT_PINGS,
+) -> list[dict]:
+    """Return the latest samples of a box, most recent first, in the format
+    of `Box.ping_history`. If none of them succeeded, the last successful
+    sample is added at the end, so that the last time the box answered is
+    still known.
+
+    Args:
+        * pending (list[dict]): the `ping_history` of the box, i.e. the
+          samples not drained to `box_pings` yet"""
+    pings = sorted(pending, key=lambda ping: ping["timestamp"], reverse=True)[:limit]
+    if len(pings) < limit:
+        pings += [
+            _as_ping(ping)
+            async for ping in db.box_pings.find({"mac": mac})
+            .sort("timestamp", -1)
+            .limit(limit - len(pings))
+        ]
+
+    if pings and not any(ping["success"] for ping in pings):
+        last_success = await db.box_pings.find_one(
+            {"mac": mac, "success": True}, sort=[("timestamp", -1)]
+        )
+        if last_success is not None:
+            pings.append(_as_ping(last_success))
+
+    return pings
+
+
+async def get_ping_stats(
+    db: AsyncIOMotorDatabase,
+    mac: str,
+    start: datetime,
+    end: datetime,
+    unit: str = "hour",
+) -> list[PingStats]:
+    """Return the reachability of a box between two dates,
+    downsampled to one entry per `unit` (minute, hour, day...)."""
+    return [
+        PingStats(
+            start=bucket["_id"],
+            pings=bucket["pings"],
+            successes=bucket["successes"],
+            success_rate=bucket["successes"] / bucket["pings"],
+        )
+        async for bucket in db.box_pings.aggregate(
+            [
+                {"$match": {"mac": mac, "timestamp": {"$gte": start, "$lt": end}}},
+                {
+                    "$group": {
+                        "_id": {"$dateTrunc": {"date": "$timestamp", "unit": unit}},
+                        "pings": {"$sum": 1},
+                        "successes": {"$sum": {"$cond": ["$success", 1, 0]}},
+                    }
+                },
+                {"$sort": {"_id": 1}},
+            ]
+        )
+    ]
@@ -1,25 +1,43 @@
+import re
+
 import requests
 
 from back.env import ENV
 from back.messaging.matrix import send_matrix_message
 
+# A line of the ONT tables of `get-all-ont-summary`: the ONT id in the port,
+# then its serial number (16 hexadecimal digits, or 4 letters and 8 digits)
+_SUMMARY_ONT_LINE = re.compile(
+    r"^\s*(\d+)\s+([0-9A-Fa-f]{16}|[A-Za-z]{4}[0-9A-Fa-f]{8})\b"
+)
+# Start of the section of a port, e.g. "In port 0/1/0 , the total of ONTs..."
+_SUMMARY_PORT_LINE = re.compile(r"In port\s+(\d+/\d+/\d+)")
+
+
+def register_ont_in_olt(ont_serial: str, notify: bool = True) -> bool:
+    """Register an ONT in the OLT. Returns whether Charon accepted it.
 
-def register_ont_in_olt(ont_serial: str) -> None:
-    """Register an ONT in the OLT."""
+    Args:
+        * ont_serial (str): serial number of the ONT
+        * notify (bool): send a Matrix message if the registration failed"""
     if ENV.deploy_env != "prod":
         print(f"ENV IS NOT PROD - Registering ONT {ont_serial} in OLT")
-        return
+        return True
 
     r = requests.get(f"{ENV.charon_url}/register-onu/{ont_serial}", timeout=5)
 
     if r.status_code != 200:
-        send_matrix_message(
-            f"❌ Erreur lors de l'enregistrement de l'ONT {ont_serial} dans l'OLT",
-            "```",
-            f"Code {r.status_code}",
-            r.text,
-            "```",
-        )
+        if notify:
+            send_matrix_message(
+                f"❌ Erreur lors de l'enregistrement de l'ONT {ont_serial} dans l'OLT",
+                "```",
+                f"Code {r.status_code}",
+                r.text,
+                "```",
+            )
+        return False
+
+    return True
 
 
 def unregister_ont_in_olt(ont_serial: str) -> None:
@@ -38,3 +56,27 @@ def unregister_ont_in_olt(ont_serial: str) -> None:
             r.text,
             "```",
         )
+
+
+def get_all_ont_summary(olt: str = "olt1") -> str:
+    """Get the summary of all the ONTs of an OLT, as printed by the OLT."""
+    r = requests.get(f"{ENV.charon_url}/get-all-ont-summary/{olt}", timeout=10)
+
+    if r.status_code != 200:
+        raise ValueError(f"Charon Error {r.status_code} : {r.text}")
+
+    return r.text
+
+
+def parse_ont_summary(summary: str) -> dict[str, str | None]:
+    """The serial numbers of the ONTs in a summary of `get_all_ont_summary`,
+    with the port of the OLT they are on (None if the summary does not say).
+    The serial numbers are upper case."""
+    onts: dict[str, str | None] = {}
+    port = None
+    for line in summary.splitlines():
+        if match := _SUMMARY_PORT_LINE.search(line):
+            port = match.group(1)
+        elif match := _SUMMARY_ONT_LINE.match(line):
+            onts[match.group(2).upper()] = port
+    return onts
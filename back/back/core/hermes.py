@@ -1,7 +1,6 @@
-import random
-import string
 from datetime import datetime
-from ipaddress import IPv4Address, IPv4Interface, IPv6Address
+from ipaddress import IPv4Address, IPv4Interface, IPv6Address, IPv6Network
+from typing import Tuple
 
 from common_models.hermes_models import (
     Box,
@@ -11,17 +10,27 @@ from common_models.hermes_models import (
     UnetFirewall,
     UnetNetwork,
     UnetProfile,
+    WanIpv4,
+    WanIpv6,
     WanVlan,
     WifiDetails,
 )
 from common_models.log_models import IpamLog
+from common_models.pon_models import ONT
 from common_models.user_models import User
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from netaddr import EUI
-from xkcdpass import xkcd_password
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 
 from back.core.ipam import MongoIpam
-from back.core.ipam_logging import create_log
+from back.core.ipam_logging import create_log, create_logs
+from back.core.loader import Loader
+from back.core.passwords import generate_password
+from back.core.ssid_pool import allocate_ssid, allocate_ssids, release_ssid_reservations
+from back.core.unet_ids import allocate_unet_id, allocate_unet_ids
+from back.mongodb.db import WITHOUT_PING_HISTORY
+from back.mongodb.hermes_com_models import EnrichedBox
 
 ADH_TP_IPV4_WAN_VLAN = WanVlan(
     vlan_id=101, ipv4_gateway=IPv4Address("137.194.11.254"), ipv6_gateway=None
@@ -35,14 +44,55 @@ ADH_IPV6_WAN_VLAN = WanVlan(
     vlan_id=103, ipv4_gateway=None, ipv6_gateway=IPv6Address("2a09:6847:ffff::1")
 )
 
+# Fields of a unet its members may change themselves
+UNET_SETTINGS_FIELDS = ("wifi", "firewall", "dhcp")
+# Attempts of a versioned box update before giving up on a busy box
+BOX_UPDATE_ATTEMPTS = 5
+# Boxes enriched with their users and ONT per page, see get_enriched_boxes
+ENRICHED_BOXES_LIMIT = 100
 
-async def _generate_unique_unet_id(db: AsyncIOMotorDatabase) -> str:
-    unet_id = "".join(
-        random.choice(string.ascii_lowercase + string.digits) for _ in range(8)
+
+class UnetVersionConflict(ValueError):
+    """Raised when a unet changed since the version an update was based on."""
+
+    def __init__(self, unet_id: str) -> None:
+        """Raised when a unet changed since the version an update was based on."""
+        super().__init__(f"The unet {unet_id} was modified concurrently")
+
+
+def _build_unet_profile(
+    unet_id: str,
+    addresses: Tuple[WanIpv4, WanIpv6, IPv6Network],
+    lan_vlan: int,
+    ssid: str,
+) -> UnetProfile:
+    wan_ipv4, wan_ipv6, ipv6_prefix = addresses
+    return UnetProfile(
+        unet_id=unet_id,
+        network=UnetNetwork(
+            wan_ipv4=wan_ipv4,
+            wan_ipv6=wan_ipv6,
+            ipv6_prefix=ipv6_prefix,
+            lan_ipv4=LanIpv4(
+                address=IPv4Interface(f"192.168.{lan_vlan}.1/24"),
+                vlan=lan_vlan,
+            ),
+        ),
+        wifi=WifiDetails(ssid=ssid, psk=generate_password()),
+        dhcp=Dhcp(
+            dns_servers=DnsServers(
+                ipv4=[IPv4Address("8.8.8.8"), IPv4Address("1.1.1.1")],
+                ipv6=[
+                    IPv6Address("2001:4860:4860::8888"),
+                    IPv6Address("2606:4700:4700::1111"),
+                ],
+            )
+        ),
+        firewall=UnetFirewall(
+            ipv4_port_forwarding=[],
+            ipv6_port_opening=[],
+        ),
     )
-    if await db.boxes.find_one({"main_unet_id": unet_id}):
-        return await _generate_unique_unet_id(db)
-    return unet_id
 
 
 async def register_box_for_new_ftth_adh(
@@ -57,47 +107,33 @@ async def register_box_for_new_ftth_adh(
 
     ipam = MongoIpam(db)
 
-    available_ipv4 = await ipam.get_available_ipv4(telecom_ip)
-    ipv6, prefix = ipam.compute_ipv6_and_prefix(available_ipv4.ip.ip, telecom_ip)
-
-    unet_id = await _generate_unique_unet_id(db)
+    unet_id = await allocate_unet_id(db)
+    available_ipv4, ipv6, prefix = await ipam.lease_addresses(telecom_ip, unet_id)
+    ssid = await allocate_ssid(db)
     new_box = Box(
         type=box_type.lower(),
         ptah_profile=ptah_profile.lower(),
         main_unet_id=unet_id,
         mac=EUI(mac),
         unets=[
-            UnetProfile(
-                unet_id=unet_id,
-                network=UnetNetwork(
-                    wan_ipv4=available_ipv4,
-                    wan_ipv6=ipv6,
-                    ipv6_prefix=prefix,
-                    lan_ipv4=LanIpv4(address=IPv4Interface("192.168.1.1/24"), vlan=1),
-                ),
-                wifi=WifiDetails(
-                    ssid=await generate_unique_ssid(db), psk=generate_password()
-                ),
-                dhcp=Dhcp(
-                    dns_servers=DnsServers(
-                        ipv4=[IPv4Address("8.8.8.8"), IPv4Address("1.1.1.1")],
-                        ipv6=[
-                            IPv6Address("2001:4860:4860::8888"),
-                            IPv6Address("2606:4700:4700::1111"),
-                        ],
-                    )
-                ),
-                firewall=UnetFirewall(
-                    ipv4_port_forwarding=[],
-                    ipv6_port_opening=[],
-                ),
+            _build_unet_profile(
+                unet_id,
+                (available_ipv4, ipv6, prefix),
+                lan_vlan=1,
+                ssid=ssid,
             )
         ],
         wan_vlan=[ADH_TP_IPV4_WAN_VLAN, ADH_EXTE_IPV4_WAN_VLAN, ADH_IPV6_WAN_VLAN],
         ping_history=[],
     )
 
-    await db.boxes.insert_one(new_box.model_dump(mode="json"))
+    try:
+        await db.boxes.insert_one(new_box.model_dump(mode="json"))
+    except Exception:
+        await ipam.release_lease(unet_id, quarantine=False)
+        raise
+    finally:
+        await release_ssid_reservations(db, [ssid])
 
     await create_log(
         db,
@@ -111,6 +147,77 @@ async def register_box_for_new_ftth_adh(
     return new_box
 
 
+async def register_boxes_for_new_ftth_adhs(
+    db: AsyncIOMotorDatabase,
+    requests: list[Tuple[str, str, str, bool]],
+) -> list[Box | None]:
+    """Register many new boxes at once, e.g. to onboard a batch of FTTH members.
+    Unet ids, addresses and SSIDs are allocated in batch, the boxes are inserted
+    with one bulk write and the IPAM logs are appended with another one.
+
+    Args:
+        * requests (list[Tuple[str, str, str, bool]]): the box type, ptah
+          profile, MAC address and telecom flag of each box
+
+    Returns the new boxes, in the same order as the requests, or None for the
+    boxes that could not be inserted (e.g. their MAC address already exists)."""
+    if not requests:
+        return []
+
+    ipam = MongoIpam(db)
+
+    unet_ids = await allocate_unet_ids(db, len(requests))
+    addresses = await ipam.lease_many_addresses(
+        [(telecom_ip, unet_id) for (*_, telecom_ip), unet_id in zip(requests, unet_ids)]
+    )
+    ssids = await allocate_ssids(db, len(requests))
+
+    new_boxes: list[Box | None] = [
+        Box(
+            type=box_type.lower(),
+            ptah_profile=ptah_profile.lower(),
+            main_unet_id=unet_id,
+            mac=EUI(mac),
+            unets=[_build_unet_profile(unet_id, unet_addresses, lan_vlan=1, ssid=ssid)],
+            wan_vlan=[ADH_TP_IPV4_WAN_VLAN, ADH_EXTE_IPV4_WAN_VLAN, ADH_IPV6_WAN_VLAN],
+            ping_history=[],
+        )
+        for (box_type, ptah_profile, mac, _), unet_id, unet_addresses, ssid in zip(
+            requests, unet_ids, addresses, ssids
+        )
+    ]
+
+    try:
+        await db.boxes.insert_many(
+            [box.model_dump(mode="json") for box in new_boxes if box], ordered=False
+        )
+    except BulkWriteError as e:
+        for error in e.details["writeErrors"]:
+            await ipam.release_lease(unet_ids[error["index"]], quarantine=False)
+            new_boxes[error["index"]] = None
+    except Exception:
+        for unet_id in unet_ids:
+            await ipam.release_lease(unet_id, quarantine=False)
+        raise
+    finally:
+        await release_ssid_reservations(db, ssids)
+
+    await create_logs(
+        db,
+        [
+            IpamLog(
+                timestamp=datetime.now(),
+                source="sadh-back",
+                message=f"{box.unets[0].network.wan_ipv4.ip} and {box.unets[0].network.wan_ipv6.ip}/{box.unets[0].network.ipv6_prefix} assigned to unet {box.main_unet_id} on box {box.mac}",
+            )
+            for box in new_boxes
+            if box
+        ],
+    )
+
+    return new_boxes
+
+
 async def update_ptah_profile_on_box(
     db: AsyncIOMotorDatabase, box: Box, new_ptah_profile: str
 ) -> Box:
@@ -127,7 +234,7 @@ async def update_ptah_profile_on_box(
 
 
 async def get_box_by_ssid(db: AsyncIOMotorDatabase, ssid: str) -> Box | None:
-    box_dict = await db.boxes.find_one({"unets.wifi.ssid": ssid})
+    box_dict = await db.boxes.find_one({"unets.wifi.ssid": ssid}, WITHOUT_PING_HISTORY)
     if box_dict is None:
         return None
 
@@ -141,46 +248,30 @@ async def register_unet_on_box(
 ) -> UnetProfile:
     ipam = MongoIpam(db)
 
-    available_ipv4 = await ipam.get_available_ipv4(telecom_ip)
-    ipv6, prefix = ipam.compute_ipv6_and_prefix(available_ipv4.ip.ip, telecom_ip)
-
-    unet_id = await _generate_unique_unet_id(db)
+    unet_id = await allocate_unet_id(db)
+    available_ipv4, ipv6, prefix = await ipam.lease_addresses(telecom_ip, unet_id)
 
     # To be sure not to have a duplicate local network in the box,
     # We take the highest vlan number and add 1
     highest_lan = max([unet.network.lan_ipv4.vlan for unet in box.unets])
 
-    new_profile = UnetProfile(
-        unet_id=unet_id,
-        network=UnetNetwork(
-            wan_ipv4=available_ipv4,
-            wan_ipv6=ipv6,
-            ipv6_prefix=prefix,
-            lan_ipv4=LanIpv4(
-                address=IPv4Interface(f"192.168.{highest_lan+1}.1/24"),
-                vlan=highest_lan + 1,
-            ),
-        ),
-        wifi=WifiDetails(ssid=await generate_unique_ssid(db), psk=generate_password()),
-        dhcp=Dhcp(
-            dns_servers=DnsServers(
-                ipv4=[IPv4Address("8.8.8.8"), IPv4Address("1.1.1.1")],
-                ipv6=[
-                    IPv6Address("2001:4860:4860::8888"),
-                    IPv6Address("2606:4700:4700::1111"),
-                ],
-            )
-        ),
-        firewall=UnetFirewall(
-            ipv4_port_forwarding=[],
-            ipv6_port_opening=[],
-        ),
+    new_profile = _build_unet_profile(
+        unet_id,
+        (available_ipv4, ipv6, prefix),
+        lan_vlan=highest_lan + 1,
+        ssid=await allocate_ssid(db),
     )
 
-    await db.boxes.update_one(
-        {"mac": str(box.mac)},
-        {"$push": {"unets": new_profile.model_dump(mode="json")}},
-    )
+    try:
+        result = await db.boxes.update_one(
+            {"mac": str(box.mac)},
+            {"$push": {"unets": new_profile.model_dump(mode="json")}},
+        )
+    finally:
+        await release_ssid_reservations(db, [new_profile.wifi.ssid])
+    if result.modified_count == 0:
+        await ipam.release_lease(unet_id, quarantine=False)
+        raise ValueError(f"Box with MAC address {box.mac} does not exist")
 
     await create_log(
         db,
@@ -194,31 +285,200 @@ async def register_unet_on_box(
     return new_profile
 
 
-async def get_box_from_user(db: AsyncIOMotorDatabase, user: User) -> Box | None:
+async def register_unets_on_boxes(
+    db: AsyncIOMotorDatabase,
+    requests: list[Tuple[Box, bool]],
+) -> list[UnetProfile]:
+    """Register many unets at once, e.g. for mass onboarding.
+    Addresses are leased in one pass, boxes are updated with one bulk write
+    and the IPAM logs are appended with another one.
+
+    Args:
+        * requests (list[Tuple[Box, bool]]): the box to add each unet to,
+          and whether its adherent gets a telecom IP
+
+    Returns the new unet profiles, in the same order as the requests.
+    Raises a ValueError, and registers nothing, if some of the boxes were
+    deleted meanwhile."""
+    if not requests:
+        return []
+
+    ipam = MongoIpam(db)
+
+    unet_ids = await allocate_unet_ids(db, len(requests))
+    addresses = await ipam.lease_many_addresses(
+        [(telecom_ip, unet_id) for (_, telecom_ip), unet_id in zip(requests, unet_ids)]
+    )
+
+    # Several unets can be added to the same box, give each its own LAN
+    highest_lans = {
+        str(box.mac): max(unet.network.lan_ipv4.vlan for unet in box.unets)
+        for box, _ in requests
+    }
+    ssids = await allocate_ssids(db, len(requests))
+    new_profiles = []
+    for (box, _), unet_id, unet_addresses, ssid in zip(
+        requests, unet_ids, addresses, ssids
+    ):
+        highest_lans[str(box.mac)] += 1
+        new_profiles.append(
+            _build_unet_profile(
+                unet_id, unet_addresses, lan_vlan=highest_lans[str(box.mac)], ssid=ssid
+            )
+        )
+
+    try:
+        result = await db.boxes.bulk_write(
+            [
+                UpdateOne(
+                    {"mac": str(box.mac)},
+                    {"$push": {"unets": new_profile.model_dump(mode="json")}},
+                )
+                for (box, _), new_profile in zip(requests, new_profiles)
+            ]
+        )
+    except BulkWriteError as e:
+        # The write is ordered: the unets before the failing one were added
+        for unet_id in unet_ids[e.details["writeErrors"][0]["index"] :]:
+            await ipam.release_lease(unet_id, quarantine=False)
+        raise
+    except Exception:
+        for unet_id in unet_ids:
+            await ipam.release_lease(unet_id, quarantine=False)
+        raise
+    finally:
+        await release_ssid_reservations(db, ssids)
+
+    if result.matched_count != len(requests):
+        # Some boxes were deleted since they were read: take the unets
+        # back from the others, so that nothing is registered
+        await db.boxes.update_many(
+            {"unets.unet_id": {"$in": unet_ids}},
+            {"$pull": {"unets": {"unet_id": {"$in": unet_ids}}}},
+        )
+        for unet_id in unet_ids:
+            await ipam.release_lease(unet_id, quarantine=False)
+        raise ValueError(
+            f"{len(requests) - result.matched_count} of the boxes no longer exist"
+        )
+
+    await create_logs(
+        db,
+        [
+            IpamLog(
+                timestamp=datetime.now(),
+                source="sadh-back",
+                message=f"{new_profile.network.wan_ipv4.ip} and {new_profile.network.wan_ipv6.ip}/{new_profile.network.ipv6_prefix} assigned to unet {new_profile.unet_id} on box {box.mac}",
+            )
+            for (box, _), new_profile in zip(requests, new_profiles)
+        ],
+    )
+
+    return new_profiles
+
+
+async def get_box_from_user(
+    db: AsyncIOMotorDatabase, user: User, loader: Loader | None = None
+) -> Box | None:
     if not user.membership or not user.membership.unetid:
         return None
 
+    if loader is not None:
+        return await loader.get_box_of_unet(user.membership.unetid)
+
     return Box.model_validate(
-        await db.boxes.find_one({"unets.unet_id": user.membership.unetid})
+        await db.boxes.find_one(
+            {"unets.unet_id": user.membership.unetid}, WITHOUT_PING_HISTORY
+        )
     )
 
 
-def generate_password() -> str:
-    default_words = xkcd_password.locate_wordfile()
-    word_list = xkcd_password.generate_wordlist(
-        wordfile=default_words, min_length=5, max_length=8, valid_chars="[^'\"]"
+def _version_filter(version: int) -> int | dict:
+    # Unets which were never updated through update_unet_settings have no version
+    return {"$in": [0, None]} if version == 0 else version
+
+
+async def get_unet_version(db: AsyncIOMotorDatabase, unet_id: str) -> int | None:
+    """The version of the settings of a unet (see update_unet_settings),
+    or None if no box holds the unet."""
+    box_dict = await db.boxes.find_one(
+        {"unets.unet_id": unet_id},
+        {"_id": 0, "unets": {"$elemMatch": {"unet_id": unet_id}}},
     )
-    raw_password = xkcd_password.generate_xkcdpassword(
-        word_list, numwords=4, delimiter="_"
+    if box_dict is None:
+        return None
+    return box_dict["unets"][0].get("version", 0)
+
+
+async def update_unet_settings(
+    db: AsyncIOMotorDatabase,
+    new_unet: UnetProfile,
+    version: int | None = None,
+) -> Tuple[UnetProfile, int] | None:
+    """Update the settings a member may change (Wi-Fi, firewall, DHCP) of a unet.
+
+    Only these fields of the targeted unet are written, so the other unets of
+    the box are left untouched. The update is guarded by the `version` of the
+    unet, which is incremented on every update: the members of the other unets
+    of the same box do not conflict with it.
+
+    Args:
+     * new_unet (UnetProfile): the unet with its new settings
+     * version (int | None): the version of the unet the new settings are
+       based on (see get_unet_version). If None, the current version is used,
+       and the update is retried if the unet changes in between.
+
+    Returns the updated unet and its new version, or None if no box holds the
+    unet. Raises UnetVersionConflict if the unet is not at the expected
+    version."""
+    unet_id = new_unet.unet_id
+    settings = new_unet.model_dump(
+        include=set(UNET_SETTINGS_FIELDS), exclude_unset=True, mode="json"
     )
 
-    if raw_password is None:
-        raise ValueError("Password generation failed")
+    for _ in range(BOX_UPDATE_ATTEMPTS):
+        expected = version
+        if expected is None:
+            expected = await get_unet_version(db, unet_id)
+            if expected is None:
+                return None
+
+        box_dict = await db.boxes.find_one_and_update(
+            {
+                "unets": {
+                    "$elemMatch": {
+                        "unet_id": unet_id,
+                        "version": _version_filter(expected),
+                    }
+                }
+            },
+            {
+                "$set": {
+                    f"unets.$.{field}": value for field, value in settings.items()
+                },
+                "$inc": {"unets.$.version": 1},
+            },
+            projection={"_id": 0, "unets": {"$elemMatch": {"unet_id": unet_id}}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if box_dict is not None:
+            unet_dict = box_dict["unets"][0]
+            return UnetProfile.model_validate(unet_dict), unet_dict["version"]
+
+        if version is not None:
+            break
+
+    if await db.boxes.count_documents({"unets.unet_id": unet_id}, limit=1) == 0:
+        return None
+    raise UnetVersionConflict(unet_id)
 
-    return raw_password
 
+async def get_users_on_box(
+    db: AsyncIOMotorDatabase, box: Box, loader: Loader | None = None
+) -> list[User]:
+    if loader is not None:
+        return await loader.get_users_on_unets([unet.unet_id for unet in box.unets])
 
-async def get_users_on_box(db: AsyncIOMotorDatabase, box: Box) -> list[User]:
     return [
         User.model_validate(user)
         for user in await db.users.find(
@@ -231,136 +491,67 @@ async def get_users_on_box(db: AsyncIOMotorDatabase, box: Box) -> list[User]:
     ]
 
 
-async def generate_unique_ssid(db: AsyncIOMotorDatabase) -> str:
-    """Get SSID that is not already assigned."""
-    ssids = [
-        "Rezel-Hydrogen",
-        "Rezel-Helium",
-        "Rezel-Lithium",
-        "Rezel-Beryllium",
-        "Rezel-Boron",
-        "Rezel-Carbon",
-        "Rezel-Nitrogen",
-        "Rezel-Oxygen",
-        "Rezel-Fluorine",
-        "Rezel-Neon",
-        "Rezel-Sodium",
-        "Rezel-Magnesium",
-        "Rezel-Aluminum",
-        "Rezel-Silicon",
-        "Rezel-Phosphorus",
-        "Rezel-Sulfur",
-        "Rezel-Chlorine",
-        "Rezel-Argon",
-        "Rezel-Potassium",
-        "Rezel-Calcium",
-        "Rezel-Scandium",
-        "Rezel-Titanium",
-        "Rezel-Vanadium",
-        "Rezel-Chromium",
-        "Rezel-Manganese",
-        "Rezel-Iron",
-        "Rezel-Cobalt",
-        "Rezel-Nickel",
-        "Rezel-Copper",
-        "Rezel-Zinc",
-        "Rezel-Gallium",
-        "Rezel-Germanium",
-        "Rezel-Arsenic",
-        "Rezel-Selenium",
-        "Rezel-Bromine",
-        "Rezel-Krypton",
-        "Rezel-Rubidium",
-        "Rezel-Strontium",
-        "Rezel-Yttrium",
-        "Rezel-Zirconium",
-        "Rezel-Niobium",
-        "Rezel-Molybdenum",
-        "Rezel-Technetium",
-        "Rezel-Ruthenium",
-        "Rezel-Rhodium",
-        "Rezel-Palladium",
-        "Rezel-Silver",
-        "Rezel-Cadmium",
-        "Rezel-Indium",
-        "Rezel-Tin",
-        "Rezel-Antimony",
-        "Rezel-Tellurium",
-        "Rezel-Iodine",
-        "Rezel-Xenon",
-        "Rezel-Cesium",
-        "Rezel-Barium",
-        "Rezel-Lanthanum",
-        "Rezel-Cerium",
-        "Rezel-Praseodymium",
-        "Rezel-Neodymium",
-        "Rezel-Promethium",
-        "Rezel-Samarium",
-        "Rezel-Europium",
-        "Rezel-Gadolinium",
-        "Rezel-Terbium",
-        "Rezel-Dysprosium",
-        "Rezel-Holmium",
-        "Rezel-Erbium",
-        "Rezel-Thulium",
-        "Rezel-Ytterbium",
-        "Rezel-Lutetium",
-        "Rezel-Hafnium",
-        "Rezel-Tantalum",
-        "Rezel-Tungsten",
-        "Rezel-Rhenium",
-        "Rezel-Osmium",
-        "Rezel-Iridium",
-        "Rezel-Platinum",
-        "Rezel-Gold",
-        "Rezel-Mercury",
-        "Rezel-Thallium",
-        "Rezel-Lead",
-        "Rezel-Bismuth",
-        "Rezel-Polonium",
-        "Rezel-Astatine",
-        "Rezel-Radon",
-        "Rezel-Francium",
-        "Rezel-Radium",
-        "Rezel-Actinium",
-        "Rezel-Thorium",
-        "Rezel-Protactinium",
-        "Rezel-Uranium",
-        "Rezel-Neptunium",
-        "Rezel-Plutonium",
-        "Rezel-Americium",
-        "Rezel-Curium",
-        "Rezel-Berkelium",
-        "Rezel-Californium",
-        "Rezel-Einsteinium",
-        "Rezel-Fermium",
-        "Rezel-Mendelevium",
-        "Rezel-Nobelium",
-        "Rezel-Lawrencium",
-        "Rezel-Rutherfordium",
-        "Rezel-Dubnium",
-        "Rezel-Seaborgium",
-        "Rezel-Bohrium",
-        "Rezel-Hassium",
-        "Rezel-Meitnerium",
-        "Rezel-Darmstadtium",
-        "Rezel-Roentgenium",
-        "Rezel-Copernicium",
-        "Rezel-Nihonium",
-        "Rezel-Flerovium",
-        "Rezel-Moscovium",
-        "Rezel-Livermorium",
-        "Rezel-Tennessine",
-        "Rezel-Oganesson",
+def _enriched_boxes_pipeline(query: dict, skip: int, limit: int) -> list[dict]:
+    return [
+        {"$match": query},
+        # Paginate first, so that the lookups only run for the returned boxes
+        {"$sort": {"_id": 1}},
+        {"$skip": skip},
+        {"$limit": limit},
+        {"$project": {"ping_history": 0}},
+        {
+            "$lookup": {
+                "from": "users",
+                "localField": "unets.unet_id",
+                "foreignField": "membership.unetid",
+                "as": "users",
+            }
+        },
+        {
+            "$lookup": {
+                "from": "pms",
+                "localField": "mac",
+                "foreignField": "pon_list.ont_list.box_mac_address",
+                "let": {"mac": "$mac"},
+                "pipeline": [
+                    {"$unwind": "$pon_list"},
+                    {"$unwind": "$pon_list.ont_list"},
+                    {
+                        "$match": {
+                            "$expr": {
+                                "$eq": ["$pon_list.ont_list.box_mac_address", "$$mac"]
+                            }
+                        }
+                    },
+                    {"$replaceWith": "$pon_list.ont_list"},
+                ],
+                "as": "onts",
+            }
+        },
     ]
 
-    random_ssid = None
-
-    while random_ssid is None and ssids:
-        random_ssid = random.choice(ssids)
-        if await db.boxes.find_one({"unets.wifi.ssid": random_ssid}):
-            random_ssid = None
 
-    if random_ssid is None:
-        random_ssid = "Rezel-" + str(datetime.now().timestamp())
-    return random_ssid
+async def get_enriched_boxes(
+    db: AsyncIOMotorDatabase,
+    query: dict | None = None,
+    skip: int = 0,
+    limit: int = ENRICHED_BOXES_LIMIT,
+) -> list[EnrichedBox]:
+    """Get the boxes matching the query along with their users and ONT,
+    with a single aggregation instead of one query per box.
+
+    Args:
+     * query (dict | None): filter of the boxes
+     * skip (int), limit (int): the page of boxes to return, in insertion
+       order"""
+    return [
+        EnrichedBox(
+            box=Box.model_validate({**box, "ping_history": []}),
+            users=[User.model_validate(user) for user in box["users"]],
+            ont=ONT.model_validate(box["onts"][0]) if box["onts"] else None,
+            unet_count=len(box["unets"]),
+        )
+        async for box in db.boxes.aggregate(
+            _enriched_boxes_pipeline(query or {}, skip, limit)
+        )
+    ]
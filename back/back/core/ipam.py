@@ -6,53 +6,357 @@ and retrieve available IP ranges and addresses.
 
 """
 
-from ipaddress import IPv4Address, IPv4Interface, IPv6Interface, IPv6Network
+import logging
+from datetime import datetime, timedelta
+from ipaddress import (
+    IPv4Address,
+    IPv4Interface,
+    IPv4Network,
+    IPv6Interface,
+    IPv6Network,
+    ip_network,
+)
 from typing import Tuple
 
 from common_models.hermes_models import Box, WanIpv4, WanIpv6
 from common_models.ipam_models import IPAMNetworks
+from common_models.user_models import User
 from motor.motor_asyncio import AsyncIOMotorDatabase
 
+from back.core.ipam_config import (
+    IPAMConfig,
+    derive_ipv6_objects,
+    get_ipam_config,
+    prefix_of_ipv6,
+)
+from back.core.ipam_index import (
+    claim_first_free_ipv4,
+    claim_free_ipv4s,
+    get_ipv4_index_usage,
+    mark_ipv4_free,
+    pop_quarantined_ipv4,
+    pop_quarantined_ipv4s,
+    quarantine_ipv4,
+    rebuild_ipv4_index,
+)
+from back.core.ipam_leases import (
+    claim_lease,
+    claim_leases,
+    find_lease,
+    get_released_leases,
+    release_lease,
+    sync_leases,
+)
+from back.core.ipam_usage import UnetAddressing, get_unet_addressing
+from back.env import ENV
+from back.mongodb.db import WITHOUT_PING_HISTORY
+from back.mongodb.ipam_com_models import IPAMLookup, IPAMUsage, IPv4UsageTotals
+
+logger = logging.getLogger(__name__)
+
+# Attempts at leasing addresses before giving up, the allocation index being
+# out of date with the leases (see lease_addresses)
+LEASE_ATTEMPTS = 5
+
 
 class MongoIpam:
     """Provides functions to interact with the MongoDB databases
     and retrieve available IP ranges and addresses, namely
 
-    - get_available_ipv4: returns an available IPv4 address"""
+    - lease_addresses: leases an IPv4 address and its IPv6 prefix to a unet
+    - lease_many_addresses: same as lease_addresses, for many unets at once
+    - release_lease: releases the addresses leased to a unet
+    - get_available_ipv4: reserves and returns an available IPv4 address
+    - get_available_ipv4s: same as get_available_ipv4, for many addresses at once
+    - release_ipv4: gives an IPv4 address back to the pool right away
+    - rebuild_index: recomputes the allocation index and leases from the boxes
+    - get_usage: returns the usage of the IPv4 networks
+    - lookup: finds the unet, box and user an address is leased to"""
 
     def __init__(self, db: AsyncIOMotorDatabase):
         """Initializes the MongoDB client and the database."""
         self.db = db
 
+    async def lease_addresses(
+        self, from_telecom: bool, unet_id: str
+    ) -> Tuple[WanIpv4, WanIpv6, IPv6Network]:
+        """Leases an available IPv4 address, and the IPv6 derived from it, to a unet.
+        Safe to call concurrently: an address is never leased twice.
+
+        Args:
+            * from_telecom (bool): whether the adherent is from telecom or not
+            * unet_id (str): the unet the addresses are leased to"""
+        for _ in range(LEASE_ATTEMPTS):
+            ipv4 = await self.get_available_ipv4(from_telecom)
+            ipv6, prefix = self.compute_ipv6_and_prefix(ipv4.ip.ip, from_telecom)
+            try:
+                claimed = await claim_lease(self.db, ipv4.ip.ip, prefix, unet_id)
+            except BaseException:
+                await self.release_ipv4(ipv4.ip.ip)
+                raise
+            if claimed:
+                return ipv4, ipv6, prefix
+            # The index was out of date and the address is still leased:
+            # keep it marked as used and try the next one
+
+        raise ValueError(
+            f"Could not lease addresses to unet {unet_id} after {LEASE_ATTEMPTS} attempts"
+        )
+
+    async def lease_many_addresses(
+        self, requests: list[Tuple[bool, str]]
+    ) -> list[Tuple[WanIpv4, WanIpv6, IPv6Network]]:
+        """Leases addresses to many unets in one pass: the addresses are
+        reserved with one update per network and leased with one bulk write.
+        Either every unet gets its addresses, or nothing is leased: a
+        ValueError is raised if the addresses run out, and the leases claimed
+        so far are also given back if anything else interrupts the leasing.
+
+        Args:
+            * requests (list[Tuple[bool, str]]): (from_telecom, unet_id) of each unet
+
+        Returns the addresses, in the same order as the requests."""
+        results: list[Tuple[WanIpv4, WanIpv6, IPv6Network] | None] = [None] * len(
+            requests
+        )
+        # Addresses reserved in the index but not leased yet
+        reserved: list[IPv4Address] = []
+
+        try:
+            for _ in range(LEASE_ATTEMPTS):
+                pending = [i for i, result in enumerate(results) if not result]
+                if not pending:
+                    break
+                for from_telecom in (True, False):
+                    indexes = [i for i in pending if requests[i][0] == from_telecom]
+                    if not indexes:
+                        continue
+
+                    ipv4s = await self.get_available_ipv4s(from_telecom, len(indexes))
+                    reserved = [ipv4.ip.ip for ipv4 in ipv4s]
+                    candidates = [
+                        (ipv4, *self.compute_ipv6_and_prefix(ipv4.ip.ip, from_telecom))
+                        for ipv4 in ipv4s
+                    ]
+                    claimed = await claim_leases(
+                        self.db,
+                        [
+                            (ipv4.ip.ip, prefix, requests[i][1])
+                            for i, (ipv4, _, prefix) in zip(indexes, candidates)
+                        ],
+                    )
+                    reserved = []
+                    # Addresses that were still leased stay marked as used,
+                    # the corresponding unets get another one on the next pass
+                    for i, candidate, ok in zip(indexes, candidates, claimed):
+                        if ok:
+                            results[i] = candidate
+            if not all(results):
+                raise ValueError(
+                    f"Could not lease addresses to {results.count(None)} unets "
+                    f"after {LEASE_ATTEMPTS} attempts"
+                )
+        except BaseException:
+            # Whatever interrupted the leasing (no address left, database
+            # error, cancellation), give back what was taken so far
+            for _, unet_id in requests:
+                ipv4_addr = await release_lease(self.db, unet_id)
+                if ipv4_addr is not None:
+                    await self.release_ipv4(ipv4_addr)
+                    if ipv4_addr in reserved:
+                        reserved.remove(ipv4_addr)
+            for ipv4_addr in reserved:
+                await self.release_ipv4(ipv4_addr)
+            raise
+
+        return [result for result in results if result]
+
+    async def release_lease(self, unet_id: str, quarantine: bool = True) -> None:
+        """Releases the addresses leased to a unet, once it has been deleted.
+        The IPv4 address is only given back to the pool after the quarantine
+        period (ENV.ipam_quarantine_days), as it may still be in caches and
+        abuse databases.
+
+        Args:
+            * unet_id (str): the deleted unet
+            * quarantine (bool): False if the addresses were never used,
+              e.g. the unet could not be created"""
+        ipv4_addr = await release_lease(self.db, unet_id)
+        if ipv4_addr is None:
+            return
+        if quarantine and ENV.ipam_quarantine_days > 0:
+            await quarantine_ipv4(self.db, ipv4_addr, datetime.now())
+        else:
+            await self.release_ipv4(ipv4_addr)
+
     async def get_available_ipv4(self, from_telecom: bool) -> WanIpv4:
-        """Returns an available IPv4 address from the database.
+        """Reserves an available IPv4 address in the allocation index and returns it.
+        The address must be given back with release_ipv4 if it ends up unused.
 
         Args:
             * from_telecom (bool): whether the adherent is from telecom or not
         """
-        all_ipv4_nets = (await self.__get_all_networks()).ipv4_networks
-        ipv4_nets = [net for net in all_ipv4_nets if net.from_telecom == from_telecom]
-
-        # Get the used IPs
-        used_ips = await self.__get_all_used_ip_addresses()
-        used_ipv4 = [
-            unet_profile.network.wan_ipv4.ip.ip
-            for box in used_ips
-            for unet_profile in box.unets
-        ]
-
-        # Find the first available IP
-        for ipv4network in ipv4_nets:
+        config = await self.__get_indexed_config()
+        quarantine_end = datetime.now() - timedelta(days=ENV.ipam_quarantine_days)
+
+        # Take an address out of quarantine first, then the first available IP
+        for ipv4network in config.networks_by_flag[from_telecom]:
             network = ipv4network.network
-            for ip in network.hosts():
-                if ip not in used_ipv4:
-                    return WanIpv4(
-                        ip=IPv4Interface(f"{ip}/{network.prefixlen}"),
-                        vlan=ipv4network.vlan,
-                    )
+            ip = await pop_quarantined_ipv4(self.db, network, quarantine_end)
+            if ip is None:
+                ip = await claim_first_free_ipv4(self.db, network)
+            if ip is not None:
+                return WanIpv4(
+                    ip=IPv4Interface(f"{ip}/{network.prefixlen}"),
+                    vlan=ipv4network.vlan,
+                )
 
         raise ValueError("No available IPv4 address found.")
 
+    async def get_available_ipv4s(
+        self, from_telecom: bool, count: int
+    ) -> list[WanIpv4]:
+        """Reserves `count` available IPv4 addresses in the allocation index, and
+        returns them. As in get_available_ipv4, the addresses out of quarantine
+        are taken first, then the free ones, with a single update for each per
+        network. If there are not enough available addresses, nothing is
+        reserved and a ValueError is raised.
+
+        Args:
+            * from_telecom (bool): whether the adherents are from telecom or not
+            * count (int): the number of addresses to reserve
+        """
+        config = await self.__get_indexed_config()
+        quarantine_end = datetime.now() - timedelta(days=ENV.ipam_quarantine_days)
+
+        addresses: list[WanIpv4] = []
+        for ipv4network in config.networks_by_flag[from_telecom]:
+            if len(addresses) == count:
+                break
+            network = ipv4network.network
+            ips = await pop_quarantined_ipv4s(
+                self.db, network, quarantine_end, count - len(addresses)
+            )
+            if len(addresses) + len(ips) < count:
+                ips += await claim_free_ipv4s(
+                    self.db, network, count - len(addresses) - len(ips)
+                )
+            addresses += [
+                WanIpv4(
+                    ip=IPv4Interface(f"{ip}/{network.prefixlen}"),
+                    vlan=ipv4network.vlan,
+                )
+                for ip in ips
+            ]
+
+        if len(addresses) < count:
+            for address in addresses:
+                await self.release_ipv4(address.ip.ip)
+            raise ValueError(
+                f"Not enough available IPv4 addresses ({len(addresses)} < {count})."
+            )
+
+        return addresses
+
+    async def __get_indexed_config(self) -> IPAMConfig:
+        """Returns the IPAM configuration, after making sure
+        the allocation index covers every configured network."""
+        config = await get_ipam_config(self.db)
+
+        # Index is missing a configured network (first start or new range)
+        if not config.index_checked:
+            if await self.db.ipam_index.count_documents(
+                {"_id": {"$in": config.network_ids}}
+            ) != len(config.network_ids):
+                await self.rebuild_index()
+            config.index_checked = True
+
+        return config
+
+    async def release_ipv4(self, ipv4_addr: IPv4Address) -> None:
+        """Gives an IPv4 address back to the pool, once no unet uses it anymore.
+
+        Args:
+            * ipv4_addr (IPv4Address): the address to release"""
+        await mark_ipv4_free(self.db, ipv4_addr)
+
+    async def rebuild_index(self) -> None:
+        """Recomputes the allocation index and the leases
+        from the addresses used by the boxes."""
+        unets = await self.__get_all_used_ip_addresses()
+        await sync_leases(
+            self.db,
+            (
+                (unet.ipv4_address, IPv6Network(unet.ipv6_prefix), unet.unet_id)
+                for unet in unets
+            ),
+        )
+        await rebuild_ipv4_index(
+            self.db,
+            await self.__get_all_networks(),
+            (unet.ipv4_address for unet in unets),
+            await get_released_leases(
+                self.db, datetime.now() - timedelta(days=ENV.ipam_quarantine_days)
+            ),
+        )
+
+    async def get_usage(self) -> IPAMUsage:
+        """Returns how full each IPv4 network is, and the totals for telecom
+        and non-telecom adherents. Only the allocation index is read."""
+        await self.__get_indexed_config()
+        networks = await get_ipv4_index_usage(self.db)
+
+        def totals(from_telecom: bool) -> IPv4UsageTotals:
+            selected = [net for net in networks if net.from_telecom == from_telecom]
+            return IPv4UsageTotals(
+                size=sum(net.size for net in selected),
+                reserved=sum(net.reserved for net in selected),
+                used=sum(net.used for net in selected),
+                quarantined=sum(net.quarantined for net in selected),
+                free=sum(net.free for net in selected),
+                largest_free_block=max(
+                    (net.largest_free_block for net in selected), default=0
+                ),
+            )
+
+        return IPAMUsage(
+            networks=networks, telecom=totals(True), non_telecom=totals(False)
+        )
+
+    async def lookup(self, address: str) -> IPAMLookup | None:
+        """Finds the unet, box and user an address is leased to,
+        using indexed reads only (see back.mongodb.indexes).
+
+        Args:
+            * address (str): an IPv4 address, an IPv6 address
+              or an IPv6 prefix (e.g. 2a09:6847:1234::/48)
+
+        Raises a ValueError if the address is not valid."""
+        parsed = ip_network(address, strict=False)
+        if isinstance(parsed, IPv4Network):
+            lease = await find_lease(self.db, parsed.network_address)
+        else:
+            prefix = prefix_of_ipv6(parsed.network_address)
+            lease = prefix and await find_lease(self.db, prefix)
+        if lease is None:
+            return None
+
+        box = user = None
+        if lease["unet_id"] is not None:
+            box = await self.db.boxes.find_one(
+                {"unets.unet_id": lease["unet_id"]}, WITHOUT_PING_HISTORY
+            )
+            user = await self.db.users.find_one({"membership.unetid": lease["unet_id"]})
+
+        return IPAMLookup(
+            ipv4=IPv4Address(lease["_id"]),
+            ipv6_prefix=IPv6Network(lease["ipv6_prefix"]),
+            unet_id=lease["unet_id"],
+            released_at=lease.get("released_at"),
+            box=Box.model_validate(box) if box else None,
+            user=User.model_validate(user) if user else None,
+        )
+
     def compute_ipv6_and_prefix(
         self, ipv4_addr: IPv4Address, from_telecom: bool
     ) -> Tuple[WanIpv6, IPv6Network]:
@@ -62,32 +366,22 @@ class MongoIpam:
         Args:
             * ipv4_addr (IPAddress): the (public) IPv4 address of the adherent
             * from_telecom (bool): whether the adherent is from telecom or not"""
-        if from_telecom:
-            [_, _, x, y] = str(ipv4_addr).split(".")
-            prefix = f"2a09:6847:{int(x):02x}{int(y):02x}::/48"
-            public_ip = f"2a09:6847:ffff::{int(x):02x}{int(y):02x}/64"
-        else:
-            [_, _, _, z] = str(ipv4_addr).split(".")
-            prefix = f"2a09:6847:4{int(z):02x}::/48"
-            public_ip = f"2a09:6847:ffff::4{int(z):02x}/64"
-        return WanIpv6(ip=IPv6Interface(public_ip), vlan=103), IPv6Network(prefix)
+        public_ip, prefix = derive_ipv6_objects(ipv4_addr, from_telecom)
+        return WanIpv6(ip=IPv6Interface((public_ip, 64)), vlan=103), prefix
 
-    async def __get_all_used_ip_addresses(self) -> list[Box]:
-        """Retrieve all the boxes from the database
+    async def __get_all_used_ip_addresses(self) -> list[UnetAddressing]:
+        """Retrieve the addressing of every unet of every box
         (only the fields related to IP addresses are queried)"""
-        response = self.db.boxes.find({})
-        if response is None:
-            raise ValueError(
-                "No IP addresses found in the database. This is highly unusual. Check the database."
-            )
-
-        return [Box.model_validate(elt) async for elt in response]
+        return await get_unet_addressing(self.db)
 
     async def __get_all_networks(self) -> IPAMNetworks:
-        """Returns all the IP ranges from the database."""
-        response = await self.db.ipam.find_one()
-        if response is None:
-            raise ValueError("No IP ranges found in the database.")
-        del response["_id"]
-        networks = IPAMNetworks.model_validate(response)
-        return networks
+        """Returns all the IP ranges (cached, see ipam_config)."""
+        return (await get_ipam_config(self.db)).networks
+
+
+async def init_ipam(db: AsyncIOMotorDatabase) -> None:
+    """Resynchronises the allocation index and leases with the boxes, run at startup."""
+    try:
+        await MongoIpam(db).rebuild_index()
+    except ValueError as e:
+        logger.warning("Could not build the IPAM allocation index: %s", e)
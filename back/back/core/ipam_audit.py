@@ -0,0 +1,210 @@
+"""
+Consistency auditor of the addresses assigned to the unets.
+
+The boxes are streamed through aggregation pipelines (with a server-side
+cursor and `allowDiskUse`), so that the audit runs in bounded memory and can
+be scheduled nightly without loading every `Box`. It reports:
+
+- WAN IPv4 addresses or IPv6 prefixes assigned to more than one unet
+- IPv6 prefixes that do not follow the rules of `compute_ipv6_and_prefix`
+- WAN IPv4 addresses outside of every configured network
+- unets that no user is attached to
+"""
+
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+from ipaddress import IPv4Address, IPv6Network
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from back.core.ipam_config import derive_ipv6, get_ipam_config
+from back.messaging.matrix import send_matrix_message
+from back.mongodb.ipam_com_models import IPAMAuditIssue, IPAMAuditReport
+
+logger = logging.getLogger(__name__)
+
+RUN_HOUR = 4
+MAX_REPORTED_ISSUES = 1000  # the counts are always complete
+CURSOR_BATCH_SIZE = 500
+
+DUPLICATE_IPV4 = "duplicate_ipv4"
+DUPLICATE_IPV6_PREFIX = "duplicate_ipv6_prefix"
+IPV6_RULE_MISMATCH = "ipv6_rule_mismatch"
+OUTSIDE_NETWORKS = "outside_networks"
+NO_USER = "no_user"
+
+UNETS_PIPELINE = [
+    {
+        "$project": {
+            "_id": 0,
+            "mac": 1,
+            "unets.unet_id": 1,
+            "unets.network.wan_ipv4.ip": 1,
+            "unets.network.ipv6_prefix": 1,
+        }
+    },
+    {"$unwind": "$unets"},
+    {
+        "$lookup": {
+            "from": "users",
+            "localField": "unets.unet_id",
+            "foreignField": "membership.unetid",
+            "pipeline": [{"$project": {"_id": 1}}, {"$limit": 1}],
+            "as": "users",
+        }
+    },
+    {
+        "$project": {
+            "mac": 1,
+            "unet_id": "$unets.unet_id",
+            "ipv4": {
+                "$arrayElemAt": [{"$split": ["$unets.network.wan_ipv4.ip", "/"]}, 0]
+            },
+            "ipv6_prefix": "$unets.network.ipv6_prefix",
+            "has_user": {"$gt": [{"$size": "$users"}, 0]},
+        }
+    },
+]
+
+
+def _duplicates_pipeline(field: dict | str) -> list[dict]:
+    """Group the unets by the given field and keep the groups of more than one."""
+    return [
+        {"$unwind": "$unets"},
+        {
+            "$group": {
+                "_id": field,
+                "unets": {"$push": {"unet_id": "$unets.unet_id", "mac": "$mac"}},
+                "count": {"$sum": 1},
+            }
+        },
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+
+
+class _Report:
+    def __init__(self) -> None:
+        self.started_at = datetime.now()
+        self.unets_checked = 0
+        self.counts: Counter[str] = Counter()
+        self.issues: list[IPAMAuditIssue] = []
+
+    def add(self, kind: str, detail: str, unet_id=None, box_mac=None) -> None:
+        self.counts[kind] += 1
+        if len(self.issues) < MAX_REPORTED_ISSUES:
+            self.issues.append(
+                IPAMAuditIssue(
+                    kind=kind, detail=detail, unet_id=unet_id, box_mac=box_mac
+                )
+            )
+
+    def build(self) -> IPAMAuditReport:
+        return IPAMAuditReport(
+            started_at=self.started_at,
+            finished_at=datetime.now(),
+            unets_checked=self.unets_checked,
+            issue_counts=dict(self.counts),
+            issues=self.issues,
+            truncated=sum(self.counts.values()) > len(self.issues),
+        )
+
+
+async def run_ipam_audit(db: AsyncIOMotorDatabase) -> IPAMAuditReport:
+    """Audit every unet and store the report in the `ipam_audits` collection."""
+    config = await get_ipam_config(db)
+    report = _Report()
+
+    async for unet in db.boxes.aggregate(
+        UNETS_PIPELINE, allowDiskUse=True, batchSize=CURSOR_BATCH_SIZE
+    ):
+        report.unets_checked += 1
+        unet_id, mac = unet["unet_id"], unet["mac"]
+
+        if not unet["has_user"]:
+            report.add(NO_USER, "No user is attached to this unet", unet_id, mac)
+
+        ipv4 = IPv4Address(unet["ipv4"])
+        network = config.network_of(ipv4)
+        if network is None:
+            report.add(
+                OUTSIDE_NETWORKS,
+                f"{ipv4} is not in any configured network",
+                unet_id,
+                mac,
+            )
+            continue
+
+        _, expected_prefix = derive_ipv6(int(ipv4), network.from_telecom)
+        if IPv6Network(unet["ipv6_prefix"]) != IPv6Network((expected_prefix, 48)):
+            report.add(
+                IPV6_RULE_MISMATCH,
+                f"{unet['ipv6_prefix']} should be {IPv6Network((expected_prefix, 48))} for {ipv4}",
+                unet_id,
+                mac,
+            )
+
+    for kind, field in (
+        (
+            DUPLICATE_IPV4,
+            {"$arrayElemAt": [{"$split": ["$unets.network.wan_ipv4.ip", "/"]}, 0]},
+        ),
+        (DUPLICATE_IPV6_PREFIX, "$unets.network.ipv6_prefix"),
+    ):
+        async for group in db.boxes.aggregate(
+            _duplicates_pipeline(field),
+            allowDiskUse=True,
+            batchSize=CURSOR_BATCH_SIZE,
+        ):
+            for unet in group["unets"]:
+                report.add(
+                    kind,
+                    f"{group['_id']} is assigned to {group['count']} unets",
+                    unet["unet_id"],
+                    unet["mac"],
+                )
+
+    result = report.build()
+    await db.ipam_audits.insert_one(result.model_dump())
+    logger.info(
+        "ipam_audit: %d unets checked, issues: %s",
+        result.unets_checked,
+        result.issue_counts,
+    )
+    return result
+
+
+async def get_last_ipam_audit(db: AsyncIOMotorDatabase) -> IPAMAuditReport | None:
+    report = await db.ipam_audits.find_one(sort=[("started_at", -1)])
+    return IPAMAuditReport.model_validate(report) if report else None
+
+
+def _seconds_until_next_run() -> int:
+    now = datetime.now()
+    target = now.replace(hour=RUN_HOUR, minute=0, second=0, microsecond=0)
+    if target <= now:
+        target += timedelta(days=1)
+    return int((target - now).total_seconds())
+
+
+async def ipam_audit_loop(db: AsyncIOMotorDatabase) -> None:
+    logger.info("ipam_audit loop started (daily at %02d:00)", RUN_HOUR)
+    while True:
+        await asyncio.sleep(_seconds_until_next_run())
+        try:
+            report = await run_ipam_audit(db)
+            if report.issue_counts:
+                send_matrix_message(
+                    "⚠️ ipam_audit : incohérences détectées",
+                    "```",
+                    *(
+                        f"{kind}: {count}"
+                        for kind, count in report.issue_counts.items()
+                    ),
+                    "```",
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("ipam_audit loop: unexpected error: %s", e)
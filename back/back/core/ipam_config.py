@@ -0,0 +1,149 @@
+"""
+Process-level cache of the IPAM configuration.
+
+The `ipam` collection holds static configuration (the IPv4 networks and
+whether they are for telecom adherents). It is parsed once and kept in memory
+along with values derived from it, and invalidated by a change stream on the
+collection. When change streams are not available (standalone MongoDB), the
+cache expires after CACHE_TTL instead.
+"""
+
+import asyncio
+import logging
+import time
+from bisect import bisect_right
+from functools import lru_cache
+from ipaddress import IPv4Address, IPv6Address, IPv6Network
+from typing import Tuple
+
+from common_models.ipam_models import IPAMNetworks
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL = 60  # seconds, only used when change streams are not available
+
+IPV6_BASE = 0x2A096847 << 96  # 2a09:6847::/32
+IPV6_WAN_BASE = 0x2A096847FFFF << 80  # 2a09:6847:ffff::/48
+
+
+class IPAMConfig:
+    """Parsed IPAM configuration and the values derived from it."""
+
+    def __init__(self, networks: IPAMNetworks) -> None:
+        self.networks = networks
+        self.networks_by_flag = {
+            from_telecom: [
+                net
+                for net in networks.ipv4_networks
+                if net.from_telecom == from_telecom
+            ]
+            for from_telecom in (True, False)
+        }
+        self.network_ids = [str(net.network) for net in networks.ipv4_networks]
+
+        # (first address, last address, network config), sorted for bisection
+        self.ranges = sorted(
+            (
+                (int(net.network.network_address), int(net.network.broadcast_address))
+                + (net,)
+                for net in networks.ipv4_networks
+            ),
+            key=lambda r: r[0],
+        )
+        self._starts = [r[0] for r in self.ranges]
+
+        self.loaded_at = time.monotonic()
+        # Set once the allocation index is known to cover every network
+        self.index_checked = False
+
+    def network_of(self, ipv4_addr: IPv4Address):
+        """Return the configured network containing an address, or None."""
+        position = bisect_right(self._starts, int(ipv4_addr)) - 1
+        if position < 0:
+            return None
+        first, last, net = self.ranges[position]
+        return net if first <= int(ipv4_addr) <= last else None
+
+
+_cache: IPAMConfig | None = None
+_watching = False
+
+
+def invalidate_ipam_config() -> None:
+    global _cache
+    _cache = None
+
+
+async def get_ipam_config(db: AsyncIOMotorDatabase) -> IPAMConfig:
+    """Return the IPAM configuration, reading it from the database only if needed."""
+    global _cache
+    cached = _cache
+    if cached is not None and (
+        _watching or time.monotonic() - cached.loaded_at < CACHE_TTL
+    ):
+        return cached
+
+    response = await db.ipam.find_one()
+    if response is None:
+        raise ValueError("No IP ranges found in the database.")
+    del response["_id"]
+
+    _cache = IPAMConfig(IPAMNetworks.model_validate(response))
+    return _cache
+
+
+async def watch_ipam_config(db: AsyncIOMotorDatabase) -> None:
+    """Invalidate the cache whenever the `ipam` collection changes.
+    Meant to run as a background task for the whole life of the app."""
+    global _watching
+    while True:
+        try:
+            async with db.ipam.watch() as stream:
+                _watching = True
+                # Changes made before the stream was opened are not seen
+                invalidate_ipam_config()
+                async for _ in stream:
+                    invalidate_ipam_config()
+        except OperationFailure as e:
+            # Change streams need a replica set, fall back on the TTL
+            logger.info("IPAM config change stream unavailable (%s)", e)
+            _watching = False
+            return
+        except PyMongoError as e:
+            logger.warning("IPAM config change stream interrupted: %s", e)
+        finally:
+            _watching = False
+        await asyncio.sleep(5)
+
+
+@lru_cache(maxsize=None)
+def derive_ipv6(ipv4_addr: int, from_telecom: bool) -> Tuple[int, int]:
+    """Return the public IPv6 address and the /48 prefix (as integers)
+    derived from an IPv4 address.
+    Rules at : https://a.notes.rezel.net/Co4oqxHwQPWwVAMkf6AwHw"""
+    if from_telecom:
+        suffix = ipv4_addr & 0xFFFF  # last two bytes
+    else:
+        suffix = 0x400 | (ipv4_addr & 0xFF)  # "4" followed by the last byte
+    return IPV6_WAN_BASE | suffix, IPV6_BASE | (suffix << 80)
+
+
+def prefix_of_ipv6(ipv6_addr: IPv6Address) -> IPv6Network | None:
+    """Return the /48 prefix leased along with an IPv6 address, which is either
+    in the prefix itself or the public WAN address derived from the same IPv4.
+    Returns None if the address is not one of ours."""
+    ipv6_int = int(ipv6_addr)
+    if ipv6_int >> 80 == IPV6_WAN_BASE >> 80:
+        return IPv6Network((IPV6_BASE | ((ipv6_int & 0xFFFF) << 80), 48))
+    if ipv6_int >> 96 == IPV6_BASE >> 96:
+        return IPv6Network((ipv6_int >> 80 << 80, 48))
+    return None
+
+
+def derive_ipv6_objects(
+    ipv4_addr: IPv4Address, from_telecom: bool
+) -> Tuple[IPv6Address, IPv6Network]:
+    public_ip, prefix = derive_ipv6(int(ipv4_addr), from_telecom)
+    return IPv6Address(public_ip), IPv6Network((prefix, 48))
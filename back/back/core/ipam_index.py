@@ -0,0 +1,332 @@
+"""
+Persistent IPv4 allocation index.
+
+Each configured IPv4 network has one document in the `ipam_index` collection
+holding a bitmap of its addresses, so that finding a free address does not
+require scanning every box. The bitmap is stored as an array of 32-bit words
+(bit `i` of word `w` is the address at offset `w * 32 + i` in the network),
+which lets a single address be claimed or released atomically with `$bit`.
+
+Addresses that cannot be assigned (network and broadcast addresses, padding
+of the last word) are marked as used when the index is built. They are
+counted in `reserved`, while `used` counts the assigned hosts and is kept up
+to date by every update of the bitmap, so that usage can be read cheaply.
+
+Released addresses are not freed right away: they stay marked as used and are
+appended to the `released` free list of their network, oldest first, until
+their quarantine is over. They are then popped from the head of the list.
+"""
+
+from datetime import datetime
+from ipaddress import IPv4Address, IPv4Network
+from itertools import takewhile
+from typing import Iterable, Tuple
+
+from bson import Int64
+from common_models.ipam_models import IPAMNetworks
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReplaceOne
+
+from back.mongodb.ipam_com_models import IPv4NetworkUsage
+
+WORD_BITS = 32
+FULL_WORD = (1 << WORD_BITS) - 1
+
+
+def _host_offsets(network: IPv4Network) -> range:
+    """Offsets (from the network address) of the assignable hosts."""
+    if network.prefixlen >= 31:
+        return range(0, network.num_addresses)
+    return range(1, network.num_addresses - 1)
+
+
+def build_bitmap(network: IPv4Network, used_ips: Iterable[IPv4Address]) -> list[int]:
+    """Build the bitmap words of a network from the addresses in use."""
+    size = network.num_addresses
+    nb_words = (size + WORD_BITS - 1) // WORD_BITS
+    hosts = _host_offsets(network)
+
+    # Start with everything marked as used, then free the assignable hosts
+    words = [FULL_WORD] * nb_words
+    for offset in hosts:
+        words[offset // WORD_BITS] &= ~(1 << (offset % WORD_BITS)) & FULL_WORD
+
+    base = int(network.network_address)
+    for ip in used_ips:
+        if ip in network:
+            offset = int(ip) - base
+            words[offset // WORD_BITS] |= 1 << (offset % WORD_BITS)
+
+    return words
+
+
+def largest_free_block(words: list[int]) -> int:
+    """Return the length of the longest run of free addresses."""
+    largest = run = 0
+    for word in words:
+        if word == 0:
+            run += WORD_BITS
+            continue
+        if word == FULL_WORD:
+            largest, run = max(largest, run), 0
+            continue
+        for bit in range(WORD_BITS):
+            if word >> bit & 1:
+                largest, run = max(largest, run), 0
+            else:
+                run += 1
+    return max(largest, run)
+
+
+def first_free_offset(words: list[int]) -> int | None:
+    """Return the offset of the lowest clear bit, or None if the bitmap is full."""
+    for index, word in enumerate(words):
+        if word != FULL_WORD:
+            free_bits = ~word & FULL_WORD
+            return index * WORD_BITS + (free_bits & -free_bits).bit_length() - 1
+    return None
+
+
+async def rebuild_ipv4_index(
+    db: AsyncIOMotorDatabase,
+    networks: IPAMNetworks,
+    used_ips: Iterable[IPv4Address],
+    quarantined: Iterable[Tuple[IPv4Address, datetime]] = (),
+) -> None:
+    """Rebuild the whole index from the configured networks and the used addresses.
+
+    Args:
+        * networks (IPAMNetworks): the IPAM configuration
+        * used_ips (Iterable[IPv4Address]): every WAN IPv4 currently assigned
+        * quarantined (Iterable[Tuple[IPv4Address, datetime]]): the released
+          addresses still in quarantine, and when they were released"""
+    quarantined = sorted(quarantined, key=lambda q: q[1])
+    used_ips = list(used_ips) + [ip for ip, _ in quarantined]
+    operations = []
+    for ipv4network in networks.ipv4_networks:
+        network = ipv4network.network
+        words = build_bitmap(network, used_ips)
+        reserved = len(words) * WORD_BITS - len(_host_offsets(network))
+        operations.append(
+            ReplaceOne(
+                {"_id": str(network)},
+                {
+                    "_id": str(network),
+                    "from_telecom": ipv4network.from_telecom,
+                    "vlan": ipv4network.vlan,
+                    "first": int(network.network_address),
+                    "last": int(network.broadcast_address),
+                    "reserved": reserved,
+                    "used": sum(w.bit_count() for w in words) - reserved,
+                    "words": [Int64(w) for w in words],
+                    "released": [
+                        {
+                            "offset": int(ip) - int(network.network_address),
+                            "released_at": released_at,
+                        }
+                        for ip, released_at in quarantined
+                        if ip in network
+                    ],
+                },
+                upsert=True,
+            )
+        )
+
+    if operations:
+        await db.ipam_index.bulk_write(operations, ordered=False)
+
+    await db.ipam_index.delete_many(
+        {"_id": {"$nin": [str(net.network) for net in networks.ipv4_networks]}}
+    )
+
+
+async def get_ipv4_index_usage(db: AsyncIOMotorDatabase) -> list[IPv4NetworkUsage]:
+    """Return the usage of every indexed network, read from the index only."""
+    return [
+        IPv4NetworkUsage(
+            network=IPv4Network(entry["_id"]),
+            vlan=entry["vlan"],
+            from_telecom=entry["from_telecom"],
+            size=entry["last"] - entry["first"] + 1,
+            reserved=entry["reserved"],
+            used=entry["used"],
+            quarantined=len(entry.get("released", [])),
+            free=entry["last"] - entry["first"] + 1 - entry["reserved"] - entry["used"],
+            largest_free_block=largest_free_block([int(w) for w in entry["words"]]),
+        )
+        async for entry in db.ipam_index.find().sort("first")
+    ]
+
+
+async def claim_first_free_ipv4(
+    db: AsyncIOMotorDatabase, network: IPv4Network
+) -> IPv4Address | None:
+    """Atomically mark the first free address of a network as used and return it.
+
+    Returns None if the network is full or not indexed."""
+    while True:
+        entry = await db.ipam_index.find_one({"_id": str(network)}, {"words": 1})
+        if entry is None:
+            return None
+
+        offset = first_free_offset([int(w) for w in entry["words"]])
+        if offset is None or offset >= network.num_addresses:
+            return None
+
+        if await _set_bit(db, str(network), offset, used=True):
+            return network.network_address + offset
+        # Someone claimed the same address in the meantime, try the next one
+
+
+async def claim_free_ipv4s(
+    db: AsyncIOMotorDatabase, network: IPv4Network, count: int
+) -> list[IPv4Address]:
+    """Atomically mark up to `count` free addresses of a network as used,
+    lowest first, in a single update. Returns the claimed addresses."""
+    while True:
+        entry = await db.ipam_index.find_one({"_id": str(network)}, {"words": 1})
+        if entry is None:
+            return []
+
+        words = [int(w) for w in entry["words"]]
+        masks: dict[int, int] = {}
+        offsets = []
+        for index, word in enumerate(words):
+            free_bits = ~word & FULL_WORD
+            while free_bits and len(offsets) < count:
+                bit = free_bits & -free_bits
+                free_bits ^= bit
+                masks[index] = masks.get(index, 0) | bit
+                offsets.append(index * WORD_BITS + bit.bit_length() - 1)
+            if len(offsets) >= count:
+                break
+
+        if not offsets:
+            return []
+
+        query: dict = {"_id": str(network)}
+        query.update(
+            {f"words.{i}": {"$bitsAllClear": mask} for i, mask in masks.items()}
+        )
+        result = await db.ipam_index.update_one(
+            query,
+            {
+                "$bit": {f"words.{i}": {"or": Int64(m)} for i, m in masks.items()},
+                "$inc": {"used": len(offsets)},
+            },
+        )
+        if result.modified_count == 1:
+            return [network.network_address + offset for offset in offsets]
+        # Some of the addresses were claimed in the meantime, try again
+
+
+async def quarantine_ipv4(
+    db: AsyncIOMotorDatabase, ip: IPv4Address, released_at: datetime
+) -> bool:
+    """Append a released address, which stays marked as used, to the free list
+    of its network. Returns False if it is not part of any indexed network."""
+    location = await _locate(db, ip)
+    if location is None:
+        return False
+    network_id, offset = location
+    result = await db.ipam_index.update_one(
+        {"_id": network_id},
+        {"$push": {"released": {"offset": offset, "released_at": released_at}}},
+    )
+    return result.modified_count == 1
+
+
+async def pop_quarantined_ipv4(
+    db: AsyncIOMotorDatabase, network: IPv4Network, released_before: datetime
+) -> IPv4Address | None:
+    """Atomically pop the oldest released address of a network, if it was
+    released before the given date. The address stays marked as used."""
+    entry = await db.ipam_index.find_one_and_update(
+        {"_id": str(network), "released.0.released_at": {"$lte": released_before}},
+        {"$pop": {"released": -1}},
+        projection={"released": {"$slice": 1}},
+    )
+    if entry is None:
+        return None
+    return network.network_address + entry["released"][0]["offset"]
+
+
+async def pop_quarantined_ipv4s(
+    db: AsyncIOMotorDatabase,
+    network: IPv4Network,
+    released_before: datetime,
+    count: int,
+) -> list[IPv4Address]:
+    """Atomically pop up to `count` of the oldest released addresses of a
+    network, which were released before the given date, in a single update.
+    The addresses stay marked as used."""
+    while True:
+        entry = await db.ipam_index.find_one(
+            {"_id": str(network)}, {"words": 0, "released": {"$slice": count}}
+        )
+        if entry is None:
+            return []
+
+        # The free list is sorted by release date
+        offsets = [
+            released["offset"]
+            for released in takewhile(
+                lambda released: released["released_at"] <= released_before,
+                entry.get("released", []),
+            )
+        ]
+        if not offsets:
+            return []
+
+        result = await db.ipam_index.update_one(
+            {"_id": str(network), "released.offset": {"$all": offsets}},
+            {"$pull": {"released": {"offset": {"$in": offsets}}}},
+        )
+        if result.modified_count == 1:
+            return [network.network_address + offset for offset in offsets]
+        # Some of the addresses were popped in the meantime, try again
+
+
+async def mark_ipv4_used(db: AsyncIOMotorDatabase, ip: IPv4Address) -> bool:
+    """Mark an address as used. Returns False if it was already used
+    or is not part of any indexed network."""
+    location = await _locate(db, ip)
+    return location is not None and await _set_bit(db, *location, used=True)
+
+
+async def mark_ipv4_free(db: AsyncIOMotorDatabase, ip: IPv4Address) -> bool:
+    """Mark an address as free. Returns False if it was already free
+    or is not part of any indexed network."""
+    location = await _locate(db, ip)
+    return location is not None and await _set_bit(db, *location, used=False)
+
+
+async def _locate(db: AsyncIOMotorDatabase, ip: IPv4Address) -> tuple[str, int] | None:
+    """Return the indexed network containing an address and the address offset."""
+    entry = await db.ipam_index.find_one(
+        {"first": {"$lte": int(ip)}, "last": {"$gte": int(ip)}}, {"first": 1}
+    )
+    if entry is None:
+        return None
+    return entry["_id"], int(ip) - entry["first"]
+
+
+async def _set_bit(
+    db: AsyncIOMotorDatabase, network_id: str, offset: int, used: bool
+) -> bool:
+    """Atomically flip one bit, only if it is not already in the requested state."""
+    word = f"words.{offset // WORD_BITS}"
+    mask = 1 << (offset % WORD_BITS)
+
+    if used:
+        query = {"_id": network_id, word: {"$bitsAllClear": mask}}
+        update = {"$bit": {word: {"or": Int64(mask)}}, "$inc": {"used": 1}}
+    else:
+        query = {"_id": network_id, word: {"$bitsAllSet": mask}}
+        update = {
+            "$bit": {word: {"and": Int64(FULL_WORD ^ mask)}},
+            "$inc": {"used": -1},
+        }
+
+    result = await db.ipam_index.update_one(query, update)
+    return result.modified_count == 1
@@ -0,0 +1,193 @@
+"""
+IPv4/IPv6 leases.
+
+A lease ties a WAN IPv4 address (and the IPv6 prefix derived from it) to a
+unet. Leases live in the `ipam_leases` collection, keyed by the IPv4 address,
+so that two concurrent provisionings can never end up with the same address:
+claiming is a single atomic find-and-modify, and the unique indexes make the
+loser of a race fail instead of silently sharing the address.
+
+A released lease is kept (with `unet_id` set to None) so that its history
+stays available, and so that the addresses still in quarantine are known.
+Its IPv6 prefix is kept too, so the prefixes are only unique among the
+leased addresses (see back.mongodb.indexes).
+"""
+
+import logging
+from datetime import datetime, timedelta
+from ipaddress import IPv4Address, IPv6Network
+from typing import Iterable, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pymongo import DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from back.mongodb.db import durable
+
+logger = logging.getLogger(__name__)
+
+# Leases claimed more recently than this are not released by a resync,
+# as the box holding them may still be being written
+RESYNC_GRACE_PERIOD = timedelta(minutes=5)
+
+
+def _leases(db: AsyncIOMotorDatabase) -> AsyncIOMotorCollection:
+    return durable(db.ipam_leases)
+
+
+async def find_lease(
+    db: AsyncIOMotorDatabase, address: IPv4Address | IPv6Network
+) -> dict | None:
+    """Return the lease of an IPv4 address or of an IPv6 /48 prefix, if any.
+    A prefix may have been released by several addresses: the current lease
+    is returned, else the last released one."""
+    if isinstance(address, IPv4Address):
+        return await _leases(db).find_one({"_id": str(address)})
+    return await _leases(db).find_one(
+        {"ipv6_prefix": str(address), "unet_id": {"$type": "string"}}
+    ) or await _leases(db).find_one(
+        {"ipv6_prefix": str(address)}, sort=[("released_at", DESCENDING)]
+    )
+
+
+async def claim_lease(
+    db: AsyncIOMotorDatabase,
+    ipv4_addr: IPv4Address,
+    ipv6_prefix: IPv6Network,
+    unet_id: str,
+) -> bool:
+    """Atomically claim the lease of an address for a unet.
+
+    Returns False if the address is already leased to another unet."""
+    try:
+        await _leases(db).find_one_and_update(
+            {"_id": str(ipv4_addr), "unet_id": None},
+            {
+                "$set": {
+                    "ipv6_prefix": str(ipv6_prefix),
+                    "unet_id": unet_id,
+                    "claimed_at": datetime.now(),
+                    "released_at": None,
+                }
+            },
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+async def claim_leases(
+    db: AsyncIOMotorDatabase,
+    leases: list[Tuple[IPv4Address, IPv6Network, str]],
+) -> list[bool]:
+    """Claim many leases in a single bulk write, see claim_lease.
+
+    Args:
+        * leases (list[Tuple[IPv4Address, IPv6Network, str]]): the
+          (IPv4 address, IPv6 prefix, unet_id) to claim
+
+    Returns, for each lease, whether it was claimed."""
+    if not leases:
+        return []
+
+    now = datetime.now()
+    claimed = [True] * len(leases)
+    try:
+        await _leases(db).bulk_write(
+            [
+                UpdateOne(
+                    {"_id": str(ipv4_addr), "unet_id": None},
+                    {
+                        "$set": {
+                            "ipv6_prefix": str(ipv6_prefix),
+                            "unet_id": unet_id,
+                            "claimed_at": now,
+                            "released_at": None,
+                        }
+                    },
+                    upsert=True,
+                )
+                for ipv4_addr, ipv6_prefix, unet_id in leases
+            ],
+            ordered=False,
+        )
+    except BulkWriteError as e:
+        for error in e.details["writeErrors"]:
+            if error["code"] != 11000:  # duplicate key
+                raise
+            claimed[error["index"]] = False
+    return claimed
+
+
+async def release_lease(db: AsyncIOMotorDatabase, unet_id: str) -> IPv4Address | None:
+    """Release the lease held by a unet. Returns the released address, if any."""
+    lease = await _leases(db).find_one_and_update(
+        {"unet_id": unet_id},
+        {"$set": {"unet_id": None, "released_at": datetime.now()}},
+        projection={"_id": 1},
+    )
+    if lease is None:
+        return None
+    return IPv4Address(lease["_id"])
+
+
+async def get_released_leases(
+    db: AsyncIOMotorDatabase, released_after: datetime
+) -> list[Tuple[IPv4Address, datetime]]:
+    """Return the addresses released after the given date, and when they were."""
+    return [
+        (IPv4Address(lease["_id"]), lease["released_at"])
+        async for lease in _leases(db).find(
+            {"unet_id": None, "released_at": {"$gt": released_after}},
+            {"released_at": 1},
+        )
+    ]
+
+
+async def sync_leases(
+    db: AsyncIOMotorDatabase,
+    used: Iterable[Tuple[IPv4Address, IPv6Network, str]],
+) -> None:
+    """Make the leases match the addresses actually assigned to the unets.
+
+    Args:
+        * used (Iterable[Tuple[IPv4Address, IPv6Network, str]]): every
+          (WAN IPv4, IPv6 prefix, unet_id) currently assigned"""
+    now = datetime.now()
+    leased_ips = []
+    operations = []
+    for ipv4_addr, ipv6_prefix, unet_id in used:
+        leased_ips.append(str(ipv4_addr))
+        operations.append(
+            UpdateOne(
+                {"_id": str(ipv4_addr)},
+                {
+                    "$set": {
+                        "ipv6_prefix": str(ipv6_prefix),
+                        "unet_id": unet_id,
+                        "released_at": None,
+                    },
+                    "$setOnInsert": {"claimed_at": now},
+                },
+                upsert=True,
+            )
+        )
+
+    if operations:
+        try:
+            await _leases(db).bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # IPv6 prefixes assigned to several unets in the boxes (see the
+            # ipv6_prefix_leased index), the other leases are still synced
+            for error in e.details["writeErrors"]:
+                logger.warning("Could not sync IPAM lease: %s", error["errmsg"])
+
+    await _leases(db).update_many(
+        {
+            "_id": {"$nin": leased_ips},
+            "unet_id": {"$type": "string"},
+            "claimed_at": {"$lt": now - RESYNC_GRACE_PERIOD},
+        },
+        {"$set": {"unet_id": None, "released_at": now}},
+    )
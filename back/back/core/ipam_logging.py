@@ -1,8 +1,10 @@
 import uuid
-from datetime import timedelta
+from datetime import datetime, timedelta
+from itertools import groupby
 
 from common_models.log_models import IpamLog
 from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
 
 from back.messaging.matrix import send_matrix_message
 
@@ -13,26 +15,7 @@ async def create_log(
 ) -> None:
 
     try:
-        await db.ipam_logs.update_one(
-            {
-                "from_date": {"$lt": log.timestamp.timestamp()},
-                "to_date": {"$gt": log.timestamp.timestamp()},
-            },
-            {
-                "$push": {"logs": log.model_dump(mode="json")},
-                "$setOnInsert": {
-                    "_id": str(uuid.uuid4()),
-                    "from_date": log.timestamp.replace(
-                        hour=0, minute=0, second=0, microsecond=0
-                    ).timestamp(),
-                    "to_date": (
-                        log.timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
-                        + timedelta(days=1)
-                    ).timestamp(),
-                },
-            },
-            upsert=True,
-        )
+        await db.ipam_logs.update_one(*_bucket_update(log.timestamp, [log]))
     except Exception as e:
         send_matrix_message(
             "Error while creating log",
@@ -41,3 +24,57 @@ async def create_log(
             f"{e}",
             "",
         )
+
+
+async def create_logs(
+    db: AsyncIOMotorDatabase,
+    logs: list[IpamLog],
+) -> None:
+    """Append many logs with a single bulk write (one update per daily bucket)."""
+    if not logs:
+        return
+
+    def day(log: IpamLog) -> datetime:
+        return log.timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    buckets = [
+        list(bucket_logs)
+        for _, bucket_logs in groupby(
+            sorted(logs, key=lambda log: log.timestamp), key=day
+        )
+    ]
+
+    try:
+        await db.ipam_logs.bulk_write(
+            [
+                UpdateOne(*_bucket_update(bucket_logs[0].timestamp, bucket_logs))
+                for bucket_logs in buckets
+            ]
+        )
+    except Exception as e:
+        send_matrix_message(
+            f"Error while creating {len(logs)} logs",
+            *[f"Message : {log.message}" for log in logs],
+            f"{e}",
+            "",
+        )
+
+
+def _bucket_update(timestamp: datetime, logs: list[IpamLog]) -> tuple[dict, dict, bool]:
+    """Query, update and upsert flag appending logs to the daily bucket of a timestamp."""
+    from_date = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    return (
+        {
+            "from_date": {"$lt": timestamp.timestamp()},
+            "to_date": {"$gt": timestamp.timestamp()},
+        },
+        {
+            "$push": {"logs": {"$each": [log.model_dump(mode="json") for log in logs]}},
+            "$setOnInsert": {
+                "_id": str(uuid.uuid4()),
+                "from_date": from_date.timestamp(),
+                "to_date": (from_date + timedelta(days=1)).timestamp(),
+            },
+        },
+        True,
+    )
@@ -0,0 +1,54 @@
+"""
+Lightweight read model of the addresses used by the unets.
+
+Only the addressing fields of the boxes are requested from MongoDB, and they
+are returned as compact tuples instead of validated `Box` models, which would
+also load and validate the Wi-Fi, DHCP, firewall and ping history payloads.
+"""
+
+from ipaddress import IPv4Address
+from typing import AsyncIterator, NamedTuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+ADDRESSING_PROJECTION = {
+    "_id": 0,
+    "unets.unet_id": 1,
+    "unets.network.wan_ipv4.ip": 1,
+    "unets.network.ipv6_prefix": 1,
+}
+
+
+class UnetAddressing(NamedTuple):
+    unet_id: str
+    ipv4: int  # WAN IPv4 address, without the prefix length
+    ipv6_prefix: str
+
+    @property
+    def ipv4_address(self) -> IPv4Address:
+        return IPv4Address(self.ipv4)
+
+
+def _ipv4_to_int(interface: str) -> int:
+    """Convert a stored IPv4 interface (e.g. "137.194.11.3/24") to an int."""
+    return int(IPv4Address(interface.partition("/")[0]))
+
+
+async def iter_unet_addressing(
+    db: AsyncIOMotorDatabase, query: dict | None = None
+) -> AsyncIterator[UnetAddressing]:
+    """Stream the addressing of every unet of the boxes matching the query."""
+    async for box in db.boxes.find(query or {}, ADDRESSING_PROJECTION):
+        for unet in box.get("unets", []):
+            network = unet["network"]
+            yield UnetAddressing(
+                unet_id=unet["unet_id"],
+                ipv4=_ipv4_to_int(network["wan_ipv4"]["ip"]),
+                ipv6_prefix=network["ipv6_prefix"],
+            )
+
+
+async def get_unet_addressing(
+    db: AsyncIOMotorDatabase, query: dict | None = None
+) -> list[UnetAddressing]:
+    return [unet async for unet in iter_unet_addressing(db, query)]
@@ -0,0 +1,239 @@
+"""
+Request-scoped cache of the users, boxes, PMs and ONTs.
+
+The dependencies and the core functions of a request often need the same
+documents: the current user, then their box, then the ONT of the box... A
+`Loader` reads each of them at most once per request, and the lookups made in
+the same iteration of the event loop (e.g. with asyncio.gather) are batched in
+a single `$in` query. Documents found by one lookup are also cached for the
+other lookups they answer, e.g. a box read by unet id is cached by MAC address.
+
+The loader caches reads only: a request writing a document and reading it
+back must call `clear` in between.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+from common_models.hermes_models import Box
+from common_models.pon_models import PM
+from common_models.user_models import User
+from fastapi import Request
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from netaddr import EUI, mac_unix_expanded
+
+from back.core.ont_locations import find_ont_locations
+from back.mongodb.db import WITHOUT_PING_HISTORY
+from back.mongodb.pon_com_models import ONTLocation
+from back.mongodb.repository import decode_many
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class BatchLoader(Generic[K, V]):
+    """Loads values by key, each key at most once, batching the keys
+    requested in the same iteration of the event loop.
+
+    Args:
+        * batch_load (Callable[[list[K]], Awaitable[dict[K, V]]]): reads the
+          values of many keys, the keys without a value are left out"""
+
+    def __init__(self, batch_load: Callable[[list[K]], Awaitable[dict[K, V]]]) -> None:
+        self._batch_load = batch_load
+        self._futures: dict[K, asyncio.Future] = {}
+        self._queue: list[K] = []
+        self._tasks: set[asyncio.Task] = set()
+
+    async def load(self, key: K) -> V | None:
+        future = self._futures.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._futures[key] = loop.create_future()
+            if not self._queue:
+                loop.call_soon(self._dispatch)
+            self._queue.append(key)
+        # The future is shared with the other callers, which must not be
+        # cancelled along with this one
+        return await asyncio.shield(future)
+
+    async def load_many(self, keys: list[K]) -> list[V | None]:
+        return list(await asyncio.gather(*(self.load(key) for key in keys)))
+
+    def prime(self, key: K, value: V | None) -> None:
+        """Cache the value of a key, unless it is already known or being read."""
+        if key not in self._futures:
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(value)
+            self._futures[key] = future
+
+    def clear(self) -> None:
+        self._futures = {key: self._futures[key] for key in self._queue}
+
+    def _dispatch(self) -> None:
+        keys, self._queue = self._queue, []
+        task = asyncio.ensure_future(
+            self._run({key: self._futures[key] for key in keys})
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, futures: dict[K, asyncio.Future]) -> None:
+        try:
+            values = await self._batch_load(list(futures))
+        except Exception as e:  # pylint: disable=broad-except
+            for key, future in futures.items():
+                # Not cached, so that a later load tries again
+                if self._futures.get(key) is future:
+                    del self._futures[key]
+                future.set_exception(e)
+            return
+        for key, future in futures.items():
+            future.set_result(values.get(key))
+
+
+def mac_key(mac: EUI | str) -> str:
+    """A MAC address as stored in the database."""
+    return str(EUI(mac, dialect=mac_unix_expanded))
+
+
+class Loader:
+    """Reads the users, boxes, PMs and ONTs of a request, see the module docstring."""
+
+    def __init__(self, db: AsyncIOMotorDatabase) -> None:
+        self.db = db
+        # By user id
+        self._users: BatchLoader[str, User] = BatchLoader(self._load_users)
+        # The users of a unet, by unet id
+        self._users_by_unet_id: BatchLoader[str, list[User]] = BatchLoader(
+            self._load_users_by_unet_id
+        )
+        # By MAC address (see mac_key)
+        self._boxes: BatchLoader[str, Box] = BatchLoader(self._load_boxes)
+        # The box holding a unet, by unet id
+        self._boxes_by_unet_id: BatchLoader[str, Box] = BatchLoader(
+            self._load_boxes_by_unet_id
+        )
+        # By PM id
+        self._pms: BatchLoader[str, PM] = BatchLoader(self._load_pms)
+        # The ONT of a box, by box MAC address (see mac_key)
+        self._onts_by_box_mac: BatchLoader[str, ONTLocation] = BatchLoader(
+            self._load_onts_by_box_mac
+        )
+        # By ONT serial number
+        self._onts: BatchLoader[str, ONTLocation] = BatchLoader(self._load_onts)
+
+    async def get_user(self, user_id: str) -> User | None:
+        return await self._users.load(user_id)
+
+    async def get_users_on_unets(self, unet_ids: list[str]) -> list[User]:
+        return [
+            user
+            for users in await self._users_by_unet_id.load_many(unet_ids)
+            for user in users or []
+        ]
+
+    async def get_box(self, mac: EUI | str) -> Box | None:
+        return await self._boxes.load(mac_key(mac))
+
+    async def get_box_of_unet(self, unet_id: str) -> Box | None:
+        return await self._boxes_by_unet_id.load(unet_id)
+
+    async def get_pm(self, pm_id: str) -> PM | None:
+        return await self._pms.load(pm_id)
+
+    async def get_ont_of_box(self, mac: EUI | str) -> ONTLocation | None:
+        return await self._onts_by_box_mac.load(mac_key(mac))
+
+    async def get_ont(self, serial_number: str) -> ONTLocation | None:
+        return await self._onts.load(serial_number)
+
+    def clear(self) -> None:
+        """Forget the documents read so far, e.g. after writing some of them."""
+        for batch_loader in (
+            self._users,
+            self._users_by_unet_id,
+            self._boxes,
+            self._boxes_by_unet_id,
+            self._pms,
+            self._onts_by_box_mac,
+            self._onts,
+        ):
+            batch_loader.clear()
+
+    async def _load_users(self, user_ids: list[str]) -> dict[str, User]:
+        users = decode_many(
+            User,
+            await self.db.users.find({"_id": {"$in": user_ids}}).to_list(None),
+        )
+        return {str(user.id): user for user in users}
+
+    async def _load_users_by_unet_id(
+        self, unet_ids: list[str]
+    ) -> dict[str, list[User]]:
+        users_by_unet_id: dict[str, list[User]] = {unet_id: [] for unet_id in unet_ids}
+        users = decode_many(
+            User,
+            await self.db.users.find({"membership.unetid": {"$in": unet_ids}}).to_list(
+                None
+            ),
+        )
+        for user in users:
+            self._users.prime(str(user.id), user)
+            if user.membership and user.membership.unetid in users_by_unet_id:
+                users_by_unet_id[user.membership.unetid].append(user)
+        return users_by_unet_id
+
+    async def _read_boxes(self, query: dict) -> list[Box]:
+        boxes = decode_many(
+            Box, await self.db.boxes.find(query, WITHOUT_PING_HISTORY).to_list(None)
+        )
+        for box in boxes:
+            self._boxes.prime(mac_key(box.mac), box)
+            for unet in box.unets:
+                self._boxes_by_unet_id.prime(unet.unet_id, box)
+        return boxes
+
+    async def _load_boxes(self, macs: list[str]) -> dict[str, Box]:
+        return {
+            mac_key(box.mac): box
+            for box in await self._read_boxes({"mac": {"$in": macs}})
+        }
+
+    async def _load_boxes_by_unet_id(self, unet_ids: list[str]) -> dict[str, Box]:
+        return {
+            unet.unet_id: box
+            for box in await self._read_boxes({"unets.unet_id": {"$in": unet_ids}})
+            for unet in box.unets
+        }
+
+    async def _load_pms(self, pm_ids: list[str]) -> dict[str, PM]:
+        pms = decode_many(
+            PM, await self.db.pms.find({"_id": {"$in": pm_ids}}).to_list(None)
+        )
+        return {pm.id: pm for pm in pms}
+
+    def _cache_onts(self, locations: list[ONTLocation]) -> None:
+        for location in locations:
+            self._onts.prime(location.ont.serial_number, location)
+            self._onts_by_box_mac.prime(mac_key(location.ont.box_mac_address), location)
+
+    async def _load_onts_by_box_mac(self, macs: list[str]) -> dict[str, ONTLocation]:
+        locations = await find_ont_locations(self.db, "box_mac_address", macs)
+        self._cache_onts(locations)
+        return {
+            mac_key(location.ont.box_mac_address): location for location in locations
+        }
+
+    async def _load_onts(self, serial_numbers: list[str]) -> dict[str, ONTLocation]:
+        locations = await find_ont_locations(self.db, "serial_number", serial_numbers)
+        self._cache_onts(locations)
+        return {location.ont.serial_number: location for location in locations}
+
+
+def get_request_loader(request: Request, db: AsyncIOMotorDatabase) -> Loader:
+    """The loader of a request, created on first use."""
+    loader = getattr(request.state, "loader", None)
+    if loader is None:
+        loader = request.state.loader = Loader(db)
+    return loader
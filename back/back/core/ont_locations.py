@@ -0,0 +1,50 @@
+"""
+Lookup of single ONTs.
+
+The ONTs are stored in the PMs (`pms.pon_list.ont_list`). Instead of reading
+and validating a whole PM to find one of them, an aggregation matches the PM
+through the multikey indexes on the serial numbers and box MAC addresses (see
+back.mongodb.indexes) and returns only the ONT along with its PM and PON.
+"""
+
+from typing import Literal
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from back.mongodb.pon_com_models import ONTLocation
+
+
+def _ont_locations_pipeline(field: str, values: list[str]) -> list[dict]:
+    match = {f"pon_list.ont_list.{field}": {"$in": values}}
+    return [
+        {"$match": match},
+        {"$unwind": "$pon_list"},
+        {"$unwind": "$pon_list.ont_list"},
+        {"$match": match},
+        {
+            "$project": {
+                "_id": 0,
+                "pm_id": "$_id",
+                "pm_description": "$description",
+                "pon": "$pon_list",
+                "ont": "$pon_list.ont_list",
+            }
+        },
+        {"$set": {"pon.ont_list": []}},
+    ]
+
+
+async def find_ont_locations(
+    db: AsyncIOMotorDatabase,
+    field: Literal["serial_number", "box_mac_address"],
+    values: list[str],
+) -> list[ONTLocation]:
+    """Find the ONTs whose serial number or box MAC address is in `values`.
+
+    Args:
+        * field (str): "serial_number" or "box_mac_address"
+        * values (list[str]): the serial numbers or MAC addresses, as stored"""
+    return [
+        ONTLocation.model_validate(location)
+        async for location in db.pms.aggregate(_ont_locations_pipeline(field, values))
+    ]
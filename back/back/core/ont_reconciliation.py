@@ -0,0 +1,418 @@
+"""
+Bulk registration and reconciliation of the ONTs.
+
+register_ont_for_new_ftth_adh registers one ONT with a few reads and a write,
+then the routers register it in the OLT through Charon. reconcile_onts does the
+same for many ONTs at once:
+
+- the PMs and the boxes are read once, and the requested ONTs are compared in
+  memory with the PMs, in order: each ONT is added, updated (box or software
+  version), moved to another position, or left unchanged
+- with a summary of the OLT (see charon.parse_ont_summary), the ONTs of the
+  PMs missing in the OLT, or in the OLT but not in the PMs, are reported and
+  `configured_in_olt` is set on every ONT of the PMs
+- the changes are applied with a single ordered bulk_write. The additions only
+  apply if the position and serial number are still free (see push_ont_update),
+  and the written ONTs are read back to report the changes lost to concurrent
+  registrations. A move is a pull then a push: without transactions, a moved
+  ONT whose new position was taken meanwhile is put back where it was
+- the ONTs missing in the OLT (without a summary, the added ONTs) are then
+  registered in it. The requests to Charon are blocking, so they run in
+  threads, at most OLT_REGISTRATION_CONCURRENCY at once
+"""
+
+import asyncio
+import logging
+from collections import Counter, defaultdict
+from typing import Tuple
+
+import requests
+from common_models.pon_models import ONT, PM, PON
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from netaddr import EUI, AddrFormatError, mac_unix_expanded
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from back.core.charon import parse_ont_summary, register_ont_in_olt
+from back.core.loader import mac_key
+from back.core.ont_locations import find_ont_locations
+from back.core.pm_topology import invalidate_pm_topology
+from back.core.pon import (
+    get_first_free_port,
+    is_free_port,
+    mec128_string_to_position_in_pon,
+    position_in_pon_to_mec128_string,
+    push_ont_update,
+)
+from back.messaging.matrix import send_matrix_message
+from back.mongodb.pon_com_models import (
+    BulkRegisterONT,
+    ONTReconciliationReport,
+    ONTReconciliationResult,
+)
+
+logger = logging.getLogger(__name__)
+
+OLT_REGISTRATION_CONCURRENCY = 4
+
+ADDED = "added"
+UPDATED = "updated"
+MOVED = "moved"
+UNCHANGED = "unchanged"
+ERROR = "error"
+
+
+class _Reconciliation:
+    """The PMs as they will be once the planned writes are applied."""
+
+    def __init__(self, pms: list[PM], box_macs: set[str]) -> None:
+        self.pms = {pm.id: pm for pm in pms}
+        self.box_macs = box_macs
+        # By serial number
+        self.locations: dict[str, Tuple[PM, PON, ONT]] = {}
+        # Serial number of the ONT of each box, by MAC address (see mac_key)
+        self.ont_of_box: dict[str, str] = {}
+        for pm in pms:
+            for pon in pm.pon_list:
+                for ont in pon.ont_list:
+                    self._index(pm, pon, ont)
+
+        self.operations: list[UpdateOne] = []
+        self.results: list[ONTReconciliationResult] = []
+        self.requested: set[str] = set()
+        # The changed ONTs, by serial number, with the index of their result
+        self.changed: dict[str, Tuple[int, str, PON, ONT]] = {}
+        # Where the moved ONTs were, by serial number, to put them back if
+        # their new position was taken meanwhile
+        self.moved_from: dict[str, Tuple[str, PON, ONT]] = {}
+
+    def _index(self, pm: PM, pon: PON, ont: ONT) -> None:
+        self.locations[ont.serial_number] = (pm, pon, ont)
+        self.ont_of_box[mac_key(ont.box_mac_address)] = ont.serial_number
+
+    def _unindex(self, pon: PON, ont: ONT) -> None:
+        pon.ont_list.remove(ont)
+        del self.locations[ont.serial_number]
+        del self.ont_of_box[mac_key(ont.box_mac_address)]
+
+    def _add(self, pm: PM, pon: PON, ont: ONT) -> None:
+        pon.ont_list.append(ont)
+        self._index(pm, pon, ont)
+
+    def plan(self, entry: BulkRegisterONT) -> None:
+        serial_number = entry.serial_number
+        if serial_number in self.requested:
+            self.results.append(
+                ONTReconciliationResult(
+                    serial_number=serial_number,
+                    status=ERROR,
+                    detail="ONT requested more than once",
+                )
+            )
+            return
+        self.requested.add(serial_number)
+
+        try:
+            status, pm, pon, ont = self._plan(entry)
+        except ValueError as e:
+            self.results.append(
+                ONTReconciliationResult(
+                    serial_number=serial_number, status=ERROR, detail=str(e)
+                )
+            )
+            return
+
+        if status != UNCHANGED:
+            self.changed[serial_number] = (len(self.results), pm.id, pon, ont)
+        self.results.append(
+            ONTReconciliationResult(
+                serial_number=serial_number,
+                status=status,
+                mec128_position=position_in_pon_to_mec128_string(
+                    pon, ont.position_in_pon
+                ),
+            )
+        )
+
+    def _free_position(self, pm: PM, position_mec128: str | None) -> Tuple[PON, int]:
+        if not position_mec128:
+            return get_first_free_port(pm)
+
+        pon, position_in_pon = mec128_string_to_position_in_pon(pm, position_mec128)
+        if not is_free_port(pon, position_in_pon):
+            raise ValueError(
+                f"Specified position in PM {position_mec128} is not available (already used)"
+            )
+        return pon, position_in_pon
+
+    def _plan(self, entry: BulkRegisterONT) -> Tuple[str, PM, PON, ONT]:
+        try:
+            box_mac = EUI(entry.box_mac_address, dialect=mac_unix_expanded)
+        except AddrFormatError as e:
+            raise ValueError(f"Invalid box MAC address {entry.box_mac_address}") from e
+        if mac_key(box_mac) not in self.box_macs:
+            raise ValueError(f"No box with MAC address {box_mac}")
+
+        if not (pm := self.pms.get(entry.pm_id)):
+            raise ValueError(f"PM with id {entry.pm_id} does not exist")
+
+        if self.ont_of_box.get(mac_key(box_mac)) not in (None, entry.serial_number):
+            raise ValueError(
+                f"There is already an ONT registered for this box {box_mac}"
+            )
+
+        if not (location := self.locations.get(entry.serial_number)):
+            pon, position_in_pon = self._free_position(pm, entry.position_pm)
+            ont = ONT(
+                serial_number=entry.serial_number,
+                software_version=entry.software_version,
+                box_mac_address=box_mac,
+                position_in_pon=position_in_pon,
+            )
+            self.operations.append(UpdateOne(**push_ont_update(pm.id, pon, ont)))
+            self._add(pm, pon, ont)
+            return ADDED, pm, pon, ont
+
+        current_pm, current_pon, current_ont = location
+        changes = {}
+        if mac_key(current_ont.box_mac_address) != mac_key(box_mac):
+            changes["box_mac_address"] = box_mac
+        if current_ont.software_version != entry.software_version:
+            changes["software_version"] = entry.software_version
+
+        same_position = current_pm is pm and (
+            not entry.position_pm
+            or mec128_string_to_position_in_pon(pm, entry.position_pm)
+            == (current_pon, current_ont.position_in_pon)
+        )
+        if same_position and not changes:
+            return UNCHANGED, pm, current_pon, current_ont
+
+        if same_position:
+            ont = current_ont.model_copy(update=changes)
+            self.operations.append(
+                UpdateOne(
+                    {
+                        "_id": pm.id,
+                        "pon_list.ont_list.serial_number": ont.serial_number,
+                    },
+                    {
+                        "$set": {
+                            f"pon_list.$[].ont_list.$[ont].{field}": (
+                                mac_key(value) if field == "box_mac_address" else value
+                            )
+                            for field, value in changes.items()
+                        }
+                    },
+                    array_filters=[{"ont.serial_number": ont.serial_number}],
+                )
+            )
+            self._unindex(current_pon, current_ont)
+            self._add(pm, current_pon, ont)
+            return UPDATED, pm, current_pon, ont
+
+        # Moved, removed from its PON before being added to the new one
+        pon, position_in_pon = self._free_position(pm, entry.position_pm)
+        ont = current_ont.model_copy(
+            update={**changes, "position_in_pon": position_in_pon}
+        )
+        self.operations.append(
+            UpdateOne(
+                {"_id": current_pm.id},
+                {
+                    "$pull": {
+                        "pon_list.$[].ont_list": {"serial_number": ont.serial_number}
+                    }
+                },
+            )
+        )
+        self.operations.append(UpdateOne(**push_ont_update(pm.id, pon, ont)))
+        self.moved_from[ont.serial_number] = (current_pm.id, current_pon, current_ont)
+        self._unindex(current_pon, current_ont)
+        self._add(pm, pon, ont)
+        return MOVED, pm, pon, ont
+
+    def compare_with_olt(
+        self, olt_onts: dict[str, str | None]
+    ) -> Tuple[list[str], list[str]]:
+        """Plan the updates of `configured_in_olt`. Returns the serial numbers
+        missing in the OLT, and the ones missing in the PMs."""
+        in_db = {serial_number.upper() for serial_number in self.locations}
+        missing_in_olt = []
+        # The ONTs to update, by PM and value of `configured_in_olt`
+        to_update: dict[Tuple[str, bool], list[str]] = defaultdict(list)
+        for serial_number, (pm, _, ont) in sorted(self.locations.items()):
+            configured = serial_number.upper() in olt_onts
+            if not configured:
+                missing_in_olt.append(serial_number)
+            if ont.configured_in_olt != configured:
+                to_update[(pm.id, configured)].append(serial_number)
+
+        for (pm_id, configured), serial_numbers in to_update.items():
+            self.operations.append(
+                UpdateOne(
+                    {"_id": pm_id},
+                    {
+                        "$set": {
+                            "pon_list.$[].ont_list.$[ont].configured_in_olt": configured
+                        }
+                    },
+                    array_filters=[{"ont.serial_number": {"$in": serial_numbers}}],
+                )
+            )
+
+        return missing_in_olt, sorted(set(olt_onts) - in_db)
+
+    async def _restore(self, db: AsyncIOMotorDatabase, serial_number: str) -> str:
+        """Put back a moved ONT which was pulled from its PON but not added to
+        the new one. Returns the detail of its result."""
+        pm_id, pon, ont = self.moved_from[serial_number]
+        try:
+            restored = await db.pms.update_one(**push_ont_update(pm_id, pon, ont))
+        except DuplicateKeyError:  # registered again in another PM meanwhile
+            restored = None
+        if restored is not None and restored.modified_count == 1:
+            return "Not moved, the new position was taken meanwhile"
+
+        logger.error("Moved ONT %s lost, could not put it back", serial_number)
+        send_matrix_message(
+            f"❌ ONT {serial_number} retirée du PM {pm_id} sans pouvoir y être remise",
+            "```",
+            ont.model_dump_json(),
+            "```",
+        )
+        return "Removed from its PON but not moved, and could not be put back"
+
+    async def check_written(self, db: AsyncIOMotorDatabase) -> None:
+        """Report the changed ONTs which are not where they were planned,
+        because of concurrent changes of the PMs. The moves are not atomic:
+        the moved ONTs found in no PM are put back where they were."""
+        locations = {
+            location.ont.serial_number: location
+            for location in await find_ont_locations(
+                db, "serial_number", list(self.changed)
+            )
+        }
+        for serial_number, (index, pm_id, pon, ont) in self.changed.items():
+            location = locations.get(serial_number)
+            if (
+                location is None
+                or location.pm_id != pm_id
+                or location.pon.olt_id != pon.olt_id
+                or location.pon.olt_interface != pon.olt_interface
+                or location.ont.position_in_pon != ont.position_in_pon
+                or mac_key(location.ont.box_mac_address) != mac_key(ont.box_mac_address)
+                or location.ont.software_version != ont.software_version
+            ):
+                detail = "Not applied, the PM was changed meanwhile"
+                if location is None and serial_number in self.moved_from:
+                    detail = await self._restore(db, serial_number)
+                self.results[index] = ONTReconciliationResult(
+                    serial_number=serial_number, status=ERROR, detail=detail
+                )
+
+
+async def _register_in_olt(serial_numbers: list[str]) -> list[str]:
+    """Register ONTs in the OLT. Returns the serial numbers which failed."""
+    semaphore = asyncio.Semaphore(OLT_REGISTRATION_CONCURRENCY)
+
+    async def register(serial_number: str) -> bool:
+        async with semaphore:
+            try:
+                return await asyncio.to_thread(
+                    register_ont_in_olt, serial_number, notify=False
+                )
+            except requests.RequestException:
+                logger.exception("Could not register ONT %s in OLT", serial_number)
+                return False
+
+    registered = await asyncio.gather(*map(register, serial_numbers))
+    return [
+        serial_number for serial_number, ok in zip(serial_numbers, registered) if not ok
+    ]
+
+
+async def reconcile_onts(
+    db: AsyncIOMotorDatabase,
+    onts: list[BulkRegisterONT],
+    olt_summary: str | None = None,
+    register_in_olt: bool = True,
+) -> ONTReconciliationReport:
+    """Register, update or move many ONTs at once, see the module docstring.
+
+    Args:
+        * onts (list[BulkRegisterONT]): the ONTs, applied in order
+        * olt_summary (str | None): output of charon.get_all_ont_summary
+        * register_in_olt (bool): register the ONTs missing in the OLT"""
+    macs = set()
+    for entry in onts:
+        try:
+            macs.add(mac_key(entry.box_mac_address))
+        except AddrFormatError:
+            pass  # reported by _Reconciliation.plan
+    box_macs = {
+        mac_key(box["mac"])
+        async for box in db.boxes.find({"mac": {"$in": list(macs)}}, {"mac": 1})
+    }
+    pms = [PM.model_validate(pm) async for pm in db.pms.find()]
+
+    reconciliation = _Reconciliation(pms, box_macs)
+    for entry in onts:
+        reconciliation.plan(entry)
+
+    missing_in_olt: list[str] = []
+    unknown_in_db: list[str] = []
+    if olt_summary is not None:
+        missing_in_olt, unknown_in_db = reconciliation.compare_with_olt(
+            parse_ont_summary(olt_summary)
+        )
+
+    if reconciliation.operations:
+        try:
+            await db.pms.bulk_write(reconciliation.operations, ordered=True)
+        except BulkWriteError as e:
+            # The writes after the failed one are not applied, check_written
+            # reports them
+            logger.warning(
+                "ONT reconciliation stopped by a write error: %s",
+                e.details.get("writeErrors"),
+            )
+        invalidate_pm_topology()
+        await reconciliation.check_written(db)
+
+    results = reconciliation.results
+    to_register = []
+    if register_in_olt:
+        failed = {result.serial_number for result in results if result.status == ERROR}
+        if olt_summary is not None:
+            to_register = [
+                serial_number
+                for serial_number in missing_in_olt
+                if serial_number not in failed
+            ]
+        else:
+            to_register = [
+                result.serial_number for result in results if result.status == ADDED
+            ]
+    olt_registration_failures = await _register_in_olt(to_register)
+    if olt_registration_failures:
+        send_matrix_message(
+            f"❌ Erreur lors de l'enregistrement de {len(olt_registration_failures)} ONTs dans l'OLT",
+            "```",
+            *olt_registration_failures,
+            "```",
+        )
+
+    return ONTReconciliationReport(
+        results=results,
+        status_counts=dict(Counter(result.status for result in results)),
+        writes=len(reconciliation.operations),
+        registered_in_olt=[
+            serial_number
+            for serial_number in to_register
+            if serial_number not in olt_registration_failures
+        ],
+        olt_registration_failures=olt_registration_failures,
+        missing_in_olt=missing_in_olt,
+        unknown_in_db=unknown_in_db,
+    )
@@ -12,6 +12,9 @@ from common_models.user_models import (
 )
 from motor.motor_asyncio import AsyncIOMotorDatabase
 
+from back.mongodb import repository
+from back.mongodb.repository import Repository
+
 
 class Result:
     failed_ftth_users: list[User] = []
@@ -25,25 +28,17 @@ async def refresh_partial_refund_database(db: AsyncIOMotorDatabase) -> Result:
     """
     result: Result = Result()
 
-    users = [
-        User.model_validate(user) for user in await db.users.find({}).to_list(None)
-    ]
-
-    ftth_users = [
-        user
-        for user in users
-        if user.membership
-        and user.membership.status == MembershipStatus.ACTIVE
-        and user.membership.type == MembershipType.FTTH
-    ]
+    ftth_users = await repository.users(db).find(
+        {
+            "membership.status": MembershipStatus.ACTIVE,
+            "membership.type": MembershipType.FTTH,
+        }
+    )
 
     # Get existing partial refund objects for active ftth_users
-    partial_refunds = [
-        PartialRefund.model_validate(refund)
-        for refund in await db.partial_refunds.find(
-            {"user_id": {"$in": [str(user.id) for user in ftth_users]}}
-        ).to_list(None)
-    ]
+    partial_refunds = await Repository(db.partial_refunds, PartialRefund).find(
+        {"user_id": {"$in": [str(user.id) for user in ftth_users]}}
+    )
 
     for ftth_user in ftth_users:
         if not ftth_user.membership or not ftth_user.membership.start_date:
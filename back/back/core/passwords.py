@@ -0,0 +1,37 @@
+"""
+Generation of the Wi-Fi passwords (PSK) of the unets.
+
+The xkcd wordlist is read from disk and filtered once, the first time a
+password is generated, and then kept in memory as a tuple of words.
+"""
+
+import secrets
+from functools import lru_cache
+
+from xkcdpass import xkcd_password
+
+PASSWORD_WORDS = 4
+PASSWORD_DELIMITER = "_"
+
+
+@lru_cache(maxsize=1)
+def get_wordlist() -> tuple[str, ...]:
+    default_words = xkcd_password.locate_wordfile()
+    word_list = xkcd_password.generate_wordlist(
+        wordfile=default_words, min_length=5, max_length=8, valid_chars="[^'\"]"
+    )
+
+    if not word_list:
+        raise ValueError("Password generation failed")
+
+    return tuple(word_list)
+
+
+def generate_password() -> str:
+    words = get_wordlist()
+    return PASSWORD_DELIMITER.join(secrets.choice(words) for _ in range(PASSWORD_WORDS))
+
+
+def generate_passwords(count: int) -> list[str]:
+    """Generate `count` passwords, e.g. for a PSK rotation campaign."""
+    return [generate_password() for _ in range(count)]
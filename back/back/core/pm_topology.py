@@ -0,0 +1,150 @@
+"""
+Capacity and topology of the PMs.
+
+Ports used and free per PON and per PM, the MEC128 occupancy map and the
+software versions of the ONTs are computed with a single `$facet`
+aggregation, returning the positions of the ONTs rather than the ONTs
+themselves. The result is cached in the process and invalidated by the ONT
+writes (see invalidate_pm_topology), and expires after CACHE_TTL for the
+writes made by other processes.
+"""
+
+import time
+
+from common_models.pon_models import PON
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from back.core.pon import position_in_pon_to_mec128_string
+from back.mongodb.pon_com_models import PMCapacity, PMTopology, PONCapacity
+
+CACHE_TTL = 60  # seconds
+
+TOPOLOGY_PIPELINE = [
+    {
+        "$facet": {
+            "pms": [
+                {"$sort": {"_id": 1}},
+                {
+                    "$project": {
+                        "description": 1,
+                        "pons": {
+                            "$map": {
+                                "input": "$pon_list",
+                                "as": "pon",
+                                "in": {
+                                    "olt_id": "$$pon.olt_id",
+                                    "olt_interface": "$$pon.olt_interface",
+                                    "number_of_ports": "$$pon.number_of_ports",
+                                    "mec128_offset": "$$pon.mec128_offset",
+                                    "rack": "$$pon.rack",
+                                    "tiroir": "$$pon.tiroir",
+                                    "onts": {
+                                        "$map": {
+                                            "input": "$$pon.ont_list",
+                                            "as": "ont",
+                                            "in": {
+                                                "position_in_pon": "$$ont.position_in_pon",
+                                                "serial_number": "$$ont.serial_number",
+                                            },
+                                        }
+                                    },
+                                },
+                            }
+                        },
+                    }
+                },
+            ],
+            "software_versions": [
+                {"$unwind": "$pon_list"},
+                {"$unwind": "$pon_list.ont_list"},
+                {
+                    "$group": {
+                        "_id": "$pon_list.ont_list.software_version",
+                        "count": {"$sum": 1},
+                    }
+                },
+                {"$sort": {"_id": 1}},
+            ],
+        }
+    }
+]
+
+_cache: PMTopology | None = None
+_cached_at = 0.0
+# Incremented by every invalidation, so that a result computed before an
+# ONT write is not cached after it
+_generation = 0
+
+
+def invalidate_pm_topology() -> None:
+    global _cache, _generation
+    _cache = None
+    _generation += 1
+
+
+def _pon_capacity(pon_dict: dict) -> PONCapacity:
+    pon = PON.model_validate({**pon_dict, "ont_list": []})
+    serial_numbers = {
+        ont["position_in_pon"]: ont["serial_number"] for ont in pon_dict["onts"]
+    }
+    used = len(serial_numbers.keys() & range(pon.number_of_ports))
+    return PONCapacity(
+        olt_id=pon.olt_id,
+        olt_interface=pon.olt_interface,
+        rack=pon.rack,
+        tiroir=pon.tiroir,
+        ports=pon.number_of_ports,
+        used=used,
+        free=pon.number_of_ports - used,
+        occupancy={
+            position_in_pon_to_mec128_string(pon, position): serial_numbers.get(
+                position
+            )
+            for position in range(pon.number_of_ports)
+        },
+    )
+
+
+async def _compute_pm_topology(db: AsyncIOMotorDatabase) -> PMTopology:
+    facets = (await db.pms.aggregate(TOPOLOGY_PIPELINE).to_list(None))[0]
+
+    pms = []
+    for pm in facets["pms"]:
+        pons = [_pon_capacity(pon) for pon in pm.get("pons") or []]
+        ports = sum(pon.ports for pon in pons)
+        used = sum(pon.used for pon in pons)
+        pms.append(
+            PMCapacity(
+                id=pm["_id"],
+                description=pm["description"],
+                ports=ports,
+                used=used,
+                free=ports - used,
+                pons=pons,
+            )
+        )
+
+    ports = sum(pm.ports for pm in pms)
+    used = sum(pm.used for pm in pms)
+    return PMTopology(
+        pms=pms,
+        ports=ports,
+        used=used,
+        free=ports - used,
+        software_versions={
+            version["_id"]: version["count"] for version in facets["software_versions"]
+        },
+    )
+
+
+async def get_pm_topology(db: AsyncIOMotorDatabase) -> PMTopology:
+    """Return the capacity and topology of the PMs, computing it only if needed."""
+    global _cache, _cached_at
+    if _cache is not None and time.monotonic() - _cached_at < CACHE_TTL:
+        return _cache
+
+    generation = _generation
+    topology = await _compute_pm_topology(db)
+    if generation == _generation:
+        _cache, _cached_at = topology, time.monotonic()
+    return topology
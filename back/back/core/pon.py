@@ -5,14 +5,26 @@ from common_models.hermes_models import Box
 from common_models.pon_models import ONT, PM, PON
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from netaddr import EUI, mac_unix_expanded
+from pymongo.errors import DuplicateKeyError
 
-from back.mongodb.pon_com_models import ONTInfo
+from back.core.loader import Loader
+from back.core.ont_locations import find_ont_locations
+from back.mongodb.pon_com_models import ONTInfo, ONTLocation
+
+# Attempts at registering an ONT on the first free port, which a concurrent
+# registration may take in between
+ONT_REGISTRATION_ATTEMPTS = 5
+
+
+def occupied_positions(pon: PON) -> set[int]:
+    return {ont.position_in_pon for ont in pon.ont_list}
 
 
 def get_first_free_port(pm: PM) -> Tuple[PON, int]:
     for pon in pm.pon_list:
+        occupied = occupied_positions(pon)
         for i in range(0, pon.number_of_ports):
-            if not any(ont.position_in_pon == i for ont in pon.ont_list):
+            if i not in occupied:
                 return pon, i
     raise ValueError("No free port available")
 
@@ -20,7 +32,7 @@ def get_first_free_port(pm: PM) -> Tuple[PON, int]:
 def is_free_port(pon: PON, position_in_pon: int) -> bool:
     if position_in_pon >= pon.number_of_ports:
         return False
-    return not any(ont.position_in_pon == position_in_pon for ont in pon.ont_list)
+    return position_in_pon not in occupied_positions(pon)
 
 
 def position_in_pon_to_mec128_string(pon: PON, position_in_pon: int) -> str:
@@ -46,6 +58,47 @@ def mec128_string_to_position_in_pon(pm: PM, mec128_position: str) -> Tuple[PON,
     raise ValueError(f"Invalid mec128 position {mec128_position} (out of range)")
 
 
+def push_ont_update(pm_id: str, pon: PON, ont: ONT) -> dict:
+    """Arguments of an update (update_one or UpdateOne) adding an ONT to a
+    PON, which only matches the PM if the position in the PON and the serial
+    number are still free in it. The PON is picked with an array filter:
+    a positional `$` would be undefined, the query matching two array paths."""
+    return {
+        "filter": {
+            "_id": pm_id,
+            "pon_list": {
+                "$elemMatch": {
+                    "olt_interface": pon.olt_interface,
+                    "olt_id": pon.olt_id,
+                    "ont_list.position_in_pon": {"$ne": ont.position_in_pon},
+                }
+            },
+            "pon_list.ont_list.serial_number": {"$ne": ont.serial_number},
+        },
+        "update": {"$push": {"pon_list.$[pon].ont_list": ont.model_dump(mode="json")}},
+        "array_filters": [
+            {
+                "pon.olt_interface": pon.olt_interface,
+                "pon.olt_id": pon.olt_id,
+                "pon.ont_list.position_in_pon": {"$ne": ont.position_in_pon},
+            }
+        ],
+    }
+
+
+async def _push_ont(db: AsyncIOMotorDatabase, pm_id: str, pon: PON, ont: ONT) -> bool:
+    """Add an ONT to a PON, in a single write which only applies if its
+    position in the PON and its serial number are still free in the PM.
+    Returns whether the ONT was added."""
+    try:
+        result = await db.pms.update_one(**push_ont_update(pm_id, pon, ont))
+    except DuplicateKeyError as e:  # registered in another PM meanwhile
+        raise ValueError(
+            f"ONT with serial number {ont.serial_number} already registered"
+        ) from e
+    return result.modified_count == 1
+
+
 async def register_ont_for_new_ftth_adh(
     db: AsyncIOMotorDatabase,
     pm_id: str,
@@ -54,47 +107,50 @@ async def register_ont_for_new_ftth_adh(
     box: Box,
     position_mec128: str | None = None,
 ) -> ONTInfo:
-    # PM exists
-    if not (pm := PM.model_validate(await db.pms.find_one({"_id": pm_id}))):
-        raise ValueError(f"PM with id {pm_id} does not exist")
-
-    # ONT with this serial number not already registered
-    if await db.pms.find_one({"pon_list.ont_list.serial_number": serial_number}):
-        raise ValueError(f"ONT with serial number {serial_number} already registered")
-
-    # Not already an ONT with the same box_mac_address
-    if await db.pms.find_one({"pon_list.ont_list.box_mac_address": str(box.mac)}):
-        raise ValueError(
-            f"There is already an ONT registered for this box {str(box.mac)}"
-        )
-
-    position_pm: Tuple[PON, int] | None = None
+    for _ in range(ONT_REGISTRATION_ATTEMPTS):
+        # PM exists
+        if not (pm_dict := await db.pms.find_one({"_id": pm_id})):
+            raise ValueError(f"PM with id {pm_id} does not exist")
+        pm = PM.model_validate(pm_dict)
+
+        # ONT with this serial number not already registered
+        if await db.pms.find_one({"pon_list.ont_list.serial_number": serial_number}):
+            raise ValueError(
+                f"ONT with serial number {serial_number} already registered"
+            )
 
-    if position_mec128:
-        position_pm = mec128_string_to_position_in_pon(pm, position_mec128)
-        if not is_free_port(*position_pm):
+        # Not already an ONT with the same box_mac_address
+        if await db.pms.find_one({"pon_list.ont_list.box_mac_address": str(box.mac)}):
             raise ValueError(
-                f"Specified position in PM {position_mec128} is not available (already used)"
+                f"There is already an ONT registered for this box {str(box.mac)}"
             )
-    else:
-        position_pm = get_first_free_port(pm)
 
-    pon, position_in_pon = position_pm
-    new_ont = ONT(
-        serial_number=serial_number,
-        software_version=software_version,
-        box_mac_address=box.mac,
-        position_in_pon=position_in_pon,
-    )
+        position_pm: Tuple[PON, int] | None = None
+
+        if position_mec128:
+            position_pm = mec128_string_to_position_in_pon(pm, position_mec128)
+            if not is_free_port(*position_pm):
+                raise ValueError(
+                    f"Specified position in PM {position_mec128} is not available (already used)"
+                )
+        else:
+            position_pm = get_first_free_port(pm)
+
+        pon, position_in_pon = position_pm
+        new_ont = ONT(
+            serial_number=serial_number,
+            software_version=software_version,
+            box_mac_address=box.mac,
+            position_in_pon=position_in_pon,
+        )
 
-    await db.pms.update_one(
-        {
-            "_id": pm.id,
-            "pon_list.olt_interface": pon.olt_interface,
-            "pon_list.olt_id": pon.olt_id,
-        },
-        {"$push": {"pon_list.$.ont_list": new_ont.model_dump(mode="json")}},
-    )
+        # The checks above are run again if the position was taken meanwhile
+        if await _push_ont(db, pm.id, pon, new_ont):
+            break
+    else:
+        raise ValueError(
+            f"Could not register the ONT in PM {pm_id}, too many concurrent registrations"
+        )
 
     ont_info = ONTInfo(
         serial_number=serial_number,
@@ -110,48 +166,35 @@ async def register_ont_for_new_ftth_adh(
     return ont_info
 
 
-async def get_ont_from_box(db: AsyncIOMotorDatabase, box: Box) -> ONT | None:
-    pm = await db.pms.find_one({"pon_list.ont_list.box_mac_address": str(box.mac)})
-
-    if not pm:  # No PM has this ONT
-        return None
-
-    pm = PM.model_validate(pm)
+async def _get_ont_location_of_box(
+    db: AsyncIOMotorDatabase, box: Box, loader: Loader | None
+) -> ONTLocation | None:
+    if loader is not None:
+        return await loader.get_ont_of_box(box.mac)
 
-    ont = [
-        ont
-        for pon in pm.pon_list
-        for ont in pon.ont_list
-        if ont.box_mac_address == box.mac
-    ][0]
+    locations = await find_ont_locations(db, "box_mac_address", [str(box.mac)])
+    return locations[0] if locations else None
 
-    return ont
 
+async def _get_ont_location(
+    db: AsyncIOMotorDatabase, serial_number: str, loader: Loader | None
+) -> ONTLocation | None:
+    if loader is not None:
+        return await loader.get_ont(serial_number)
 
-async def get_ontinfo_from_box(db: AsyncIOMotorDatabase, box: Box) -> ONTInfo | None:
-    pm = await db.pms.find_one({"pon_list.ont_list.box_mac_address": str(box.mac)})
+    locations = await find_ont_locations(db, "serial_number", [serial_number])
+    return locations[0] if locations else None
 
-    if not pm:  # No PM has this ONT
-        return None
-
-    pm = PM.model_validate(pm)
-
-    ont = [
-        ont
-        for pon in pm.pon_list
-        for ont in pon.ont_list
-        if ont.box_mac_address == box.mac
-    ][0]
-
-    pon = next(filter(lambda p: ont in p.ont_list, pm.pon_list))
 
+def _ont_info(location: ONTLocation) -> ONTInfo:
+    ont, pon = location.ont, location.pon
     return ONTInfo(
         serial_number=ont.serial_number,
         software_version=ont.software_version,
         box_mac_address=str(EUI(ont.box_mac_address, dialect=mac_unix_expanded)),
         mec128_position=position_in_pon_to_mec128_string(pon, ont.position_in_pon),
         olt_interface=pon.olt_interface,
-        pm_description=pm.description,
+        pm_description=location.pm_description,
         position_in_subscriber_panel=ont.position_in_subscriber_panel,
         pon_rack=pon.rack,
         pon_tiroir=pon.tiroir,
@@ -160,55 +203,29 @@ async def get_ontinfo_from_box(db: AsyncIOMotorDatabase, box: Box) -> ONTInfo |
     )
 
 
-async def get_ont_from_serial_number(
-    db: AsyncIOMotorDatabase, serial_number: str
+async def get_ont_from_box(
+    db: AsyncIOMotorDatabase, box: Box, loader: Loader | None = None
 ) -> ONT | None:
-    pm = await db.pms.find_one({"pon_list.ont_list.serial_number": serial_number})
+    location = await _get_ont_location_of_box(db, box, loader)
+    return location.ont if location else None
 
-    if not pm:  # No PM has this ONT
-        return None
 
-    pm = PM.model_validate(pm)
+async def get_ontinfo_from_box(
+    db: AsyncIOMotorDatabase, box: Box, loader: Loader | None = None
+) -> ONTInfo | None:
+    location = await _get_ont_location_of_box(db, box, loader)
+    return _ont_info(location) if location else None
 
-    ont = [
-        ont
-        for pon in pm.pon_list
-        for ont in pon.ont_list
-        if ont.serial_number == serial_number
-    ][0]
 
-    return ont
+async def get_ont_from_serial_number(
+    db: AsyncIOMotorDatabase, serial_number: str, loader: Loader | None = None
+) -> ONT | None:
+    location = await _get_ont_location(db, serial_number, loader)
+    return location.ont if location else None
 
 
 async def get_ontinfo_from_serial_number(
-    db: AsyncIOMotorDatabase, serial_number: str
+    db: AsyncIOMotorDatabase, serial_number: str, loader: Loader | None = None
 ) -> ONTInfo | None:
-    pm = await db.pms.find_one({"pon_list.ont_list.serial_number": serial_number})
-
-    if not pm:  # No PM has this ONT
-        return None
-
-    pm = PM.model_validate(pm)
-
-    ont = [
-        ont
-        for pon in pm.pon_list
-        for ont in pon.ont_list
-        if ont.serial_number == serial_number
-    ][0]
-
-    pon = next(filter(lambda p: ont in p.ont_list, pm.pon_list))
-
-    return ONTInfo(
-        serial_number=ont.serial_number,
-        software_version=ont.software_version,
-        box_mac_address=str(EUI(ont.box_mac_address, dialect=mac_unix_expanded)),
-        mec128_position=position_in_pon_to_mec128_string(pon, ont.position_in_pon),
-        olt_interface=pon.olt_interface,
-        pm_description=pm.description,
-        position_in_subscriber_panel=ont.position_in_subscriber_panel,
-        pon_rack=pon.rack,
-        pon_tiroir=pon.tiroir,
-        operational_data=ont.operational_data,
-        configured_in_olt=ont.configured_in_olt,
-    )
+    location = await _get_ont_location(db, serial_number, loader)
+    return _ont_info(location) if location else None
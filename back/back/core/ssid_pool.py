@@ -0,0 +1,218 @@
+"""
+Allocation of the Wi-Fi SSIDs of the unets.
+
+New unets get the name of a chemical element. The SSIDs in use are read with
+a single indexed `distinct` query and the free ones are found in memory. The
+chosen SSID is then reserved atomically in the `ssid_reservations` collection
+(keyed by the SSID) until the unet holding it has been written, so that two
+concurrent provisionings cannot pick the same one. Reservations are dropped
+once the unet is written, and expire on their own thanks to a TTL index (see
+SSID_RESERVATION_TTL in back.mongodb.indexes) if the process stops in between.
+"""
+
+import random
+from datetime import datetime
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import DuplicateKeyError
+
+ELEMENT_SSIDS = (
+    "Rezel-Hydrogen",
+    "Rezel-Helium",
+    "Rezel-Lithium",
+    "Rezel-Beryllium",
+    "Rezel-Boron",
+    "Rezel-Carbon",
+    "Rezel-Nitrogen",
+    "Rezel-Oxygen",
+    "Rezel-Fluorine",
+    "Rezel-Neon",
+    "Rezel-Sodium",
+    "Rezel-Magnesium",
+    "Rezel-Aluminum",
+    "Rezel-Silicon",
+    "Rezel-Phosphorus",
+    "Rezel-Sulfur",
+    "Rezel-Chlorine",
+    "Rezel-Argon",
+    "Rezel-Potassium",
+    "Rezel-Calcium",
+    "Rezel-Scandium",
+    "Rezel-Titanium",
+    "Rezel-Vanadium",
+    "Rezel-Chromium",
+    "Rezel-Manganese",
+    "Rezel-Iron",
+    "Rezel-Cobalt",
+    "Rezel-Nickel",
+    "Rezel-Copper",
+    "Rezel-Zinc",
+    "Rezel-Gallium",
+    "Rezel-Germanium",
+    "Rezel-Arsenic",
+    "Rezel-Selenium",
+    "Rezel-Bromine",
+    "Rezel-Krypton",
+    "Rezel-Rubidium",
+    "Rezel-Strontium",
+    "Rezel-Yttrium",
+    "Rezel-Zirconium",
+    "Rezel-Niobium",
+    "Rezel-Molybdenum",
+    "Rezel-Technetium",
+    "Rezel-Ruthenium",
+    "Rezel-Rhodium",
+    "Rezel-Palladium",
+    "Rezel-Silver",
+    "Rezel-Cadmium",
+    "Rezel-Indium",
+    "Rezel-Tin",
+    "Rezel-Antimony",
+    "Rezel-Tellurium",
+    "Rezel-Iodine",
+    "Rezel-Xenon",
+    "Rezel-Cesium",
+    "Rezel-Barium",
+    "Rezel-Lanthanum",
+    "Rezel-Cerium",
+    "Rezel-Praseodymium",
+    "Rezel-Neodymium",
+    "Rezel-Promethium",
+    "Rezel-Samarium",
+    "Rezel-Europium",
+    "Rezel-Gadolinium",
+    "Rezel-Terbium",
+    "Rezel-Dysprosium",
+    "Rezel-Holmium",
+    "Rezel-Erbium",
+    "Rezel-Thulium",
+    "Rezel-Ytterbium",
+    "Rezel-Lutetium",
+    "Rezel-Hafnium",
+    "Rezel-Tantalum",
+    "Rezel-Tungsten",
+    "Rezel-Rhenium",
+    "Rezel-Osmium",
+    "Rezel-Iridium",
+    "Rezel-Platinum",
+    "Rezel-Gold",
+    "Rezel-Mercury",
+    "Rezel-Thallium",
+    "Rezel-Lead",
+    "Rezel-Bismuth",
+    "Rezel-Polonium",
+    "Rezel-Astatine",
+    "Rezel-Radon",
+    "Rezel-Francium",
+    "Rezel-Radium",
+    "Rezel-Actinium",
+    "Rezel-Thorium",
+    "Rezel-Protactinium",
+    "Rezel-Uranium",
+    "Rezel-Neptunium",
+    "Rezel-Plutonium",
+    "Rezel-Americium",
+    "Rezel-Curium",
+    "Rezel-Berkelium",
+    "Rezel-Californium",
+    "Rezel-Einsteinium",
+    "Rezel-Fermium",
+    "Rezel-Mendelevium",
+    "Rezel-Nobelium",
+    "Rezel-Lawrencium",
+    "Rezel-Rutherfordium",
+    "Rezel-Dubnium",
+    "Rezel-Seaborgium",
+    "Rezel-Bohrium",
+    "Rezel-Hassium",
+    "Rezel-Meitnerium",
+    "Rezel-Darmstadtium",
+    "Rezel-Roentgenium",
+    "Rezel-Copernicium",
+    "Rezel-Nihonium",
+    "Rezel-Flerovium",
+    "Rezel-Moscovium",
+    "Rezel-Livermorium",
+    "Rezel-Tennessine",
+    "Rezel-Oganesson",
+)
+
+
+async def get_used_ssids(db: AsyncIOMotorDatabase) -> set[str]:
+    """Return the SSIDs of every unet, with a single indexed query."""
+    return set(await db.boxes.distinct("unets.wifi.ssid"))
+
+
+async def _get_unavailable_ssids(db: AsyncIOMotorDatabase) -> set[str]:
+    reserved = await db.ssid_reservations.distinct("_id")
+    return await get_used_ssids(db) | set(reserved)
+
+
+async def reserve_ssid(db: AsyncIOMotorDatabase, ssid: str) -> bool:
+    """Atomically reserve an SSID. Returns False if it is already reserved."""
+    try:
+        await db.ssid_reservations.insert_one(
+            {"_id": ssid, "reserved_at": datetime.now()}
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+async def release_ssid_reservations(db: AsyncIOMotorDatabase, ssids: list[str]) -> None:
+    """Drop the reservations once the unets holding the SSIDs have been
+    written (or could not be)."""
+    await db.ssid_reservations.delete_many({"_id": {"$in": ssids}})
+
+
+async def allocate_ssids(db: AsyncIOMotorDatabase, count: int) -> list[str]:
+    """Reserve and return `count` SSIDs that are not already assigned.
+    When no element name is left, a name based on the current time is used."""
+    candidates = list(set(ELEMENT_SSIDS) - await _get_unavailable_ssids(db))
+    random.shuffle(candidates)
+
+    ssids: list[str] = []
+    for ssid in candidates:
+        if len(ssids) == count:
+            break
+        # Only fails if someone reserved it since it was read
+        if await reserve_ssid(db, ssid):
+            ssids.append(ssid)
+
+    while len(ssids) < count:
+        ssid = "Rezel-" + str(datetime.now().timestamp())
+        if await reserve_ssid(db, ssid):
+            ssids.append(ssid)
+
+    return ssids
+
+
+async def allocate_ssid(db: AsyncIOMotorDatabase) -> str:
+    """Reserve and return an SSID that is not already assigned."""
+    return (await allocate_ssids(db, 1))[0]
+
+
+async def is_ssid_available(
+    db: AsyncIOMotorDatabase, ssid: str, unet_id: str | None = None
+) -> bool:
+    """Whether an SSID can be given to a unet: no other unet has it
+    and it is not reserved for a unet being created.
+
+    Args:
+        * ssid (str): the requested SSID
+        * unet_id (str | None): the unet asking for it, which may already have it"""
+    if await db.ssid_reservations.find_one({"_id": ssid}, {"_id": 1}):
+        return False
+
+    nb = await db.boxes.count_documents(
+        {
+            "unets": {
+                "$elemMatch": {
+                    "wifi.ssid": ssid,
+                    "unet_id": {"$ne": unet_id},
+                }
+            }
+        },
+        limit=1,
+    )
+    return nb == 0
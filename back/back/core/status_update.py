@@ -15,6 +15,7 @@ from pymongo import ReturnDocument
 
 from back.core.dolibarr import create_dolibarr_member_subscription, create_dolibarr_user
 from back.core.hermes import get_box_from_user, get_users_on_box
+from back.core.ipam import MongoIpam
 from back.core.ipam_logging import IpamLog, create_log
 from back.core.pon import get_ont_from_box
 from back.env import ENV
@@ -27,6 +28,7 @@ from back.messaging.mails import (
     send_satisfaction_survey,
 )
 from back.messaging.matrix import send_matrix_message
+from back.mongodb.db import WITHOUT_PING_HISTORY
 
 
 class StatusUpdateEffect:
@@ -607,7 +609,9 @@ async def delete_unet_of_wifi_adherent(user: User, db: AsyncIOMotorDatabase) ->
     ):
         raise ValueError("User has no membership or no unetid or not a WIFI membership")
 
-    boxdict = await db.boxes.find_one({"unets.unet_id": user.membership.unetid})
+    boxdict = await db.boxes.find_one(
+        {"unets.unet_id": user.membership.unetid}, WITHOUT_PING_HISTORY
+    )
     if not boxdict:
         raise ValueError("User has no box")
     box = Box.model_validate(boxdict)
@@ -629,6 +633,7 @@ async def delete_unet_of_wifi_adherent(user: User, db: AsyncIOMotorDatabase) ->
     deleted_unet = next(
         unet for unet in box.unets if unet.unet_id == user.membership.unetid
     )
+    await MongoIpam(db).release_lease(deleted_unet.unet_id)
     await create_log(
         db,
         IpamLog(
@@ -0,0 +1,84 @@
+"""
+Allocation of unet ids.
+
+Every unet id ever handed out has a document in the `unet_ids` collection,
+keyed by the id itself. Allocating an id is a single insert: the unique `_id`
+index makes it fail on a collision (even with a concurrent provisioning), in
+which case another random id is tried.
+"""
+
+import logging
+import random
+import string
+from datetime import datetime
+
+from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from back.mongodb.db import durable
+
+logger = logging.getLogger(__name__)
+
+
+UNET_ID_LENGTH = 8
+UNET_ID_CHARS = string.ascii_lowercase + string.digits
+
+
+def _unet_ids(db: AsyncIOMotorDatabase) -> AsyncIOMotorCollection:
+    return durable(db.unet_ids)
+
+
+def _random_unet_id() -> str:
+    return "".join(random.choice(UNET_ID_CHARS) for _ in range(UNET_ID_LENGTH))
+
+
+async def allocate_unet_id(db: AsyncIOMotorDatabase) -> str:
+    """Allocate a new unet id, never returned before."""
+    while True:
+        unet_id = _random_unet_id()
+        try:
+            await _unet_ids(db).insert_one(
+                {"_id": unet_id, "allocated_at": datetime.now()}
+            )
+        except DuplicateKeyError:
+            continue
+        return unet_id
+
+
+async def allocate_unet_ids(db: AsyncIOMotorDatabase, count: int) -> list[str]:
+    """Allocate `count` new unet ids, with one insert per attempt."""
+    unet_ids: list[str] = []
+    while len(unet_ids) < count:
+        candidates = list({_random_unet_id() for _ in range(count - len(unet_ids))})
+        now = datetime.now()
+        try:
+            await _unet_ids(db).insert_many(
+                [{"_id": unet_id, "allocated_at": now} for unet_id in candidates],
+                ordered=False,
+            )
+        except BulkWriteError as e:
+            for error in e.details["writeErrors"]:
+                if error["code"] != 11000:  # duplicate key
+                    raise
+            failed = {error["index"] for error in e.details["writeErrors"]}
+            candidates = [c for i, c in enumerate(candidates) if i not in failed]
+        unet_ids += candidates
+    return unet_ids
+
+
+async def sync_unet_ids(db: AsyncIOMotorDatabase) -> None:
+    """Record the ids of the existing unets, e.g. the ones created
+    before the `unet_ids` collection existed. Run at startup."""
+    now = datetime.now()
+    operations = [
+        UpdateOne(
+            {"_id": unet_id},
+            {"$setOnInsert": {"allocated_at": now}},
+            upsert=True,
+        )
+        for unet_id in await db.boxes.distinct("unets.unet_id")
+    ]
+    if operations:
+        await _unet_ids(db).bulk_write(operations, ordered=False)
+        logger.info("unet_ids: %d existing unet ids synced", len(operations))
@@ -51,6 +51,7 @@ class Env:  # pylint: disable=too-many-instance-attributes
 
     # Logs
     log_level: str
+    slow_request_threshold_ms: int
 
     # OIDC
     oidc_issuer: str
@@ -74,6 +75,15 @@ class Env:  # pylint: disable=too-many-instance-attributes
     # MongoDB
     db_uri: str
     db_name: str
+    # Client options, left to the URI or the driver defaults when not set
+    db_max_pool_size: int | None
+    db_min_pool_size: int | None
+    db_max_idle_time_ms: int | None
+    db_compressors: str | None
+    db_server_selection_timeout_ms: int | None
+    db_connect_timeout_ms: int | None
+    db_socket_timeout_ms: int | None
+    db_read_preference: str | None
 
     charon_url: str
 
@@ -109,6 +119,8 @@ class Env:  # pylint: disable=too-many-instance-attributes
 
     box_ula_prefix: IPv6Network
 
+    ipam_quarantine_days: int
+
     helloasso_wifi_price: int
     helloasso_ftth_price: int
     helloasso_wifi_price_scholarship: int
@@ -129,6 +141,9 @@ class Env:  # pylint: disable=too-many-instance-attributes
         load_dotenv(f".env.{self.deploy_env}")
 
         self.log_level = get_or_none("LOG_LEVEL") or "INFO"
+        self.slow_request_threshold_ms = int(
+            get_or_default("SLOW_REQUEST_THRESHOLD_MS", "1000")
+        )
 
         self.oidc_issuer = get_or_raise("OIDC_ISSUER")
         self.oidc_client_id = get_or_raise("OIDC_CLIENT_ID")
@@ -149,6 +164,28 @@ class Env:  # pylint: disable=too-many-instance-attributes
 
         self.db_uri = get_or_raise("DB_URI")
         self.db_name = get_or_raise("DB_NAME")
+        _db_max_pool_size = get_or_none("DB_MAX_POOL_SIZE")
+        self.db_max_pool_size = int(_db_max_pool_size) if _db_max_pool_size else None
+        _db_min_pool_size = get_or_none("DB_MIN_POOL_SIZE")
+        self.db_min_pool_size = int(_db_min_pool_size) if _db_min_pool_size else None
+        _db_max_idle_time = get_or_none("DB_MAX_IDLE_TIME_MS")
+        self.db_max_idle_time_ms = int(_db_max_idle_time) if _db_max_idle_time else None
+        # e.g. "zstd,snappy,zlib", zstd and snappy need their python packages
+        self.db_compressors = get_or_none("DB_COMPRESSORS")
+        _db_selection_timeout = get_or_none("DB_SERVER_SELECTION_TIMEOUT_MS")
+        self.db_server_selection_timeout_ms = (
+            int(_db_selection_timeout) if _db_selection_timeout else None
+        )
+        _db_connect_timeout = get_or_none("DB_CONNECT_TIMEOUT_MS")
+        self.db_connect_timeout_ms = (
+            int(_db_connect_timeout) if _db_connect_timeout else None
+        )
+        _db_socket_timeout = get_or_none("DB_SOCKET_TIMEOUT_MS")
+        self.db_socket_timeout_ms = (
+            int(_db_socket_timeout) if _db_socket_timeout else None
+        )
+        # e.g. "primary", "primaryPreferred", "secondaryPreferred"
+        self.db_read_preference = get_or_none("DB_READ_PREFERENCE")
 
         self.matrix_user = get_or_raise("MATRIX_USER")
         self.matrix_password = get_or_raise("MATRIX_PASSWORD")
@@ -201,6 +238,8 @@ class Env:  # pylint: disable=too-many-instance-attributes
 
         self.box_ula_prefix = IPv6Network(get_or_raise("BOX_ULA_PREFIX"))
 
+        self.ipam_quarantine_days = int(get_or_default("IPAM_QUARANTINE_DAYS", "30"))
+
         self.helloasso_wifi_price = int(get_or_default("HELLOASSO_WIFI_PRICE", "1000"))
         self.helloasso_ftth_price = int(get_or_default("HELLOASSO_FTTH_PRICE", "2000"))
         self.helloasso_wifi_price_scholarship = int(
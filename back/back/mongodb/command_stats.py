@@ -0,0 +1,90 @@
+"""
+Accounting of the MongoDB commands run for each HTTP request.
+
+COMMAND_STATS is registered on the client by init_db. While a request is
+handled (see back.server.timing), track_commands puts a RequestDbStats in a
+context variable. Motor runs the driver in threads with a copy of the context
+of the caller, so the listener adds each command to the stats of the request
+which sent it. Commands sent outside of a request (e.g. by the background
+tasks) are not counted.
+"""
+
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+from pymongo import monitoring
+
+
+class RequestDbStats:
+    """Commands sent, documents returned and time spent in MongoDB."""
+
+    def __init__(self) -> None:
+        # Commands of a request may run concurrently, e.g. with asyncio.gather
+        self._lock = threading.Lock()
+        self.commands: Counter[str] = Counter()
+        self.documents = 0
+        self.duration = 0.0  # seconds
+
+    @property
+    def command_count(self) -> int:
+        return sum(self.commands.values())
+
+    def add(self, command_name: str, duration: float, documents: int) -> None:
+        with self._lock:
+            self.commands[command_name] += 1
+            self.documents += documents
+            self.duration += duration
+
+
+_current_stats: ContextVar[RequestDbStats | None] = ContextVar(
+    "request_db_stats", default=None
+)
+
+
+@contextmanager
+def track_commands() -> Iterator[RequestDbStats]:
+    """Count the commands sent in this context, until exiting it."""
+    stats = RequestDbStats()
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+
+
+def _returned_documents(reply: dict) -> int:
+    cursor = reply.get("cursor")
+    if cursor is not None:  # find, aggregate, getMore
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", ())))
+    if "value" in reply:  # findAndModify
+        return 0 if reply["value"] is None else 1
+    if "values" in reply:  # distinct
+        return len(reply["values"])
+    return 0
+
+
+class CommandStatsListener(monitoring.CommandListener):
+    """Adds the commands to the stats of the current request, if any."""
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.add(
+                event.command_name,
+                event.duration_micros / 1e6,
+                _returned_documents(event.reply),
+            )
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.add(event.command_name, event.duration_micros / 1e6, 0)
+
+
+COMMAND_STATS = CommandStatsListener()
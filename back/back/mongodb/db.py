@@ -1,10 +1,22 @@
 import logging
-from typing import Annotated, Optional
+from typing import Annotated, Any, Optional
 
 from fastapi import Depends
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from motor.motor_asyncio import (
+    AsyncIOMotorClient,
+    AsyncIOMotorCollection,
+    AsyncIOMotorDatabase,
+)
+from pymongo import ReadPreference, WriteConcern
+from pymongo.read_concern import ReadConcern
 
 from back.env import ENV
+from back.mongodb.command_stats import COMMAND_STATS
+from back.mongodb.indexes import ensure_indexes
+from back.mongodb.pool_stats import POOL_STATS
+
+# Projection of the boxes leaving out the ping history (see back.core.box_pings)
+WITHOUT_PING_HISTORY = {"ping_history": {"$slice": 0}}
 
 database: Optional[AsyncIOMotorDatabase] = None
 db_client: Optional[AsyncIOMotorClient] = None
@@ -23,12 +35,58 @@ GetDatabase = Annotated[
 ]
 
 
-def init_db():
+def get_client() -> AsyncIOMotorClient:
+    if db_client is None:
+        raise ValueError("Database is not connected.")
+
+    return db_client
+
+
+def client_options() -> dict[str, Any]:
+    """Options of the client set in the environment. Those which are not set
+    are left to the URI or to the driver defaults."""
+    options = {
+        "maxPoolSize": ENV.db_max_pool_size,
+        "minPoolSize": ENV.db_min_pool_size,
+        "maxIdleTimeMS": ENV.db_max_idle_time_ms,
+        "compressors": ENV.db_compressors,
+        "serverSelectionTimeoutMS": ENV.db_server_selection_timeout_ms,
+        "connectTimeoutMS": ENV.db_connect_timeout_ms,
+        "socketTimeoutMS": ENV.db_socket_timeout_ms,
+        "readPreference": ENV.db_read_preference,
+    }
+    return {key: value for key, value in options.items() if value is not None}
+
+
+def listing(collection: AsyncIOMotorCollection) -> AsyncIOMotorCollection:
+    """The collection for admin listings, which may be slightly out of date:
+    reads go to a secondary when there is one, to spare the primary."""
+    return collection.with_options(
+        read_preference=ReadPreference.SECONDARY_PREFERRED,
+        read_concern=ReadConcern("local"),
+    )
+
+
+def durable(collection: AsyncIOMotorCollection) -> AsyncIOMotorCollection:
+    """The collection for allocations (addresses, unet ids), whose writes must
+    not be rolled back by a failover and whose reads must not see writes which
+    could be."""
+    return collection.with_options(
+        read_preference=ReadPreference.PRIMARY,
+        read_concern=ReadConcern("majority"),
+        write_concern=WriteConcern("majority"),
+    )
+
+
+async def init_db():
     logging.info("Connecting to mongo...")
     global database, db_client
-    db_client = AsyncIOMotorClient(ENV.db_uri)
+    db_client = AsyncIOMotorClient(
+        ENV.db_uri, event_listeners=[POOL_STATS, COMMAND_STATS], **client_options()
+    )
     database = db_client.get_database(ENV.db_name)
     logging.info("Connected to mongo.")
+    await ensure_indexes(database)
 
 
 def close_db():
@@ -0,0 +1,63 @@
+from datetime import datetime
+from typing import Any, Optional
+
+from common_models.base import RezelBaseModel
+from pydantic import Field
+
+
+class IndexUsage(RezelBaseModel):
+    collection: str = Field(...)
+    name: str = Field(...)
+    key: dict[str, Any] = Field(...)
+    declared: bool = Field(...)  # in back.mongodb.indexes.INDEXES
+    present: bool = Field(...)
+    ops: int = Field(...)
+    since: Optional[datetime] = Field(None)
+
+
+class QueryPlan(RezelBaseModel):
+    name: str = Field(...)
+    collection: str = Field(...)
+    query: dict[str, Any] = Field(...)
+    stages: list[str] = Field(...)
+    uses_index: bool = Field(...)
+    keys_examined: int = Field(...)
+    docs_examined: int = Field(...)
+    execution_time_ms: int = Field(...)
+
+
+class SlowQuery(RezelBaseModel):
+    timestamp: datetime = Field(...)
+    namespace: str = Field(...)
+    operation: str = Field(...)
+    duration_ms: int = Field(...)
+    plan_summary: Optional[str] = Field(None)
+    keys_examined: Optional[int] = Field(None)
+    docs_examined: Optional[int] = Field(None)
+
+
+class ConnectionPoolStats(RezelBaseModel):
+    address: str = Field(...)
+    max_pool_size: int = Field(...)
+    open_connections: int = Field(...)
+    checked_out: int = Field(...)
+    max_checked_out: int = Field(...)  # since the start of the server
+    waiting: int = Field(...)
+    checkouts: int = Field(...)
+    checkout_failures: int = Field(...)
+    average_wait_ms: float = Field(...)
+    max_wait_ms: float = Field(...)
+    cleared: int = Field(...)
+
+
+class RouteDbStats(RezelBaseModel):
+    route: str = Field(...)
+    requests: int = Field(...)
+    commands: int = Field(...)
+    average_commands: float = Field(...)
+    max_commands: int = Field(...)
+    documents: int = Field(...)
+    db_time_ms: float = Field(...)
+    average_db_time_ms: float = Field(...)
+    average_time_ms: float = Field(...)
+    max_time_ms: float = Field(...)
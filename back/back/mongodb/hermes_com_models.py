@@ -0,0 +1,31 @@
+from datetime import datetime
+from typing import Optional
+
+from common_models.base import RezelBaseModel
+from common_models.hermes_models import Box
+from common_models.pon_models import ONT
+from common_models.user_models import User
+from pydantic import Field
+
+
+class EnrichedBox(RezelBaseModel):
+    box: Box = Field(...)
+    users: list[User] = Field(...)
+    ont: Optional[ONT] = Field(None)
+    unet_count: int = Field(...)
+
+
+class PingStats(RezelBaseModel):
+    start: datetime = Field(...)
+    pings: int = Field(...)
+    successes: int = Field(...)
+    success_rate: float = Field(...)
+
+
+class BoxSummary(RezelBaseModel):
+    """Partial box, read with a projection (see repository.Repository.partial)."""
+
+    mac: str = Field(...)
+    type: str = Field(...)
+    ptah_profile: str = Field(...)
+    main_unet_id: str = Field(...)
@@ -0,0 +1,226 @@
+"""
+Indexes of the collections, created at startup (see init_db).
+
+Every index the application relies on is declared in INDEXES, so that a fresh
+database is usable as is and that missing indexes show up in the report of
+`GET /db/indexes`. Creating an index which already exists is a no-op. An index
+which can't be created (e.g. a unique index over duplicated values) is logged
+and skipped, so that the application still starts.
+
+The `box_pings` time-series collection creates its own index along with the
+collection, see ensure_box_pings_collection.
+"""
+
+import logging
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from back.mongodb.db_com_models import IndexUsage, QueryPlan, SlowQuery
+
+logger = logging.getLogger(__name__)
+
+_IS_STRING = {"$type": "string"}
+
+# Lifetime of the SSID reservations, see back.core.ssid_pool
+SSID_RESERVATION_TTL = 600  # seconds
+
+INDEXES: dict[str, list[IndexModel]] = {
+    "users": [
+        IndexModel([("membership.unetid", ASCENDING)]),
+        IndexModel([("membership.status", ASCENDING)]),
+        IndexModel(
+            [("dolibarr_id", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"dolibarr_id": {"$type": "number"}},
+        ),
+    ],
+    "boxes": [
+        IndexModel([("mac", ASCENDING)], unique=True),
+        IndexModel(
+            [("main_unet_id", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"main_unet_id": _IS_STRING},
+        ),
+        IndexModel([("unets.unet_id", ASCENDING)]),
+        IndexModel([("unets.wifi.ssid", ASCENDING)]),
+    ],
+    "pms": [
+        IndexModel(
+            [("pon_list.ont_list.serial_number", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"pon_list.ont_list.serial_number": _IS_STRING},
+        ),
+        IndexModel([("pon_list.ont_list.box_mac_address", ASCENDING)]),
+    ],
+    "partial_refunds": [
+        IndexModel([("user_id", ASCENDING), ("paid", ASCENDING)]),
+    ],
+    "ipam_logs": [
+        IndexModel([("from_date", ASCENDING)]),
+    ],
+    "ipam_leases": [
+        IndexModel(
+            [("unet_id", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"unet_id": _IS_STRING},
+        ),
+        # Released leases keep their prefix, which may be derived again from
+        # another address (see derive_ipv6): only the leased ones are unique
+        IndexModel(
+            [("ipv6_prefix", ASCENDING)],
+            name="ipv6_prefix_leased",
+            unique=True,
+            partialFilterExpression={"unet_id": _IS_STRING},
+        ),
+        IndexModel([("ipv6_prefix", ASCENDING), ("released_at", DESCENDING)]),
+    ],
+    "ssid_reservations": [
+        IndexModel(
+            [("reserved_at", ASCENDING)], expireAfterSeconds=SSID_RESERVATION_TTL
+        ),
+    ],
+}
+
+# Indexes replaced by one of INDEXES, dropped by ensure_indexes
+LEGACY_INDEXES: dict[str, list[str]] = {
+    "ipam_leases": ["ipv6_prefix_1"],  # unique over the released leases too
+}
+
+# Representative lookups of the hot paths, whose plans are reported by
+# get_query_plans. The values don't need to exist, only the plan matters.
+HOT_QUERIES: dict[str, tuple[str, dict]] = {
+    "user_by_unetid": ("users", {"membership.unetid": ""}),
+    "user_by_dolibarr_id": ("users", {"dolibarr_id": 0}),
+    "users_by_status": ("users", {"membership.status": ""}),
+    "box_by_mac": ("boxes", {"mac": ""}),
+    "box_by_main_unet_id": ("boxes", {"main_unet_id": ""}),
+    "box_by_unet_id": ("boxes", {"unets.unet_id": ""}),
+    "box_by_ssid": ("boxes", {"unets.wifi.ssid": ""}),
+    "pm_by_ont_serial_number": ("pms", {"pon_list.ont_list.serial_number": ""}),
+    "pm_by_box_mac": ("pms", {"pon_list.ont_list.box_mac_address": ""}),
+    "partial_refunds_by_user": ("partial_refunds", {"user_id": "", "paid": False}),
+    "ipam_logs_by_date": ("ipam_logs", {"from_date": {"$gte": 0, "$lte": 0}}),
+    "lease_by_unet_id": ("ipam_leases", {"unet_id": ""}),
+}
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase) -> None:
+    """Drop the LEGACY_INDEXES, and create the indexes declared in INDEXES
+    which don't exist yet."""
+    for collection, names in LEGACY_INDEXES.items():
+        existing = await db[collection].index_information()
+        for name in names:
+            if name in existing:
+                logger.info("Dropping legacy index %s on %s", name, collection)
+                await db[collection].drop_index(name)
+
+    for collection, indexes in INDEXES.items():
+        for index in indexes:
+            try:
+                await db[collection].create_indexes([index])
+            except OperationFailure as e:
+                logger.error(
+                    "Could not create index %s on %s: %s",
+                    index.document["name"],
+                    collection,
+                    e,
+                )
+
+
+async def get_index_stats(db: AsyncIOMotorDatabase) -> list[IndexUsage]:
+    """Usage of the indexes of the collections in INDEXES since the last restart
+    of the server, along with the declared indexes which are missing."""
+    report: list[IndexUsage] = []
+    for collection, indexes in INDEXES.items():
+        declared = {index.document["name"] for index in indexes}
+        present = set()
+        async for stats in db[collection].aggregate([{"$indexStats": {}}]):
+            present.add(stats["name"])
+            report.append(
+                IndexUsage(
+                    collection=collection,
+                    name=stats["name"],
+                    key=dict(stats["key"]),
+                    declared=stats["name"] in declared,
+                    present=True,
+                    ops=stats["accesses"]["ops"],
+                    since=stats["accesses"]["since"],
+                )
+            )
+        report.extend(
+            IndexUsage(
+                collection=collection,
+                name=index.document["name"],
+                key=dict(index.document["key"]),
+                declared=True,
+                present=False,
+                ops=0,
+            )
+            for index in indexes
+            if index.document["name"] not in present
+        )
+    return report
+
+
+def _plan_stages(plan: dict) -> list[str]:
+    """Stages of a query plan, from the last one to the first one."""
+    stages = [plan["stage"]]
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child is not None:
+            stages.extend(_plan_stages(child))
+    return stages
+
+
+async def get_query_plans(db: AsyncIOMotorDatabase) -> list[QueryPlan]:
+    """Explain the queries of HOT_QUERIES, to spot the ones no longer using
+    an index."""
+    plans = []
+    for name, (collection, query) in HOT_QUERIES.items():
+        explain = await db.command(
+            "explain",
+            {"find": collection, "filter": query},
+            verbosity="executionStats",
+        )
+        winning_plan = explain["queryPlanner"]["winningPlan"]
+        # Plans run by the slot based engine are wrapped in a queryPlan
+        stages = _plan_stages(winning_plan.get("queryPlan", winning_plan))
+        stats = explain["executionStats"]
+        plans.append(
+            QueryPlan(
+                name=name,
+                collection=collection,
+                query=query,
+                stages=stages,
+                uses_index="COLLSCAN" not in stages,
+                keys_examined=stats["totalKeysExamined"],
+                docs_examined=stats["totalDocsExamined"],
+                execution_time_ms=stats["executionTimeMillis"],
+            )
+        )
+    return plans
+
+
+async def get_slow_queries(
+    db: AsyncIOMotorDatabase, min_duration_ms: int, limit: int
+) -> list[SlowQuery]:
+    """Most recent operations recorded by the database profiler which took at
+    least `min_duration_ms`. Empty unless profiling is enabled on the database
+    (e.g. `db.setProfilingLevel(1, { slowms: 100 })`)."""
+    return [
+        SlowQuery(
+            timestamp=operation["ts"],
+            namespace=operation["ns"],
+            operation=operation["op"],
+            duration_ms=operation["millis"],
+            plan_summary=operation.get("planSummary"),
+            keys_examined=operation.get("keysExamined"),
+            docs_examined=operation.get("docsExamined"),
+        )
+        async for operation in db.system.profile.find(
+            {"millis": {"$gte": min_duration_ms}}
+        )
+        .sort("ts", -1)
+        .limit(limit)
+    ]
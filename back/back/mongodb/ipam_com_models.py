@@ -0,0 +1,60 @@
+from datetime import datetime
+from ipaddress import IPv4Address, IPv4Network, IPv6Network
+from typing import Optional
+
+from common_models.base import RezelBaseModel
+from common_models.hermes_models import Box
+from common_models.user_models import User
+from pydantic import Field
+
+
+class IPv4NetworkUsage(RezelBaseModel):
+    network: IPv4Network = Field(...)
+    vlan: int = Field(...)
+    from_telecom: bool = Field(...)
+    size: int = Field(...)
+    reserved: int = Field(...)
+    used: int = Field(...)
+    quarantined: int = Field(...)
+    free: int = Field(...)
+    largest_free_block: int = Field(...)
+
+
+class IPv4UsageTotals(RezelBaseModel):
+    size: int = Field(0)
+    reserved: int = Field(0)
+    used: int = Field(0)
+    quarantined: int = Field(0)
+    free: int = Field(0)
+    largest_free_block: int = Field(0)
+
+
+class IPAMUsage(RezelBaseModel):
+    networks: list[IPv4NetworkUsage] = Field(...)
+    telecom: IPv4UsageTotals = Field(...)
+    non_telecom: IPv4UsageTotals = Field(...)
+
+
+class IPAMLookup(RezelBaseModel):
+    ipv4: IPv4Address = Field(...)
+    ipv6_prefix: IPv6Network = Field(...)
+    unet_id: Optional[str] = Field(None)
+    released_at: Optional[datetime] = Field(None)
+    box: Optional[Box] = Field(None)
+    user: Optional[User] = Field(None)
+
+
+class IPAMAuditIssue(RezelBaseModel):
+    kind: str = Field(...)
+    detail: str = Field(...)
+    unet_id: Optional[str] = Field(None)
+    box_mac: Optional[str] = Field(None)
+
+
+class IPAMAuditReport(RezelBaseModel):
+    started_at: datetime = Field(...)
+    finished_at: datetime = Field(...)
+    unets_checked: int = Field(...)
+    issue_counts: dict[str, int] = Field(...)
+    issues: list[IPAMAuditIssue] = Field(...)
+    truncated: bool = Field(...)
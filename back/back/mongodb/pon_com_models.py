@@ -2,7 +2,7 @@ import re
 from typing import Optional
 
 from common_models.base import RezelBaseModel
-from common_models.pon_models import ONTOperationalData
+from common_models.pon_models import ONT, ONTOperationalData, PON
 from pydantic import AliasChoices, Field, field_validator
 
 
@@ -41,3 +41,73 @@ class RegisterONT(RezelBaseModel):
             raise ValueError("Invalid position position PM (should match /[A-Z][1-8]/)")
 
         return v
+
+
+class ONTLocation(RezelBaseModel):
+    """An ONT along with the PM and PON it is in (without their other ONTs)."""
+
+    pm_id: str = Field(...)
+    pm_description: str = Field(...)
+    pon: PON = Field(...)
+    ont: ONT = Field(...)
+
+
+class PONCapacity(RezelBaseModel):
+    olt_id: str = Field(...)
+    olt_interface: str = Field(...)
+    rack: int = Field(...)
+    tiroir: int = Field(...)
+    ports: int = Field(...)
+    used: int = Field(...)
+    free: int = Field(...)
+    # Serial number of the ONT on each MEC128 position, None if free
+    occupancy: dict[str, Optional[str]] = Field(...)
+
+
+class PMCapacity(RezelBaseModel):
+    id: str = Field(...)
+    description: str = Field(...)
+    ports: int = Field(...)
+    used: int = Field(...)
+    free: int = Field(...)
+    pons: list[PONCapacity] = Field(...)
+
+
+class PMTopology(RezelBaseModel):
+    pms: list[PMCapacity] = Field(...)
+    ports: int = Field(...)
+    used: int = Field(...)
+    free: int = Field(...)
+    # Number of ONTs by software version
+    software_versions: dict[str, int] = Field(...)
+
+
+class BulkRegisterONT(RegisterONT):
+    box_mac_address: str = Field(...)
+
+
+class ONTReconciliationRequest(RezelBaseModel):
+    onts: list[BulkRegisterONT] = Field(default=[])
+    # Output of GET /net/get-all-ont-summary
+    olt_summary: Optional[str] = Field(None)
+    # Fetch the summary from Charon instead
+    fetch_olt_summary: bool = Field(False)
+    register_in_olt: bool = Field(True)
+
+
+class ONTReconciliationResult(RezelBaseModel):
+    serial_number: str = Field(...)
+    status: str = Field(...)  # see back.core.ont_reconciliation
+    detail: Optional[str] = Field(None)
+    mec128_position: Optional[str] = Field(None)
+
+
+class ONTReconciliationReport(RezelBaseModel):
+    results: list[ONTReconciliationResult] = Field(...)
+    status_counts: dict[str, int] = Field(...)
+    writes: int = Field(...)
+    registered_in_olt: list[str] = Field(default=[])
+    olt_registration_failures: list[str] = Field(default=[])
+    # Only with an OLT summary
+    missing_in_olt: list[str] = Field(default=[])
+    unknown_in_db: list[str] = Field(default=[])
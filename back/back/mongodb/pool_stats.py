@@ -0,0 +1,126 @@
+"""
+Statistics of the MongoDB connection pools.
+
+POOL_STATS is registered on the client by init_db and counts, for the pool of
+each server, the open and checked out connections and how long requests wait
+for one. Requests waiting or a peak of checked out connections close to the
+maximum size mean DB_MAX_POOL_SIZE is too small for the load.
+
+The events are emitted by the threads running the driver, hence the lock.
+"""
+
+import threading
+
+from pymongo import monitoring
+
+from back.mongodb.db_com_models import ConnectionPoolStats
+
+
+class _PoolCounters:
+    def __init__(self) -> None:
+        self.open_connections = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.waiting = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.total_wait = 0.0  # seconds
+        self.max_wait = 0.0  # seconds
+        self.cleared = 0
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Counts the connections of the pools, see get_pool_stats."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pools: dict[str, _PoolCounters] = {}
+
+    def _counters(self, address: tuple[str, int]) -> _PoolCounters:
+        return self._pools.setdefault(f"{address[0]}:{address[1]}", _PoolCounters())
+
+    def pool_created(self, event: monitoring.PoolCreatedEvent) -> None:
+        with self._lock:
+            self._counters(event.address)
+
+    def pool_ready(self, event: monitoring.PoolReadyEvent) -> None:
+        pass
+
+    def pool_cleared(self, event: monitoring.PoolClearedEvent) -> None:
+        with self._lock:
+            self._counters(event.address).cleared += 1
+
+    def pool_closed(self, event: monitoring.PoolClosedEvent) -> None:
+        with self._lock:
+            self._pools.pop(f"{event.address[0]}:{event.address[1]}", None)
+
+    def connection_created(self, event: monitoring.ConnectionCreatedEvent) -> None:
+        with self._lock:
+            self._counters(event.address).open_connections += 1
+
+    def connection_ready(self, event: monitoring.ConnectionReadyEvent) -> None:
+        pass
+
+    def connection_closed(self, event: monitoring.ConnectionClosedEvent) -> None:
+        with self._lock:
+            counters = self._counters(event.address)
+            counters.open_connections = max(counters.open_connections - 1, 0)
+
+    def connection_check_out_started(
+        self, event: monitoring.ConnectionCheckOutStartedEvent
+    ) -> None:
+        with self._lock:
+            self._counters(event.address).waiting += 1
+
+    def connection_check_out_failed(
+        self, event: monitoring.ConnectionCheckOutFailedEvent
+    ) -> None:
+        with self._lock:
+            counters = self._counters(event.address)
+            counters.waiting = max(counters.waiting - 1, 0)
+            counters.checkout_failures += 1
+
+    def connection_checked_out(
+        self, event: monitoring.ConnectionCheckedOutEvent
+    ) -> None:
+        with self._lock:
+            counters = self._counters(event.address)
+            counters.waiting = max(counters.waiting - 1, 0)
+            counters.checkouts += 1
+            counters.checked_out += 1
+            counters.max_checked_out = max(
+                counters.max_checked_out, counters.checked_out
+            )
+            counters.total_wait += event.duration or 0.0
+            counters.max_wait = max(counters.max_wait, event.duration or 0.0)
+
+    def connection_checked_in(self, event: monitoring.ConnectionCheckedInEvent) -> None:
+        with self._lock:
+            counters = self._counters(event.address)
+            counters.checked_out = max(counters.checked_out - 1, 0)
+
+    def get_pool_stats(self, max_pool_size: int) -> list[ConnectionPoolStats]:
+        with self._lock:
+            return [
+                ConnectionPoolStats(
+                    address=address,
+                    max_pool_size=max_pool_size,
+                    open_connections=counters.open_connections,
+                    checked_out=counters.checked_out,
+                    max_checked_out=counters.max_checked_out,
+                    waiting=counters.waiting,
+                    checkouts=counters.checkouts,
+                    checkout_failures=counters.checkout_failures,
+                    average_wait_ms=(
+                        1000 * counters.total_wait / counters.checkouts
+                        if counters.checkouts
+                        else 0.0
+                    ),
+                    max_wait_ms=1000 * counters.max_wait,
+                    cleared=counters.cleared,
+                )
+                for address, counters in sorted(self._pools.items())
+            ]
+
+
+POOL_STATS = PoolStatsListener()
@@ -0,0 +1,118 @@
+"""
+Typed reads of the collections.
+
+A `Repository` decodes the documents of a query as models with a single call
+to a cached `TypeAdapter`, instead of one `model_validate` per document.
+`Repository.partial` reads only the fields of a smaller model (projection),
+which is by far the cheapest way to list many documents: validation cost is
+dominated by the nested unets, addresses and MAC addresses, not by the call.
+
+FastAPI validates whatever a route returns against its `response_model`
+(models are dumped then validated again). The listing routes use `find_json`
+instead: the documents, which we wrote ourselves, are decoded once and
+serialized by the same cached `TypeAdapter`, and returned in a `Response`
+that FastAPI sends as is.
+
+`model_construct` is deliberately not used: it does not build nested models
+nor parse the stored IP/MAC/UUID strings, and it is not faster than a batched
+`TypeAdapter` call on flat models (see benchmarks/repository.py).
+"""
+
+from functools import lru_cache
+from typing import Generic, TypeVar
+
+from common_models.hermes_models import Box
+from common_models.user_models import User
+from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pydantic import BaseModel, TypeAdapter
+
+from back.mongodb.db import WITHOUT_PING_HISTORY, listing
+
+M = TypeVar("M", bound=BaseModel)
+P = TypeVar("P", bound=BaseModel)
+
+
+@lru_cache(maxsize=None)
+def list_adapter(model: type[M]) -> TypeAdapter[list[M]]:
+    return TypeAdapter(list[model])  # type: ignore[valid-type]
+
+
+@lru_cache(maxsize=None)
+def projection_of(model: type[BaseModel]) -> dict[str, int]:
+    """The projection reading only the fields of a model."""
+    projection = {"_id": 0}
+    for name, field in model.model_fields.items():
+        projection[field.alias or name] = 1
+        for alias in getattr(field.validation_alias, "choices", []):
+            if isinstance(alias, str):
+                projection[alias] = 1
+    return projection
+
+
+def decode(model: type[M], document: dict) -> M:
+    return model.model_validate(document)
+
+
+def decode_many(model: type[M], documents: list[dict]) -> list[M]:
+    return list_adapter(model).validate_python(documents)
+
+
+class Repository(Generic[M]):
+    """Reads the documents of a collection as `model` instances.
+
+    Args:
+        * collection (AsyncIOMotorCollection): the collection to read
+        * model (type[M]): the model of its documents
+        * projection (dict | None): fields to leave out of every read"""
+
+    def __init__(
+        self,
+        collection: AsyncIOMotorCollection,
+        model: type[M],
+        projection: dict | None = None,
+    ) -> None:
+        self.collection = collection
+        self.model = model
+        self.projection = projection
+
+    async def find_one(self, query: dict) -> M | None:
+        document = await self.collection.find_one(query, self.projection)
+        return decode(self.model, document) if document else None
+
+    async def find(
+        self,
+        query: dict | None = None,
+        sort: list[tuple[str, int]] | None = None,
+        limit: int = 0,
+    ) -> list[M]:
+        cursor = self.collection.find(query or {}, self.projection, limit=limit)
+        if sort:
+            cursor = cursor.sort(sort)
+        return decode_many(self.model, await cursor.to_list(None))
+
+    async def find_json(
+        self,
+        query: dict | None = None,
+        sort: list[tuple[str, int]] | None = None,
+        limit: int = 0,
+    ) -> bytes:
+        """The models of `find` as a JSON list, serialized as FastAPI would
+        (by alias), for routes which return it in a `Response`."""
+        models = await self.find(query, sort, limit)
+        return list_adapter(self.model).dump_json(models, by_alias=True)
+
+    def partial(self, model: type[P]) -> "Repository[P]":
+        """The same collection, reading only the fields of `model`."""
+        return Repository(self.collection, model, projection_of(model))
+
+    def listing(self) -> "Repository[M]":
+        """The same reads, for admin listings (see back.mongodb.db.listing)."""
+        return Repository(listing(self.collection), self.model, self.projection)
+
+
+def users(db: AsyncIOMotorDatabase) -> Repository[User]:
+    return Repository(db.users, User)
+
+
+def boxes(db: AsyncIOMotorDatabase) -> Repository[Box]:
+    return Repository(db.boxes, Box, WITHOUT_PING_HISTORY)
@@ -1,3 +1,4 @@
+from enum import Enum
 from typing import Optional, Self
 
 from common_models.base import PortableDatetime, PortableIBAN, RezelBaseModel
@@ -80,3 +81,32 @@ class AuthStatusResponse(RezelBaseModel):
         if not self.logged_in and self.user is not None:
             raise ValueError("If logged_in is false, user must be None")
         return self
+
+
+class BulkUnetRequest(RezelBaseModel):
+    user_id: str = Field(...)
+    mac_address: str = Field(...)
+    telecomian: bool = Field(...)
+
+
+class BulkBoxRequest(RezelBaseModel):
+    user_id: str = Field(...)
+    mac_address: str = Field(...)
+    box_type: str = Field(...)
+    ptah_profile: str = Field(...)
+    telecomian: bool = Field(...)
+
+
+class BulkBoxStatus(str, Enum):
+    CREATED = "created"
+    INVALID = "invalid"
+    FAILED = "failed"
+
+
+class BulkBoxReport(RezelBaseModel):
+    row: int = Field(...)
+    user_id: Optional[str] = Field(None)
+    mac_address: Optional[str] = Field(None)
+    status: BulkBoxStatus = Field(...)
+    detail: Optional[str] = Field(None)
+    main_unet_id: Optional[str] = Field(None)
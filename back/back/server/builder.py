@@ -9,12 +9,19 @@ from fastapi.responses import RedirectResponse
 from starlette.middleware.sessions import SessionMiddleware
 
 from back.core.auto_invoicing import auto_invoicing_loop
+from back.core.box_pings import ensure_box_pings_collection, ping_drain_loop
+from back.core.ipam import init_ipam
+from back.core.ipam_audit import ipam_audit_loop
+from back.core.ipam_config import watch_ipam_config
+from back.core.unet_ids import sync_unet_ids
 from back.env import ENV
 from back.mongodb.db import close_db, get_database, init_db
 from back.server.routers.appointments import router as router_appointments
 from back.server.routers.auth import router_auth
+from back.server.routers.database import router as router_database
 from back.server.routers.devices import router as router_devices
 from back.server.routers.documenso import router as router_documenso
+from back.server.routers.ipam import router as router_ipam
 from back.server.routers.logging import router as router_logging
 from back.server.routers.net import router as router_net
 from back.server.routers.nix import router as router_nix
@@ -25,6 +32,7 @@ from back.server.routers.users import router as router_users
 from back.server.routers.features import router as router_features
 from back.server.routers.payments import router as router_payments
 from back.server.routers.overdue import router as router_overdue
+from back.server.timing import ServerTimingMiddleware
 from back.utils.logger import init_logger
 
 logger = logging.getLogger(__name__)
@@ -63,6 +71,7 @@ def build() -> FastAPI:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Unet-Version"],
     )
 
     app.add_middleware(
@@ -73,15 +82,41 @@ def build() -> FastAPI:
         max_age=ENV.session_expiration_time_seconds,
     )
 
+    app.add_middleware(ServerTimingMiddleware)
+
     app.add_event_handler("startup", init_db)
     app.add_event_handler("shutdown", close_db)
 
+    async def _init_ipam() -> None:
+        await init_ipam(get_database())
+
+    app.add_event_handler("startup", _init_ipam)
+
+    async def _init_unet_ids() -> None:
+        await sync_unet_ids(get_database())
+
+    app.add_event_handler("startup", _init_unet_ids)
+
+    async def _init_box_pings() -> None:
+        await ensure_box_pings_collection(get_database())
+
+    app.add_event_handler("startup", _init_box_pings)
+
     background_tasks: dict[str, asyncio.Task] = {}
 
     async def _start_background_tasks() -> None:
         background_tasks["auto_invoicing"] = asyncio.create_task(
             auto_invoicing_loop(get_database())
         )
+        background_tasks["ipam_config_watch"] = asyncio.create_task(
+            watch_ipam_config(get_database())
+        )
+        background_tasks["ipam_audit"] = asyncio.create_task(
+            ipam_audit_loop(get_database())
+        )
+        background_tasks["box_pings_drain"] = asyncio.create_task(
+            ping_drain_loop(get_database())
+        )
 
     async def _stop_background_tasks() -> None:
         for task in background_tasks.values():
@@ -99,8 +134,10 @@ def build() -> FastAPI:
 
     app.include_router(router_auth)
     app.include_router(router_appointments)
+    app.include_router(router_database)
     app.include_router(router_devices)
     app.include_router(router_documenso)
+    app.include_router(router_ipam)
     app.include_router(router_logging)
     app.include_router(router_net)
     app.include_router(router_nix)
@@ -9,6 +9,7 @@ from motor.motor_asyncio import AsyncIOMotorDatabase
 from netaddr import EUI, mac_unix_expanded
 
 from back.core.hermes import get_box_from_user
+from back.core.loader import Loader, get_request_loader
 from back.core.status_update import StatusUpdateManager
 from back.env import ENV
 from back.mongodb.db import GetDatabase
@@ -133,22 +134,36 @@ OptionalJWTAdmin = Annotated[
 ]
 
 
+async def _get_loader(request: Request, db: GetDatabase) -> Loader:
+    """Request-scoped cache of the users, boxes and PMs, see back.core.loader."""
+    return get_request_loader(request, db)
+
+
+RequestLoader = Annotated[
+    Loader,
+    Depends(_get_loader),
+]
+
+
 async def _get_user_me_or_raise(
-    db: GetDatabase,
+    loader: RequestLoader,
     jwt_user: RequireJWTUser,
 ) -> User:
     """Get the current user."""
-    return User.model_validate(await db.users.find_one({"_id": str(jwt_user.user_id)}))
+    user = await loader.get_user(str(jwt_user.user_id))
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
 
 
 async def _get_user_me_or_none(
-    db: GetDatabase,
+    loader: RequestLoader,
     jwt_user: OptionalJWTUser,
 ) -> User | None:
     """Get the current user."""
     if jwt_user is None:
         return None
-    return User.model_validate(await db.users.find_one({"_id": str(jwt_user.user_id)}))
+    return await loader.get_user(str(jwt_user.user_id))
 
 
 RequireCurrentUser = Annotated[
@@ -164,12 +179,12 @@ OptionalCurrentUser = Annotated[
 
 async def _get_user_from_user_id_or_raise(
     user_id: str,
-    db: GetDatabase,
+    loader: RequestLoader,
 ) -> User:
-    user = await db.users.find_one({"_id": user_id})
+    user = await loader.get_user(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return User.model_validate(user)
+    return user
 
 
 UserFromPath = Annotated[
@@ -181,9 +196,10 @@ UserFromPath = Annotated[
 async def get_box_from_user_id_or_none(
     user: UserFromPath,
     db: GetDatabase,
+    loader: RequestLoader,
 ) -> Box | None:
     """Can be used on routes with a user_id parameter to get the box from the database."""
-    return await get_box(db, user)
+    return await get_box(db, user, loader)
 
 
 BoxFromUserInPath = Annotated[
@@ -195,9 +211,10 @@ BoxFromUserInPath = Annotated[
 async def _get_my_box(
     user: RequireCurrentUser,
     db: GetDatabase,
+    loader: RequestLoader,
 ) -> Box | None:
     """Can be used on user routes to get their own box from the database."""
-    return await get_box(db, user)
+    return await get_box(db, user, loader)
 
 
 OptionalCurrentUserBox = Annotated[
@@ -209,9 +226,10 @@ OptionalCurrentUserBox = Annotated[
 async def get_box(
     db: AsyncIOMotorDatabase,
     user: User,
+    loader: Loader | None = None,
 ) -> Box | None:
     """Return the user box."""
-    return await get_box_from_user(db, user)
+    return await get_box_from_user(db, user, loader)
 
 
 async def parse_mac_str(mac_str: str) -> EUI:
@@ -229,15 +247,15 @@ ParseMacAddressInPath = Annotated[
 
 async def get_box_from_mac_str(
     mac: ParseMacAddressInPath,
-    db: GetDatabase,
+    loader: RequestLoader,
 ) -> Box:
     """Return the box with the given MAC address."""
-    box_dict = await db.boxes.find_one({"mac": str(mac)})
+    box = await loader.get_box(mac)
 
-    if box_dict is None:
+    if box is None:
         raise HTTPException(status_code=404, detail="Box not found")
 
-    return Box.model_validate(box_dict)
+    return box
 
 
 BoxFromMacStr = Annotated[
@@ -0,0 +1,84 @@
+from fastapi import APIRouter, Depends, Query
+
+from back.mongodb.db import GetDatabase, get_client
+from back.mongodb.db_com_models import (
+    ConnectionPoolStats,
+    IndexUsage,
+    QueryPlan,
+    RouteDbStats,
+    SlowQuery,
+)
+from back.mongodb.indexes import get_index_stats, get_query_plans, get_slow_queries
+from back.mongodb.pool_stats import POOL_STATS
+from back.server.dependencies import must_be_admin
+from back.server.timing import get_route_stats
+
+router = APIRouter(prefix="/db", tags=["database"])
+
+
+@router.get(
+    "/indexes",
+    response_model=list[IndexUsage],
+    dependencies=[Depends(must_be_admin)],
+)
+async def _get_index_stats(
+    db: GetDatabase,
+) -> list[IndexUsage]:
+    """Usage of the indexes since the last restart of the database, including
+    the declared indexes which are missing. Unused indexes have 0 ops."""
+
+    return await get_index_stats(db)
+
+
+@router.get(
+    "/plans",
+    response_model=list[QueryPlan],
+    dependencies=[Depends(must_be_admin)],
+)
+async def _get_query_plans(
+    db: GetDatabase,
+) -> list[QueryPlan]:
+    """Plans of the hot queries, those with `uses_index` false scan their
+    whole collection."""
+
+    return await get_query_plans(db)
+
+
+@router.get(
+    "/slow-queries",
+    response_model=list[SlowQuery],
+    dependencies=[Depends(must_be_admin)],
+)
+async def _get_slow_queries(
+    db: GetDatabase,
+    min_duration_ms: int = Query(100, ge=0),
+    limit: int = Query(50, ge=1, le=1000),
+) -> list[SlowQuery]:
+    """Most recent slow operations seen by the database profiler, which
+    must be enabled for this to return anything."""
+
+    return await get_slow_queries(db, min_duration_ms, limit)
+
+
+@router.get(
+    "/pool",
+    response_model=list[ConnectionPoolStats],
+    dependencies=[Depends(must_be_admin)],
+)
+async def _get_pool_stats() -> list[ConnectionPoolStats]:
+    """Live statistics of the connection pool of each MongoDB server, to size
+    DB_MAX_POOL_SIZE to the load."""
+
+    return POOL_STATS.get_pool_stats(get_client().options.pool_options.max_pool_size)
+
+
+@router.get(
+    "/routes",
+    response_model=list[RouteDbStats],
+    dependencies=[Depends(must_be_admin)],
+)
+async def _get_route_stats() -> list[RouteDbStats]:
+    """MongoDB commands, documents and time of each route since the start of
+    the server, to find the routes making too many queries."""
+
+    return get_route_stats()
@@ -1,25 +1,48 @@
+import asyncio
 import re
 from datetime import datetime
+from typing import Literal
 
+import requests
 from common_models.hermes_models import Box
 from common_models.log_models import IpamLog
 from common_models.pon_models import ONT
 from common_models.user_models import User
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from netaddr import EUI, AddrFormatError, mac_unix_expanded
 from pymongo import ReturnDocument
 
-from back.core.charon import register_ont_in_olt
-from back.core.hermes import get_users_on_box
+from back.core.box_pings import RECENT_PINGS, get_ping_stats, get_recent_pings
+from back.core.charon import get_all_ont_summary, register_ont_in_olt
+from back.core.hermes import (
+    ENRICHED_BOXES_LIMIT,
+    get_enriched_boxes,
+    get_users_on_box,
+)
+from back.core.ipam import MongoIpam
 from back.core.ipam_logging import create_log
+from back.core.ont_reconciliation import reconcile_onts
+from back.core.pm_topology import invalidate_pm_topology
 from back.core.pon import (
     get_ont_from_box,
     get_ontinfo_from_box,
     get_ontinfo_from_serial_number,
 )
 from back.messaging.matrix import send_matrix_message
-from back.mongodb.db import GetDatabase
-from back.mongodb.pon_com_models import ONTInfo
-from back.server.dependencies import BoxFromMacStr, must_be_admin
+from back.mongodb import repository
+from back.mongodb.db import WITHOUT_PING_HISTORY, GetDatabase
+from back.mongodb.hermes_com_models import BoxSummary, EnrichedBox, PingStats
+from back.mongodb.pon_com_models import (
+    ONTInfo,
+    ONTReconciliationReport,
+    ONTReconciliationRequest,
+)
+from back.server.dependencies import (
+    BoxFromMacStr,
+    ParseMacAddressInPath,
+    RequestLoader,
+    must_be_admin,
+)
 
 router = APIRouter(prefix="/devices", tags=["devices"])
 
@@ -31,8 +54,53 @@ router = APIRouter(prefix="/devices", tags=["devices"])
 )
 async def _list_boxes(
     db: GetDatabase,
-) -> list[Box]:
-    return [Box.model_validate(box) for box in await db.boxes.find().to_list(None)]
+) -> Response:
+    return Response(
+        await repository.boxes(db).listing().find_json(),
+        media_type="application/json",
+    )
+
+
+@router.get(
+    "/box/summary",
+    response_model=list[BoxSummary],
+    dependencies=[Depends(must_be_admin)],
+)
+async def _list_box_summaries(
+    db: GetDatabase,
+) -> Response:
+    """List the boxes without their unets, cheaper than listing full boxes."""
+    return Response(
+        await repository.boxes(db).partial(BoxSummary).listing().find_json(),
+        media_type="application/json",
+    )
+
+
+@router.get(
+    "/box/enriched",
+    response_model=list[EnrichedBox],
+    dependencies=[Depends(must_be_admin)],
+)
+async def _list_enriched_boxes(
+    db: GetDatabase,
+    mac: str | None = None,
+    unet_id: str | None = None,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(ENRICHED_BOXES_LIMIT, ge=1, le=1000),
+) -> list[EnrichedBox]:
+    """List the boxes with their users, ONT and number of unets, a page at a
+    time. The boxes can be filtered by MAC address or by one of their unets
+    (e.g. the unetid of a user)."""
+    query: dict = {}
+    if mac is not None:
+        try:
+            query["mac"] = str(EUI(mac, dialect=mac_unix_expanded))
+        except AddrFormatError as e:
+            raise HTTPException(status_code=400, detail="Invalid MAC address") from e
+    if unet_id is not None:
+        query["unets.unet_id"] = unet_id
+
+    return await get_enriched_boxes(db, query, skip, limit)
 
 
 @router.get(
@@ -45,7 +113,8 @@ async def _get_box_by_ssid(
     db: GetDatabase,
 ) -> Box:
     box_dict = await db.boxes.find_one(
-        {"unets.wifi.ssid": re.compile(f"^{ssid}$", re.IGNORECASE)}
+        {"unets.wifi.ssid": re.compile(f"^{ssid}$", re.IGNORECASE)},
+        WITHOUT_PING_HISTORY,
     )
 
     if box_dict is None:
@@ -63,11 +132,19 @@ async def _get_box_by_unet_id(
     main_unet_id: str,
     db: GetDatabase,
 ) -> Box:
-    box_dict = await db.boxes.find_one({"main_unet_id": main_unet_id})
+    box_dict = await db.boxes.find_one(
+        {"main_unet_id": main_unet_id},
+        {"ping_history": {"$slice": -RECENT_PINGS}},
+    )
 
     if box_dict is None:
         raise HTTPException(status_code=404, detail="Box not found")
 
+    # The admin dashboard shows the latest reachability of the box
+    box_dict["ping_history"] = await get_recent_pings(
+        db, box_dict["mac"], box_dict["ping_history"]
+    )
+
     return Box.model_validate(box_dict)
 
 
@@ -90,18 +167,19 @@ async def _get_box_by_mac(
 async def _delete_box_by_mac(
     box: BoxFromMacStr,
     db: GetDatabase,
+    loader: RequestLoader,
 ) -> Box:
     if len(box.unets) > 1:
         raise HTTPException(
             status_code=400, detail="There must be only the main unet left"
         )
 
-    if await get_ontinfo_from_box(db, box):
+    if await get_ontinfo_from_box(db, box, loader):
         raise HTTPException(
             status_code=400, detail="This box still has an ONT attached"
         )
 
-    users = await get_users_on_box(db, box)
+    users = await get_users_on_box(db, box, loader)
 
     if len(users) != 1:
         raise HTTPException(
@@ -121,6 +199,8 @@ async def _delete_box_by_mac(
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Box not found")
 
+    await MongoIpam(db).release_lease(box.unets[0].unet_id)
+
     await create_log(
         db,
         IpamLog(
@@ -239,6 +319,33 @@ async def _list_onts(
     ]
 
 
+@router.post(
+    "/ont/reconcile",
+    response_model=ONTReconciliationReport,
+    dependencies=[Depends(must_be_admin)],
+)
+async def _reconcile_onts(
+    request: ONTReconciliationRequest,
+    db: GetDatabase,
+) -> ONTReconciliationReport:
+    """Register, update or move many ONTs at once, and compare the PMs with the
+    ONTs of the OLT. See core/ont_reconciliation.py."""
+    olt_summary = request.olt_summary
+    if olt_summary is None and request.fetch_olt_summary:
+        try:
+            olt_summary = await asyncio.to_thread(get_all_ont_summary)
+        except ValueError as e:
+            raise HTTPException(status_code=502, detail=str(e)) from e
+        except requests.RequestException as e:
+            raise HTTPException(
+                status_code=503, detail=f"Charon is unreachable: {e}"
+            ) from e
+
+    return await reconcile_onts(
+        db, request.onts, olt_summary, register_in_olt=request.register_in_olt
+    )
+
+
 @router.get(
     "/ont/{serial_number}",
     response_model=ONTInfo,
@@ -274,6 +381,7 @@ async def _delete_ont_by_serial_number(
         {},
         {"$pull": {"pon_list.$[].ont_list": {"serial_number": serial_number}}},
     )
+    invalidate_pm_topology()
 
     if result.modified_count == 0:
         raise HTTPException(status_code=500, detail="Failed to delete the ONT")
@@ -331,7 +439,26 @@ async def _register_ont_in_olt(
 ) -> None:
     """Force the registration of an ONT in the OLT."""
 
-    return register_ont_in_olt(serial_number)
+    register_ont_in_olt(serial_number)
+
+
+@router.get(
+    "/box/{mac_str}/pings",
+    response_model=list[PingStats],
+    dependencies=[Depends(must_be_admin)],
+)
+async def _get_box_pings(
+    mac: ParseMacAddressInPath,
+    start: datetime,
+    end: datetime,
+    db: GetDatabase,
+    unit: Literal["minute", "hour", "day", "week"] = "hour",
+) -> list[PingStats]:
+    """Reachability of a box between two dates, aggregated by minute, hour, day or week."""
+    if start >= end:
+        return []
+
+    return await get_ping_stats(db, str(mac), start, end, unit)
 
 
 @router.get(
@@ -342,5 +469,6 @@ async def _register_ont_in_olt(
 async def _get_users_on_box(
     box: BoxFromMacStr,
     db: GetDatabase,
+    loader: RequestLoader,
 ) -> list[User]:
-    return await get_users_on_box(db, box)
+    return await get_users_on_box(db, box, loader)
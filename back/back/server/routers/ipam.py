@@ -0,0 +1,81 @@
+from fastapi import APIRouter, Depends, HTTPException
+
+from back.core.ipam import MongoIpam
+from back.core.ipam_audit import get_last_ipam_audit, run_ipam_audit
+from back.mongodb.db import GetDatabase
+from back.mongodb.ipam_com_models import IPAMAuditReport, IPAMLookup, IPAMUsage
+from back.server.dependencies import must_be_admin
+
+router = APIRouter(prefix="/ipam", tags=["ipam"])
+
+
+@router.get(
+    "/usage",
+    response_model=IPAMUsage,
+    dependencies=[Depends(must_be_admin)],
+)
+async def _get_ipam_usage(
+    db: GetDatabase,
+) -> IPAMUsage:
+    """Usage of the IPv4 networks, cheap enough to be polled."""
+
+    try:
+        return await MongoIpam(db).get_usage()
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@router.get(
+    "/lookup/{address:path}",
+    response_model=IPAMLookup,
+    dependencies=[Depends(must_be_admin)],
+)
+async def _lookup_address(
+    address: str,
+    db: GetDatabase,
+) -> IPAMLookup:
+    """Find the unet, box and user an IPv4 address, IPv6 address or IPv6 prefix
+    is leased to (e.g. for abuse reports)."""
+
+    try:
+        lookup = await MongoIpam(db).lookup(address)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid IP address or prefix")
+
+    if lookup is None:
+        raise HTTPException(status_code=404, detail="No lease found for this address")
+
+    return lookup
+
+
+@router.post(
+    "/audit",
+    response_model=IPAMAuditReport,
+    dependencies=[Depends(must_be_admin)],
+)
+async def _run_ipam_audit(
+    db: GetDatabase,
+) -> IPAMAuditReport:
+    """Run the IPAM consistency audit now (it also runs every night)."""
+
+    try:
+        return await run_ipam_audit(db)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@router.get(
+    "/audit",
+    response_model=IPAMAuditReport,
+    dependencies=[Depends(must_be_admin)],
+)
+async def _get_last_ipam_audit(
+    db: GetDatabase,
+) -> IPAMAuditReport:
+    """Get the report of the last IPAM consistency audit."""
+
+    report = await get_last_ipam_audit(db)
+    if report is None:
+        raise HTTPException(status_code=404, detail="No audit has been run yet")
+
+    return report
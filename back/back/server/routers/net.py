@@ -2,17 +2,20 @@ from datetime import datetime
 from ipaddress import IPv4Interface
 
 import pytz
-import requests
 from common_models.hermes_models import Box, UnetProfile
 from common_models.user_models import User
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 
-from back.env import ENV
-from back.mongodb.db import GetDatabase
+from back.core.charon import get_all_ont_summary
+from back.core.passwords import generate_passwords
+from back.core.ssid_pool import get_used_ssids, is_ssid_available
+from back.mongodb.db import WITHOUT_PING_HISTORY, GetDatabase
 from back.server.dependencies import RequireCurrentUser, must_be_admin
 
 router = APIRouter(prefix="/net", tags=["net"])
 
+MAX_GENERATED_PASSWORDS = 10000
+
 
 @router.get(
     "/ssids",
@@ -23,15 +26,7 @@ async def _list_ssids(
 ):
     """List all SSIDS."""
 
-    return (
-        await db.boxes.aggregate(
-            [
-                {"$unwind": "$unets"},
-                {"$group": {"_id": None, "ssids": {"$addToSet": "$unets.wifi.ssid"}}},
-                {"$project": {"_id": 0, "ssids": 1}},
-            ]
-        ).to_list(None)
-    )[0]["ssids"]
+    return list(await get_used_ssids(db))
 
 
 @router.get(
@@ -48,18 +43,20 @@ async def _validate_ssid(
     if user.membership is None:
         return True
 
-    nb = await db.boxes.count_documents(
-        {
-            "unets": {
-                "$elemMatch": {
-                    "wifi.ssid": ssid,
-                    "unet_id": {"$ne": user.membership.unetid},
-                }
-            }
-        }
-    )
+    return await is_ssid_available(db, ssid, user.membership.unetid)
 
-    return nb == 0
+
+@router.get(
+    "/passwords",
+    response_model=list[str],
+    dependencies=[Depends(must_be_admin)],
+)
+def _generate_passwords(
+    count: int = Query(ge=1, le=MAX_GENERATED_PASSWORDS),
+) -> list[str]:
+    """Generate Wi-Fi passwords, for mass provisioning or PSK rotation."""
+
+    return generate_passwords(count)
 
 
 @router.get(
@@ -67,18 +64,13 @@ async def _validate_ssid(
     response_model=str,
     dependencies=[Depends(must_be_admin)],
 )
-def get_all_ont_summary():
+def _get_all_ont_summary():
     """Get all ONT summary from Charon"""
 
-    r = requests.get(
-        f"{ENV.charon_url}/get-all-ont-summary/olt1",
-        timeout=10,
-    )
-
-    if r.status_code != 200:
-        return f"Charon Error {r.status_code} : {r.text}"
-
-    return r.text
+    try:
+        return get_all_ont_summary()
+    except ValueError as e:
+        return str(e)
 
 
 @router.post(
@@ -93,7 +85,9 @@ async def _transfer_unet(
 ):
     """Transfer a unet to a new box."""
 
-    current_box = await db.boxes.find_one({"unets.unet_id": unet_id})
+    current_box = await db.boxes.find_one(
+        {"unets.unet_id": unet_id}, WITHOUT_PING_HISTORY
+    )
     if not current_box:
         raise HTTPException(
             status_code=404, detail="No current box found for this unet"
@@ -107,7 +101,7 @@ async def _transfer_unet(
             status_code=400, detail="Cannot transfer the main unet of a box"
         )
 
-    new_box = await db.boxes.find_one({"mac": str(mac)})
+    new_box = await db.boxes.find_one({"mac": str(mac)}, WITHOUT_PING_HISTORY)
     if not new_box:
         raise HTTPException(status_code=404, detail="No box found with this mac")
     new_box = Box.model_validate(new_box)
@@ -4,7 +4,7 @@ from fastapi.responses import JSONResponse
 from pymongo import ReturnDocument
 
 from back.core.partial_refunds import refresh_partial_refund_database
-from back.mongodb.db import GetDatabase
+from back.mongodb.db import GetDatabase, listing
 from back.server.dependencies import must_be_admin
 
 router = APIRouter(prefix="/partial-refunds", tags=["partial-refunds"])
@@ -38,7 +38,7 @@ async def _get_refunds(
 ) -> list[PartialRefund]:
     return [
         PartialRefund.model_validate(refund)
-        for refund in await db.partial_refunds.find({}).to_list(None)
+        for refund in await listing(db.partial_refunds).find({}).to_list(None)
     ]
 
 
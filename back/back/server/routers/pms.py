@@ -1,7 +1,8 @@
 from fastapi import APIRouter, Depends
 
-from back.mongodb.db import GetDatabase
-from back.mongodb.pon_com_models import PMInfo
+from back.core.pm_topology import get_pm_topology
+from back.mongodb.db import GetDatabase, listing
+from back.mongodb.pon_com_models import PMInfo, PMTopology
 from back.server.dependencies import must_be_admin
 
 router = APIRouter(prefix="/pms", tags=["pms"])
@@ -16,8 +17,21 @@ async def _list_pms(
     db: GetDatabase,
 ):
     """List all PMs."""
-    pm_list = await db.pms.find().to_list(None)
+    pm_list = await listing(db.pms).find().to_list(None)
 
     pm_info_list = [PMInfo.model_validate(pm) for pm in pm_list]
 
     return pm_info_list
+
+
+@router.get(
+    "/topology",
+    response_model=PMTopology,
+    dependencies=[Depends(must_be_admin)],
+)
+async def _get_pm_topology(
+    db: GetDatabase,
+) -> PMTopology:
+    """Used and free ports of every PON and PM, with the MEC128 occupancy map
+    and the software versions of the ONTs. Cached, see core/pm_topology.py."""
+    return await get_pm_topology(db)
@@ -1,5 +1,7 @@
 """Get or edit users."""
 
+import csv
+import io
 import logging
 from datetime import datetime, timedelta
 from secrets import randbelow
@@ -16,9 +18,11 @@ from common_models.user_models import (
 )
 from faistos import Faistos
 from faistos.utils.models import ConnectedDevice
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response, UploadFile
 from fastapi.responses import JSONResponse
-from pymongo import ReturnDocument
+from netaddr import EUI, AddrFormatError
+from pydantic import ValidationError
+from pymongo import ReturnDocument, UpdateOne
 
 from back.core.charon import register_ont_in_olt
 from back.core.documenso import (
@@ -29,12 +33,18 @@ from back.core.documenso import (
 )
 from back.core.dolibarr import archive_user_invoices, create_dolibarr_user
 from back.core.hermes import (
+    UnetVersionConflict,
     get_box_by_ssid,
     get_box_from_user,
+    get_unet_version,
     register_box_for_new_ftth_adh,
+    register_boxes_for_new_ftth_adhs,
     register_unet_on_box,
+    register_unets_on_boxes,
+    update_unet_settings,
 )
-from back.core.ipam_logging import create_log
+from back.core.ipam_logging import create_log, create_logs
+from back.core.pm_topology import invalidate_pm_topology
 from back.core.pon import (
     get_ont_from_box,
     get_ontinfo_from_box,
@@ -44,6 +54,7 @@ from back.core.scholarship_student import (
     get_all_scholarship_students,
     reset_all_scholarship_students,
 )
+from back.core.ssid_pool import is_ssid_available
 from back.core.status_update import (
     StatusUpdateInfo,
     delete_unet_of_wifi_adherent,
@@ -52,10 +63,15 @@ from back.core.status_update import (
 from back.env import ENV
 from back.messaging.matrix import send_matrix_message
 from back.messaging.sms import send_code
-from back.mongodb.db import GetDatabase
+from back.mongodb import repository
+from back.mongodb.db import WITHOUT_PING_HISTORY, GetDatabase
 from back.mongodb.pon_com_models import ONTInfo, RegisterONT
 from back.mongodb.user_com_models import (
     AuthStatusResponse,
+    BulkBoxReport,
+    BulkBoxRequest,
+    BulkBoxStatus,
+    BulkUnetRequest,
     MembershipRequest,
     MembershipUpdate,
     UserUpdate,
@@ -64,6 +80,7 @@ from back.server.dependencies import (
     BoxFromUserInPath,
     OptionalCurrentUser,
     OptionalCurrentUserBox,
+    RequestLoader,
     RequireCurrentUser,
     StatusUpdateManagerDep,
     UserFromPath,
@@ -300,7 +317,11 @@ async def _me_add_availability_slots(
 async def _user_get_unet(
     user: RequireCurrentUser,
     db: GetDatabase,
+    loader: RequestLoader,
+    response: Response,
 ) -> UnetProfile:
+    """The unet of the user. The version of its settings, to send back with
+    their update, is returned in the `X-Unet-Version` header."""
     if not user.membership:
         raise HTTPException(status_code=400, detail="User has no membership")
 
@@ -308,13 +329,15 @@ async def _user_get_unet(
         raise HTTPException(status_code=400, detail="User has no unetid")
 
     # find the box where the unetid is in the unets Array
-    box = await get_box_from_user(db, user)
+    box = await get_box_from_user(db, user, loader)
     if not box:
         raise HTTPException(status_code=404, detail="No box found for this user")
 
     # get the unet profile from the box
     for unet in box.unets:
         if unet.unet_id == user.membership.unetid:
+            version = await get_unet_version(db, unet.unet_id)
+            response.headers["X-Unet-Version"] = str(version or 0)
             return unet
 
     raise HTTPException(status_code=404, detail="No unet found for this user")
@@ -326,7 +349,15 @@ async def _user_update_unet(
     user: RequireCurrentUser,
     box: OptionalCurrentUserBox,
     db: GetDatabase,
+    response: Response,
+    version: int | None = None,
 ) -> UnetProfile:
+    """Update the Wi-Fi, firewall and DHCP settings of the user's unet.
+
+    If `version` (the `X-Unet-Version` header of GET /me/unet) is given, the
+    update is rejected with a 409 when the unet was modified since that
+    version. The new version of the unet is returned in the `X-Unet-Version`
+    header."""
     if not user.membership:
         raise HTTPException(status_code=400, detail="User has no membership")
 
@@ -347,56 +378,25 @@ async def _user_update_unet(
             detail="SSID must start with 'Rezel-'",
         )
 
-    # Count the number of boxs containing a unet with the same SSID
-    same_ssid_nb = await db.boxes.count_documents(
-        {
-            "unets": {
-                "$elemMatch": {
-                    "wifi.ssid": new_unet.wifi.ssid,
-                    "unet_id": {"$ne": user.membership.unetid},
-                }
-            }
-        }
-    )
-    if same_ssid_nb > 0:
+    if not await is_ssid_available(db, new_unet.wifi.ssid, user.membership.unetid):
         raise HTTPException(
             status_code=400,
             detail=f"SSID {new_unet.wifi.ssid} is already used",
         )
 
-    # update the unet profile in the box, but only the fields
-    # that are allowed to be updated by  the user (e.g. not the WAN adresses)
-    for unet in box.unets:
-        if unet.unet_id == user.membership.unetid:
-            for field in [
-                "wifi",
-                "firewall",
-                "dhcp",
-            ]:
-                setattr(unet, field, getattr(new_unet, field))
-            break
-
-    # update the box in the database
-    box_dict = await db.boxes.find_one_and_update(
-        {"mac": str(box.mac)},
-        {
-            "$set": {
-                "unets": [
-                    unet.model_dump(exclude_unset=True, mode="json")
-                    for unet in box.unets
-                ]
-            }
-        },
-        return_document=ReturnDocument.AFTER,
-    )
-
-    box = Box.model_validate(box_dict)
+    # only the fields that are allowed to be updated by the user are written
+    # (e.g. not the WAN adresses)
+    try:
+        updated = await update_unet_settings(db, new_unet, version)
+    except UnetVersionConflict as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
 
-    for unet in box.unets:
-        if unet.unet_id == user.membership.unetid:
-            return unet
+    if updated is None:
+        raise HTTPException(status_code=404, detail="No unet found for this user")
 
-    raise HTTPException(status_code=404, detail="No unet found for this user")
+    unet, new_version = updated
+    response.headers["X-Unet-Version"] = str(new_version)
+    return unet
 
 
 @router.get(
@@ -432,9 +432,12 @@ async def _user_get_connected_devices(
 )
 async def _get_users(
     db: GetDatabase,
-) -> list[User]:
+) -> Response:
     """Get all users."""
-    return await db.users.find().to_list(None)
+    return Response(
+        await repository.users(db).listing().find_json(),
+        media_type="application/json",
+    )
 
 
 @router.get(
@@ -538,6 +541,7 @@ async def _user_delete_membership(
     db: GetDatabase,
     user: UserFromPath,
     box: BoxFromUserInPath,
+    loader: RequestLoader,
 ) -> User:
     """Delete the user's membership."""
     if not user.membership:
@@ -548,7 +552,7 @@ async def _user_delete_membership(
             status_code=400, detail="User is still linked to a box or unet"
         )
 
-    if box and await get_ont_from_box(db, box):
+    if box and await get_ont_from_box(db, box, loader):
         raise HTTPException(status_code=400, detail="User is still linked to an ONT")
 
     try:
@@ -578,6 +582,7 @@ async def _user_delete_membership(
 async def _user_get_ont(
     db: GetDatabase,
     box: BoxFromUserInPath,
+    loader: RequestLoader,
 ) -> ONTInfo:
     if not box:
         raise HTTPException(
@@ -585,7 +590,7 @@ async def _user_get_ont(
             detail="No box found for this user. The user is likely not linked to the main unet of a box",
         )
 
-    ont_info = await get_ontinfo_from_box(db, box)
+    ont_info = await get_ontinfo_from_box(db, box, loader)
 
     if not ont_info:
         raise HTTPException(
@@ -621,6 +626,7 @@ async def _user_register_ont(
         )
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e)) from e
+    invalidate_pm_topology()
 
     register_ont_in_olt(register.serial_number)
 
@@ -701,6 +707,198 @@ async def _user_register_box(
     return new_box
 
 
+BULK_BOX_CHUNK_SIZE = 200
+
+
+async def _register_boxes(
+    rows: list[BulkBoxRequest | str],
+    db: GetDatabase,
+) -> list[BulkBoxReport]:
+    """Validate every row up front, then register the boxes of the valid ones
+    by chunks of BULK_BOX_CHUNK_SIZE. Rows that could not be parsed are given
+    as their error message."""
+    reports: list[BulkBoxReport] = []
+    valid: list[tuple[int, BulkBoxRequest, User]] = []
+
+    requests = [row for row in rows if isinstance(row, BulkBoxRequest)]
+    users = {
+        user["_id"]: User.model_validate(user)
+        async for user in db.users.find(
+            {"_id": {"$in": [request.user_id for request in requests]}}
+        )
+    }
+    existing_macs = set(
+        await db.boxes.distinct(
+            "mac",
+            {"mac": {"$in": [request.mac_address.lower() for request in requests]}},
+        )
+    )
+
+    seen_users: set[str] = set()
+    seen_macs: set[str] = set()
+    for i, row in enumerate(rows):
+        if isinstance(row, str):
+            reports.append(
+                BulkBoxReport(row=i, status=BulkBoxStatus.INVALID, detail=row)
+            )
+            continue
+
+        row.mac_address = row.mac_address.lower()
+        user = users.get(row.user_id)
+        error = None
+        if not user:
+            error = "User does not exist"
+        elif not user.membership or user.membership.unetid:
+            error = "User has no membership or already has a unetid attached"
+        elif row.mac_address in existing_macs:
+            error = "Box with this MAC address already exists"
+        elif row.user_id in seen_users or row.mac_address in seen_macs:
+            error = "User or MAC address appears more than once"
+        else:
+            try:
+                EUI(row.mac_address)
+            except AddrFormatError:
+                error = "Invalid MAC address"
+        seen_users.add(row.user_id)
+        seen_macs.add(row.mac_address)
+
+        if error:
+            reports.append(
+                BulkBoxReport(
+                    row=i,
+                    user_id=row.user_id,
+                    mac_address=row.mac_address,
+                    status=BulkBoxStatus.INVALID,
+                    detail=error,
+                )
+            )
+        else:
+            valid.append((i, row, user))
+
+    for start in range(0, len(valid), BULK_BOX_CHUNK_SIZE):
+        chunk = valid[start : start + BULK_BOX_CHUNK_SIZE]
+        try:
+            new_boxes = await register_boxes_for_new_ftth_adhs(
+                db,
+                [
+                    (row.box_type, row.ptah_profile, row.mac_address, row.telecomian)
+                    for _, row, _ in chunk
+                ],
+            )
+        except ValueError as e:
+            reports += [
+                BulkBoxReport(
+                    row=i,
+                    user_id=row.user_id,
+                    mac_address=row.mac_address,
+                    status=BulkBoxStatus.FAILED,
+                    detail=str(e),
+                )
+                for i, row, _ in chunk
+            ]
+            continue
+
+        created = [
+            (i, row, user, box)
+            for (i, row, user), box in zip(chunk, new_boxes)
+            if box is not None
+        ]
+        reports += [
+            BulkBoxReport(
+                row=i,
+                user_id=row.user_id,
+                mac_address=row.mac_address,
+                status=BulkBoxStatus.FAILED,
+                detail="Box could not be inserted",
+            )
+            for (i, row, _), box in zip(chunk, new_boxes)
+            if box is None
+        ]
+        if not created:
+            continue
+
+        await create_logs(
+            db,
+            [
+                IpamLog(
+                    timestamp=datetime.now(),
+                    source="sadh-back",
+                    message=" ".join(
+                        [
+                            f"Main unet {box.main_unet_id} created on new box {row.mac_address}",
+                            f"for {user.first_name} {user.last_name}",
+                            f"({user.membership.address.residence.name} - {user.membership.address.appartement_id})",
+                        ]
+                    ),
+                )
+                for _, row, user, box in created
+            ],
+        )
+        await db.users.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": str(user.id)},
+                    {"$set": {"membership.unetid": box.main_unet_id}},
+                )
+                for _, _, user, box in created
+            ]
+        )
+        reports += [
+            BulkBoxReport(
+                row=i,
+                user_id=row.user_id,
+                mac_address=row.mac_address,
+                status=BulkBoxStatus.CREATED,
+                main_unet_id=box.main_unet_id,
+            )
+            for i, row, _, box in created
+        ]
+
+    return sorted(reports, key=lambda report: report.row)
+
+
+@router.post(
+    "/boxes",
+    dependencies=[Depends(must_be_admin)],
+    response_model=list[BulkBoxReport],
+)
+async def _users_register_boxes(
+    requests: list[BulkBoxRequest],
+    db: GetDatabase,
+) -> list[BulkBoxReport]:
+    """Same as _user_register_box, for many users at once (batch onboarding).
+    Returns a report for each row."""
+
+    return await _register_boxes(list(requests), db)
+
+
+@router.post(
+    "/boxes/csv",
+    dependencies=[Depends(must_be_admin)],
+    response_model=list[BulkBoxReport],
+)
+async def _users_register_boxes_from_csv(
+    file: UploadFile,
+    db: GetDatabase,
+) -> list[BulkBoxReport]:
+    """Same as _users_register_boxes, from a CSV file with the columns
+    user_id, mac_address, box_type, ptah_profile and telecomian."""
+
+    try:
+        content = (await file.read()).decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="File must be UTF-8 encoded")
+
+    rows: list[BulkBoxRequest | str] = []
+    for line in csv.DictReader(io.StringIO(content)):
+        try:
+            rows.append(BulkBoxRequest.model_validate(line))
+        except ValidationError as e:
+            rows.append(str(e))
+
+    return await _register_boxes(rows, db)
+
+
 @router.post(
     "/{user_id}/unet",
     dependencies=[Depends(must_be_admin)],
@@ -720,7 +918,7 @@ async def _user_register_unet(
 
     mac_address = mac_address.lower()
 
-    box_dict = await db.boxes.find_one({"mac": str(mac_address)})
+    box_dict = await db.boxes.find_one({"mac": str(mac_address)}, WITHOUT_PING_HISTORY)
     if not box_dict:
         raise HTTPException(status_code=400, detail="Box with this MAC does not exist")
 
@@ -766,6 +964,105 @@ async def _user_register_unet(
     return box
 
 
+@router.post(
+    "/unets",
+    dependencies=[Depends(must_be_admin)],
+    response_model=list[UnetProfile],
+)
+async def _users_register_unets(
+    requests: list[BulkUnetRequest],
+    db: GetDatabase,
+) -> list[UnetProfile]:
+    """Same as _user_register_unet, for many users at once (mass onboarding).
+    Every request is checked before anything is registered."""
+    users = {
+        user["_id"]: User.model_validate(user)
+        async for user in db.users.find(
+            {"_id": {"$in": [request.user_id for request in requests]}}
+        )
+    }
+    boxes = {
+        box["mac"]: Box.model_validate(box)
+        async for box in db.boxes.find(
+            {"mac": {"$in": [request.mac_address.lower() for request in requests]}},
+            WITHOUT_PING_HISTORY,
+        )
+    }
+
+    errors = []
+    for request in requests:
+        user = users.get(request.user_id)
+        if not user:
+            errors.append(f"{request.user_id}: user does not exist")
+        elif not user.membership or user.membership.unetid:
+            errors.append(
+                f"{request.user_id}: user has no membership or already has a unetid attached"
+            )
+        elif request.mac_address.lower() not in boxes:
+            errors.append(
+                f"{request.user_id}: box {request.mac_address} does not exist"
+            )
+    if len({request.user_id for request in requests}) != len(requests):
+        errors.append("A user appears more than once")
+    if errors:
+        raise HTTPException(status_code=400, detail=errors)
+
+    try:
+        unet_profiles = await register_unets_on_boxes(
+            db,
+            [
+                (boxes[request.mac_address.lower()], request.telecomian)
+                for request in requests
+            ],
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
+
+    user_updates = []
+    logs = []
+    for request, unet_profile in zip(requests, unet_profiles):
+        user = users[request.user_id]
+        box = boxes[request.mac_address.lower()]
+        logs.append(
+            IpamLog(
+                timestamp=datetime.now(),
+                source="sadh-back",
+                message=" ".join(
+                    [
+                        f"Unet {unet_profile.unet_id} created on existing box {box.mac}",
+                        f"for {user.first_name} {user.last_name}",
+                        f"({user.membership.address.residence.name} - {user.membership.address.appartement_id})",
+                    ]
+                ),
+            )
+        )
+        user_updates += [
+            UpdateOne(
+                {"_id": str(user.id)},
+                {"$set": {"membership.unetid": unet_profile.unet_id}},
+            ),
+            UpdateOne(
+                {"membership.unetid": box.main_unet_id},
+                {
+                    "$push": {
+                        "membership.attached_wifi_adherents": {
+                            "user_id": str(user.id),
+                            # Because unet will be available tomorrow at 6:00, when
+                            # the box is reconfigured
+                            "from_date": datetime.today() + timedelta(days=1),
+                            "comment": "",
+                        }
+                    }
+                },
+            ),
+        ]
+
+    await create_logs(db, logs)
+    await db.users.bulk_write(user_updates)
+
+    return unet_profiles
+
+
 @router.delete(
     "/{user_id}/unet",
     dependencies=[Depends(must_be_admin)],
@@ -792,7 +1089,9 @@ async def _user_delete_unet(
 
     await delete_unet_of_wifi_adherent(user, db)
 
-    updated_box = Box.model_validate(await db.boxes.find_one({"mac": str(box.mac)}))
+    updated_box = Box.model_validate(
+        await db.boxes.find_one({"mac": str(box.mac)}, WITHOUT_PING_HISTORY)
+    )
 
     return updated_box
 
@@ -954,6 +1253,7 @@ async def _user_transfer_devices(
     db: GetDatabase,
     user: UserFromPath,
     box: BoxFromUserInPath,
+    loader: RequestLoader,
 ) -> None:
     """
     Transfer all devices from one user to another.
@@ -961,21 +1261,20 @@ async def _user_transfer_devices(
     if not box:
         raise HTTPException(status_code=404, detail="No box found for this user")
 
-    ont = await get_ont_from_box(db, box)
+    ont = await get_ont_from_box(db, box, loader)
     if not ont:
         raise HTTPException(status_code=404, detail="No ONT found for this user")
 
-    target_user = await db.users.find_one({"_id": target_user_id})
+    target_user = await loader.get_user(target_user_id)
     if not target_user:
         raise HTTPException(status_code=404, detail="Target user not found")
-    target_user = User.model_validate(target_user)
 
     if not target_user.membership or target_user.membership.type != MembershipType.FTTH:
         raise HTTPException(
             status_code=400, detail="Target user has no FTTH membership"
         )
 
-    target_user_current_box = await get_box(db, target_user)
+    target_user_current_box = await get_box(db, target_user, loader)
     if target_user_current_box:
         raise HTTPException(status_code=400, detail="Target user already has a box")
 
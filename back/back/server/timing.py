@@ -0,0 +1,123 @@
+"""
+Time spent in MongoDB by the HTTP requests.
+
+ServerTimingMiddleware counts the MongoDB commands of every request (see
+back.mongodb.command_stats) and reports them in a `Server-Timing` header,
+visible in the network tab of the browsers. Requests slower than
+SLOW_REQUEST_THRESHOLD_MS are logged, and the counts are aggregated by route
+for `GET /db/routes`.
+"""
+
+import logging
+import time
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from back.env import ENV
+from back.mongodb.command_stats import RequestDbStats, track_commands
+from back.mongodb.db_com_models import RouteDbStats
+
+logger = logging.getLogger(__name__)
+
+
+class _RouteCounters:
+    def __init__(self) -> None:
+        self.requests = 0
+        self.commands = 0
+        self.max_commands = 0
+        self.documents = 0
+        self.db_duration = 0.0  # seconds
+        self.duration = 0.0  # seconds
+        self.max_duration = 0.0  # seconds
+
+
+# By "METHOD /route/{path_param}", only updated from the event loop
+_routes: dict[str, _RouteCounters] = {}
+
+
+def _route_of(scope: Scope) -> str:
+    route = scope.get("route")
+    return f"{scope['method']} {route.path if route is not None else '(unmatched)'}"
+
+
+def _server_timing(stats: RequestDbStats, duration: float) -> str:
+    return (
+        f'db;dur={stats.duration * 1000:.1f};desc="{stats.command_count} commands, '
+        f'{stats.documents} documents", total;dur={duration * 1000:.1f}'
+    )
+
+
+def _record(route: str, stats: RequestDbStats, duration: float) -> None:
+    counters = _routes.setdefault(route, _RouteCounters())
+    counters.requests += 1
+    counters.commands += stats.command_count
+    counters.max_commands = max(counters.max_commands, stats.command_count)
+    counters.documents += stats.documents
+    counters.db_duration += stats.duration
+    counters.duration += duration
+    counters.max_duration = max(counters.max_duration, duration)
+
+    if duration * 1000 >= ENV.slow_request_threshold_ms:
+        logger.warning(
+            "Slow request %s: %.0f ms, %.0f ms in MongoDB, %d commands (%s), "
+            "%d documents",
+            route,
+            duration * 1000,
+            stats.duration * 1000,
+            stats.command_count,
+            ", ".join(f"{name}: {n}" for name, n in stats.commands.most_common()),
+            stats.documents,
+        )
+
+
+def get_route_stats() -> list[RouteDbStats]:
+    """MongoDB usage of each route since the start of the server, the routes
+    spending the most time in MongoDB first."""
+    return sorted(
+        (
+            RouteDbStats(
+                route=route,
+                requests=counters.requests,
+                commands=counters.commands,
+                average_commands=counters.commands / counters.requests,
+                max_commands=counters.max_commands,
+                documents=counters.documents,
+                db_time_ms=counters.db_duration * 1000,
+                average_db_time_ms=counters.db_duration * 1000 / counters.requests,
+                average_time_ms=counters.duration * 1000 / counters.requests,
+                max_time_ms=counters.max_duration * 1000,
+            )
+            for route, counters in _routes.items()
+        ),
+        key=lambda stats: stats.db_time_ms,
+        reverse=True,
+    )
+
+
+class ServerTimingMiddleware:
+    """Reports the MongoDB usage of each request, see the module docstring."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        with track_commands() as stats:
+
+            async def send_with_timing(message: Message) -> None:
+                if message["type"] == "http.response.start":
+                    MutableHeaders(scope=message).append(
+                        "Server-Timing",
+                        _server_timing(stats, time.perf_counter() - start),
+                    )
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_timing)
+            finally:
+                _record(_route_of(scope), stats, time.perf_counter() - start)
@@ -0,0 +1,206 @@
+"""
+Micro-benchmark of the reads of back.mongodb.repository.
+
+Compares, on synthetic documents, per-document `model_validate` of the raw
+documents (what the routes used to do), `Repository.find` (one cached
+`TypeAdapter` call per query), `model_construct` and `Repository.partial`
+(a smaller model read with a projection).
+
+It then times the listing endpoints through FastAPI, returning the models of
+`Repository.find` (validated again by FastAPI against the `response_model`),
+the raw documents (validated by FastAPI only) or the JSON of
+`Repository.find_json` (decoded and serialized once, sent as is).
+
+The documents are written to a scratch database next to the configured one
+(DB_NAME with a `_benchmark` suffix), which is dropped at the end. Run from
+the `back` directory (the usual environment variables must be set):
+
+    python -m benchmarks.repository [number of documents]
+"""
+
+import asyncio
+import sys
+import time
+from ipaddress import IPv4Address
+from typing import Awaitable, Callable
+from uuid import uuid4
+
+import httpx
+from common_models.hermes_models import Box
+from common_models.user_models import User
+from fastapi import FastAPI, Response
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+
+from back.core.ipam_config import derive_ipv6_objects
+from back.env import ENV
+from back.mongodb import repository
+from back.mongodb.db import WITHOUT_PING_HISTORY, client_options
+from back.mongodb.hermes_com_models import BoxSummary
+
+
+def _box_documents(count: int) -> list[dict]:
+    documents = []
+    for i in range(count):
+        ipv4 = IPv4Address("137.194.0.1") + i
+        ipv6, prefix = derive_ipv6_objects(ipv4, True)
+        unet_id = f"unet{i:04d}"
+        unet = {
+            "unet_id": unet_id,
+            "network": {
+                "wan_ipv4": {"ip": f"{ipv4}/16", "vlan": 101},
+                "wan_ipv6": {"ip": f"{ipv6}/64", "vlan": 103},
+                "ipv6_prefix": str(prefix),
+                "lan_ipv4": {"address": "192.168.1.1/24", "vlan": 1},
+            },
+            "wifi": {"ssid": f"Rezel-{i}", "psk": "correct-horse-battery-staple"},
+            "dhcp": {
+                "dns_servers": {
+                    "ipv4": ["8.8.8.8", "1.1.1.1"],
+                    "ipv6": ["2001:4860:4860::8888", "2606:4700:4700::1111"],
+                }
+            },
+            "firewall": {"ipv4_port_forwarding": [], "ipv6_port_opening": []},
+        }
+        documents.append(
+            {
+                "type": "benchmark",
+                "ptah_profile": "default",
+                "main_unet_id": unet_id,
+                "mac": f"00:00:5e:00:{i // 256 % 256:02x}:{i % 256:02x}",
+                "unets": [unet],
+                "wan_vlan": [],
+                "ping_history": [],
+            }
+        )
+    return documents
+
+
+def _user_documents(count: int) -> list[dict]:
+    return [
+        {
+            "_id": str(uuid4()),
+            "email": f"user{i}@example.org",
+            "first_name": "First",
+            "last_name": f"Last{i}",
+        }
+        for i in range(count)
+    ]
+
+
+async def _timeit(label: str, count: int, read: Callable[[], Awaitable]) -> None:
+    await read()  # warm up the caches
+    best = min([await _duration(read) for _ in range(5)])
+    print(f"{label:<45} {best * 1000:8.1f} ms  {best / count * 1e6:6.1f} µs/doc")
+
+
+async def _duration(read: Callable[[], Awaitable]) -> float:
+    start = time.perf_counter()
+    await read()
+    return time.perf_counter() - start
+
+
+async def main(count: int) -> None:
+    client = AsyncIOMotorClient(ENV.db_uri, **client_options())
+    db = client[f"{ENV.db_name}_benchmark"]
+    try:
+        await db.boxes.insert_many(_box_documents(count))
+        await db.users.insert_many(_user_documents(count))
+        await main_reads(count, db)
+        await main_endpoints(count, db)
+    finally:
+        await client.drop_database(db.name)
+        client.close()
+
+
+async def main_reads(count: int, db: AsyncIOMotorDatabase) -> None:
+    async def documents(collection: str, projection: dict | None) -> list[dict]:
+        return await db[collection].find({}, projection).to_list(None)
+
+    async def validate_each(model: type, collection: str, projection=None) -> list:
+        return [
+            model.model_validate(document)
+            for document in await documents(collection, projection)
+        ]
+
+    summary_projection = repository.projection_of(BoxSummary)
+
+    async def construct_summaries() -> list[BoxSummary]:
+        return [
+            BoxSummary.model_construct(**document)
+            for document in await documents("boxes", summary_projection)
+        ]
+
+    print(f"{count} documents of each kind")
+    await _timeit(
+        "Box: model_validate per document",
+        count,
+        lambda: validate_each(Box, "boxes", WITHOUT_PING_HISTORY),
+    )
+    await _timeit("Box: Repository.find", count, repository.boxes(db).find)
+    await _timeit(
+        "User: model_validate per document",
+        count,
+        lambda: validate_each(User, "users"),
+    )
+    await _timeit("User: Repository.find", count, repository.users(db).find)
+    await _timeit(
+        "BoxSummary: model_validate per document",
+        count,
+        lambda: validate_each(BoxSummary, "boxes", summary_projection),
+    )
+    await _timeit(
+        "BoxSummary: model_construct per document", count, construct_summaries
+    )
+    await _timeit(
+        "BoxSummary: Repository.partial",
+        count,
+        repository.boxes(db).partial(BoxSummary).find,
+    )
+
+
+def _endpoints(db: AsyncIOMotorDatabase) -> FastAPI:
+    app = FastAPI()
+
+    for name, model, repo in (
+        ("boxes", Box, repository.boxes(db)),
+        ("users", User, repository.users(db)),
+    ):
+
+        def routes(model: type, repo: repository.Repository) -> None:
+            @app.get(f"/{name}/models", response_model=list[model])
+            async def _models():
+                return await repo.find()
+
+            @app.get(f"/{name}/documents", response_model=list[model])
+            async def _documents():
+                return await repo.collection.find({}, repo.projection).to_list(None)
+
+            @app.get(f"/{name}/json", response_model=list[model])
+            async def _json():
+                return Response(await repo.find_json(), media_type="application/json")
+
+        routes(model, repo)
+
+    return app
+
+
+async def main_endpoints(count: int, db: AsyncIOMotorDatabase) -> None:
+    """Models: Repository.find, validated again by FastAPI. Documents:
+    validated by FastAPI only. JSON: Repository.find_json, sent as is."""
+    transport = httpx.ASGITransport(app=_endpoints(db))
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+
+        async def get(path: str) -> None:
+            (await http.get(path)).raise_for_status()
+
+        for name in ("boxes", "users"):
+            for path in ("models", "documents", "json"):
+                await _timeit(
+                    f"GET /{name}/{path}",
+                    count,
+                    lambda: get(f"/{name}/{path}"),
+                )
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 3000))
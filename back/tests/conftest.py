@@ -0,0 +1,27 @@
+import functools
+
+import pytest
+
+from back.core import unet_ids
+
+mongomock_collection = pytest.importorskip("mongomock.collection")
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+
+def _without_sort(method):
+    # pymongo >= 4.11 passes a sort to the bulk operations, unknown to mongomock
+    @functools.wraps(method)
+    def wrapper(self, *args, sort=None, **kwargs):
+        return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+@pytest.fixture
+def db(monkeypatch):
+    builder = mongomock_collection.BulkOperationBuilder
+    for name in ("add_update", "add_replace"):
+        monkeypatch.setattr(builder, name, _without_sort(getattr(builder, name)))
+    # mongomock_motor does not wrap the collections returned by with_options
+    monkeypatch.setattr(unet_ids, "durable", lambda collection: collection)
+    return mongomock_motor.AsyncMongoMockClient()["sadh"]
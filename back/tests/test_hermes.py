@@ -0,0 +1,45 @@
+import asyncio
+from ipaddress import IPv4Address, IPv4Interface
+
+from common_models.hermes_models import WanIpv4
+
+from back.core import hermes
+from back.core.hermes import register_boxes_for_new_ftth_adhs
+
+
+async def _lease_many_addresses(self, requests):
+    # The bitmap allocator relies on $bit, which mongomock does not support
+    addresses = []
+    for i, (from_telecom, _) in enumerate(requests, start=1):
+        ipv4 = IPv4Address("137.194.8.0") + i
+        addresses.append(
+            (
+                WanIpv4(ip=IPv4Interface((ipv4, 22)), vlan=101),
+                *self.compute_ipv6_and_prefix(ipv4, from_telecom),
+            )
+        )
+    return addresses
+
+
+def test_register_boxes_for_new_ftth_adhs(db, monkeypatch):
+    monkeypatch.setattr(hermes.MongoIpam, "lease_many_addresses", _lease_many_addresses)
+
+    boxes = asyncio.run(
+        register_boxes_for_new_ftth_adhs(
+            db,
+            [
+                ("AC", "Default", "00:00:00:00:00:01", True),
+                ("AC", "Default", "00:00:00:00:00:02", True),
+            ],
+        )
+    )
+
+    assert all(boxes)
+    assert len({box.main_unet_id for box in boxes}) == 2
+    assert [box.type for box in boxes] == ["ac", "ac"]
+    assert asyncio.run(db.boxes.count_documents({})) == 2
+    bucket = asyncio.run(db.ipam_logs.find_one())
+    assert [log["message"].rsplit(" ", 1)[1] for log in bucket["logs"]] == [
+        "00:00:00:00:00:01",
+        "00:00:00:00:00:02",
+    ]